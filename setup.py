@@ -30,6 +30,11 @@ EXCLUDED_PACKAGES = [
 REQUIRES = [
 ]
 
+EXTRAS_REQUIRE = {
+    'matrix': ['numpy'],
+    'xlsx': ['openpyxl'],
+}
+
 if __name__ == '__main__':
     setuptools.setup(
         name=NAME,
@@ -42,5 +47,6 @@ if __name__ == '__main__':
         packages=["shuup_shipping_table"],
         include_package_data=True,
         install_requires=REQUIRES,
+        extras_require=EXTRAS_REQUIRE,
         entry_points={"shuup.addon": "shuup_shipping_table=shuup_shipping_table"}
     )
@@ -31,6 +31,12 @@ class ShuupShippingTableAppConfig(AppConfig):
         ]
     }
 
+    def ready(self):
+        # connect signals
+        from shuup_shipping_table.signal_handlers import connect_region_signals
+        connect_region_signals()
+
+
 default_app_config = __name__ + ".ShuupShippingTableAppConfig"
 
 __version__ = "0.1.0.dev0"
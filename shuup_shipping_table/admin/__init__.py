@@ -32,7 +32,7 @@ class ShippingTableAdminModule(AdminModule):
         permissions = self.get_required_permissions()
         return [
             admin_url(
-                "%s/(?P<pk>\d+)/delete/$" % self.url_prefix,
+                r"%s/(?P<pk>\d+)/delete/$" % self.url_prefix,
                 self.view_template % "Delete",
                 name=self.name_template % "delete",
                 permissions=permissions
@@ -76,6 +76,24 @@ class ShippingTableModule(ShippingTableAdminModule):
     name_template = "shipping_table.%s"
     menu_entry_url = "shuup_admin:shipping_table.list"
 
+    def get_urls(self):
+        urls = super(ShippingTableModule, self).get_urls()
+        urls = urls + [
+            admin_url(
+                r"%s/(?P<pk>\d+)/import/$" % self.url_prefix,
+                self.view_template % "ItemImport",
+                name=self.name_template % "import_items",
+                permissions=self.get_required_permissions()
+            ),
+            admin_url(
+                r"%s/(?P<pk>\d+)/export/$" % self.url_prefix,
+                self.view_template % "Export",
+                name=self.name_template % "export",
+                permissions=self.get_required_permissions()
+            )
+        ]
+        return urls
+
 
 class ShippingCarrierModule(ShippingTableAdminModule):
     name = _("Carriers")
@@ -8,16 +8,16 @@
 # LICENSE file in the root directory of this source tree.
 from __future__ import unicode_literals
 
+from shuup_shipping_table.exporter import export_regions
+from shuup_shipping_table.importer import RegionImporter
 from shuup_shipping_table.models import ShippingRegion
 
 from django import forms
 from django.contrib import messages
-from django.core import serializers
 from django.core.urlresolvers import reverse, reverse_lazy
 from django.http import StreamingHttpResponse
 from django.http.response import HttpResponseRedirect
 from django.utils.translation import ugettext_lazy as _
-from django.utils.translation import ungettext_lazy as _p
 from django.views.generic.base import View
 from django.views.generic.edit import DeleteView
 
@@ -114,17 +114,22 @@ class RegionEditView(CreateOrUpdateView):
 
 
 class RegionImportView(View):
+    # number of record errors shown to the user
+    max_reported_errors = 10
 
     def post(self, request, **kwargs):
 
         if request.FILES.get('json_file'):
-
-            obj_count = 0
-            for deserialized_object in serializers.deserialize("json", request.FILES['json_file']):
-                deserialized_object.save()
-                obj_count = obj_count + 1
-
-            messages.info(request, _p("Imported {0} regions", "Imported {0} regions", obj_count).format(obj_count))
+            result = RegionImporter().import_file(request.FILES['json_file'])
+
+            if result.errors:
+                for error in result.errors[:self.max_reported_errors]:
+                    messages.error(request, _("Record {0}: {1}").format(error.record, error.message))
+                messages.error(request, _("No regions imported, fix the errors and try again"))
+            else:
+                messages.info(request, _("Regions imported: {0} created, {1} updated, {2} unchanged").format(
+                    result.created, result.updated, result.unchanged
+                ))
         else:
             messages.error(request, _("Missing JSON file"))
 
@@ -134,11 +139,6 @@ class RegionImportView(View):
 class RegionExportView(View):
 
     def get(self, request, **kwargs):
-        # FIXME: this is serializing objects without translated fields
-        from shuup_shipping_table.models import ShippingRegionTranslation
-        data = serializers.serialize(
-            'json', list(ShippingRegion.objects.all()) + list(ShippingRegionTranslation.objects.all())
-        )
-        response = StreamingHttpResponse(data, content_type="text/json")
+        response = StreamingHttpResponse(export_regions(), content_type="text/json")
         response['Content-Disposition'] = 'attachment; filename="shipping_regions.json"'
         return response
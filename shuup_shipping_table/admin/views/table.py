@@ -8,16 +8,27 @@
 # LICENSE file in the root directory of this source tree.
 from __future__ import unicode_literals
 
+import os
+
 from shuup_shipping_table.admin.forms import ShippingTableFormPart, ShippingTableItemFormPart
+from shuup_shipping_table.exporter import EXPORT_FORMATS, export_table, get_export_filename
+from shuup_shipping_table.importer import InvalidFileError, TableItemImporter, TableItemSynchronizer
 from shuup_shipping_table.models import ShippingCarrier, ShippingTable
 
-from django.core.urlresolvers import reverse_lazy
+from django.contrib import messages
+from django.core.urlresolvers import reverse, reverse_lazy
 from django.db.transaction import atomic
+from django.http import Http404, StreamingHttpResponse
+from django.http.response import HttpResponseRedirect
+from django.shortcuts import get_object_or_404
+from django.utils.encoding import force_text
 from django.utils.translation import ugettext_lazy as _
+from django.utils.translation import ungettext_lazy as _p
+from django.views.generic.base import View
 from django.views.generic.edit import DeleteView
 
 from shuup.admin.form_part import FormPartsViewMixin, SaveFormPartsMixin
-from shuup.admin.toolbar import JavaScriptActionButton
+from shuup.admin.toolbar import DropdownActionButton, DropdownItem, JavaScriptActionButton
 from shuup.admin.utils.picotable import ChoicesFilter, Column, TextFilter
 from shuup.admin.utils.views import CreateOrUpdateView, PicotableListView
 from shuup.utils.i18n import get_locally_formatted_datetime
@@ -68,9 +79,90 @@ class TableEditView(SaveFormPartsMixin, FormPartsViewMixin, CreateOrUpdateView):
             )
             toolbar.append(save_as_copy_button)
 
+            toolbar.append(DropdownActionButton([
+                DropdownItem(text=_("Sync items"), icon="fa fa-refresh", onclick="importItems('sync')"),
+                DropdownItem(text=_("Replace items"), icon="fa fa-exchange", onclick="importItems('replace')"),
+            ], text=_("Import items"), icon="fa fa-cloud-upload", extra_css_class="btn-info"))
+
+            toolbar.append(JavaScriptActionButton(text=_("Export items"),
+                                                  icon="fa fa-cloud-download",
+                                                  onclick="exportItems()",
+                                                  extra_css_class="btn-info"))
+
         return toolbar
 
 
 class TableDeleteView(DeleteView):
     model = ShippingTable
     success_url = reverse_lazy("shuup_admin:shuup_shipping_table.table.list")
+
+
+class TableItemImportView(View):
+    # number of row errors shown to the user
+    max_reported_errors = 10
+
+    def post(self, request, pk, **kwargs):
+        table = get_object_or_404(ShippingTable, pk=pk)
+        items_file = request.FILES.get("items_file")
+
+        if not items_file:
+            messages.error(request, _("Missing CSV or XLSX file"))
+        else:
+            file_format = os.path.splitext(items_file.name)[1].lstrip(".").lower()
+
+            if file_format not in ("csv", "xlsx"):
+                messages.error(request, _("Invalid file format, use a CSV or XLSX file"))
+            else:
+                self.import_items(request, table, items_file, file_format)
+
+        return HttpResponseRedirect(reverse("shuup_admin:shipping_table.edit", kwargs={"pk": table.pk}))
+
+    def import_items(self, request, table, items_file, file_format):
+        mode = request.POST.get("mode")
+        if mode == "sync":
+            importer = TableItemSynchronizer(table)
+        else:
+            importer = TableItemImporter(table, replace=(mode == "replace"))
+
+        try:
+            result = importer.import_file(items_file, file_format)
+        except InvalidFileError as error:
+            messages.error(request, force_text(error))
+            messages.error(request, _("No items imported, fix the errors and try again"))
+            return
+
+        if result.errors:
+            for error in result.errors[:self.max_reported_errors]:
+                messages.error(request, _("Line {0}: {1}").format(error.line, error.message))
+            messages.error(request, _("No items imported, fix the errors and try again"))
+        elif mode == "sync":
+            messages.info(request, _("Items synchronized: {0} created, {1} updated, {2} deleted, "
+                                     "{3} unchanged").format(result.created, result.updated,
+                                                             result.deleted, result.unchanged))
+        else:
+            messages.info(request, _p("Imported {0} item", "Imported {0} items",
+                                      result.created).format(result.created))
+
+
+class TableExportView(View):
+    content_types = {
+        "csv": "text/csv",
+        "jsonl": "application/x-ndjson",
+    }
+
+    def get(self, request, pk, **kwargs):
+        table = get_object_or_404(ShippingTable, pk=pk)
+        file_format = request.GET.get("format", "csv")
+        compress = bool(request.GET.get("gzip"))
+
+        if file_format not in EXPORT_FORMATS:
+            raise Http404("Invalid export format")
+
+        response = StreamingHttpResponse(
+            export_table(table, file_format, compress),
+            content_type=("application/gzip" if compress else self.content_types[file_format])
+        )
+        response['Content-Disposition'] = 'attachment; filename="%s"' % get_export_filename(
+            table, file_format, compress
+        )
+        return response
@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Shipping Table
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+import hashlib
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+
+from shuup_shipping_table.utils import get_setting
+
+from django.core.cache import cache
+from django.utils.encoding import force_bytes, force_text
+from django.utils.timezone import now
+
+SOURCE_CACHE_ATTR = "_shipping_table_lookup_cache"
+# set on sources whose pinned resolutions must be resolved again
+SKIP_PINS_ATTR = "_shipping_table_skip_pins"
+GENERATION_CACHE_KEY = "shipping_table:generation:%s"
+GLOBAL_GENERATION = "all"
+TRANSITIONS_CACHE_KEY = "shipping_table:transitions:%s"
+COMPONENT_FILTERS_CACHE_KEY = "shipping_table:component_filters:%s"
+LOOKUP_CACHE_KEY = "shipping_table:lookup:%s"
+PIN_CACHE_KEY = "shipping_table:pin:%s:%s"
+
+_packaging_cache = None
+_version_check = {"checked_at": None, "version": None}
+ADDRESS_KEY_ATTRS = ("country", "postal_code", "region_code", "region", "city", "street1", "street2", "street3")
+
+
+def get_address_key(address):
+    """
+    Returns a hashable key with the address attributes used to match regions.
+    """
+    if not address:
+        return None
+
+    return tuple(
+        force_text(getattr(address, attr, None) or "").upper().strip()
+        for attr in ADDRESS_KEY_ATTRS
+    )
+
+
+def get_source_lines_key(source):
+    """
+    Returns a hashable key with the product lines contents of the source.
+
+    Only the attributes which change the source weight (or the packages
+    generated by the cubic weight packer) are used.
+    """
+    lines_key = []
+
+    for line in source.get_lines():
+        product = getattr(line, "product", None)
+        if not product:
+            continue
+
+        lines_key.append((
+            product.pk,
+            line.quantity,
+            product.gross_weight,
+            product.width,
+            product.height,
+            product.depth
+        ))
+
+    return tuple(sorted(lines_key))
+
+
+def get_source_key(source):
+    """
+    Returns a hashable key which identifies the source contents
+    that matter for a shipping table lookup: shop, shipping address and lines.
+    """
+    return (
+        source.shop.pk if source.shop else None,
+        get_address_key(source.shipping_address),
+        get_source_lines_key(source)
+    )
+
+
+def _get_initial_generation():
+    # generations are not reset to 0 when the cache entry is evicted,
+    # otherwise a new generation could match an old one
+    return int(time.time() * 1000)
+
+
+def get_generation(shop_id=None):
+    """
+    Returns the current lookup generation of the shop.
+
+    The generation changes whenever a table, item, carrier or region
+    that may change a lookup of the shop is modified. Anything cached
+    together with the generation is stale once it doesn't match anymore.
+
+    When `shop_id` is None, only the global generation (bumped by changes
+    which may affect any shop, like region changes) is returned.
+
+    :rtype: tuple[int]
+    """
+    check_version()
+
+    keys = [GENERATION_CACHE_KEY % GLOBAL_GENERATION]
+    if shop_id is not None:
+        keys.append(GENERATION_CACHE_KEY % shop_id)
+    generations = cache.get_many(keys)
+
+    for key in keys:
+        if key not in generations:
+            cache.add(key, _get_initial_generation(), None)
+            generations[key] = cache.get(key)
+
+    return tuple(generations[key] for key in keys)
+
+
+def bump_generation(shop_id=None):
+    """
+    Bumps the lookup generation of the shop,
+    or of all the shops when `shop_id` is None.
+    """
+    key = GENERATION_CACHE_KEY % (GLOBAL_GENERATION if shop_id is None else shop_id)
+
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _get_initial_generation(), None)
+
+
+def check_version():
+    """
+    Compares the version stamp stored in the database with the last one
+    seen by this process, at most once every `SHIPPING_TABLE_VERSION_CHECK_INTERVAL`
+    seconds, and bumps the global generation when it changed.
+
+    This makes the generations (and everything cached with them) follow
+    changes made by other nodes when the cache is not shared between them.
+    """
+    interval = get_setting("SHIPPING_TABLE_VERSION_CHECK_INTERVAL")
+    if interval is None:
+        return
+
+    current_time = time.time()
+    checked_at = _version_check["checked_at"]
+    if checked_at is not None and current_time - checked_at < interval:
+        return
+
+    from shuup_shipping_table.models import ShippingTableVersion
+    version = ShippingTableVersion.get_current()
+
+    if _version_check["version"] is not None and version != _version_check["version"]:
+        bump_generation()
+
+    _version_check.update(checked_at=current_time, version=version)
+
+
+def get_table_transitions(shop_id, generation=None):
+    """
+    Returns the sorted moments when any enabled table of the shop
+    becomes available or unavailable.
+
+    The list is cached with the lookup generation of the shop,
+    so it is recomputed when tables change.
+    """
+    from shuup_shipping_table.models import ShippingTable
+
+    generation = generation or get_generation(shop_id)
+    key = TRANSITIONS_CACHE_KEY % shop_id
+    cached = cache.get(key)
+
+    if cached is not None and cached[0] == generation:
+        return cached[1]
+
+    transitions = set()
+    for table in ShippingTable.objects.filter(shops=shop_id, enabled=True).only("start_date", "end_date"):
+        transitions.update(table.get_availability_transitions())
+
+    transitions = sorted(transitions)
+    cache.set(key, (generation, transitions), None)
+    return transitions
+
+
+def get_next_transition(transitions, when):
+    """
+    Returns the first of the sorted transitions after `when`, or None.
+
+    Anything computed from the table availability at `when`
+    stays valid until that moment.
+    """
+    index = bisect_right(transitions, when)
+    return transitions[index] if index < len(transitions) else None
+
+
+def get_component_filters(component_id, load):
+    """
+    Returns the filters of a component, calling `load` to
+    fetch them when they are not cached.
+
+    The entries are cleared when the component filters change and are
+    cached with the global generation, which is bumped when tables or
+    carriers are deleted (removing them from the filters without signals).
+    """
+    generation = get_generation()
+    key = COMPONENT_FILTERS_CACHE_KEY % component_id
+    cached = cache.get(key)
+
+    if cached is None or cached[0] != generation:
+        cached = (generation, load())
+        cache.set(key, cached, None)
+
+    return cached[1]
+
+
+def clear_component_filters(component_id):
+    cache.delete(COMPONENT_FILTERS_CACHE_KEY % component_id)
+
+
+def get_lookup_cache_key(shop_id, address, weight_band, lookup_key):
+    """
+    Returns the cache key of a lookup shared by the sources with the same
+    shop, address and weight band.
+
+    The key contains the lookup generation of the shop,
+    so any table change invalidates the cached lookups.
+    """
+    key = (shop_id, get_address_key(address), weight_band, lookup_key, get_generation(shop_id))
+    return LOOKUP_CACHE_KEY % hashlib.md5(force_bytes(repr(key))).hexdigest()
+
+
+def get_cached_lookup(lookup_cache_key):
+    """
+    Returns the cached lookup value, or None when it is not cached.
+    """
+    return cache.get(lookup_cache_key)
+
+
+def set_cached_lookup(lookup_cache_key, value, shop_id, timeout):
+    """
+    Caches a lookup value for `timeout` seconds, or until
+    a table of the shop becomes available or unavailable.
+    """
+    current_time = now()
+    next_transition = get_next_transition(get_table_transitions(shop_id), current_time)
+
+    if next_transition is not None:
+        timeout = min(timeout, int((next_transition - current_time).total_seconds()))
+
+    if timeout > 0:
+        cache.set(lookup_cache_key, value, timeout)
+
+
+def get_pinned_lookup(component_id, fingerprint):
+    """
+    Returns the id of the item pinned for the component and the
+    source fingerprint, as a one-item tuple, or None when nothing is pinned.
+
+    The tuple holds None when the pinned resolution is a miss.
+    """
+    pinned = cache.get(PIN_CACHE_KEY % (component_id, fingerprint))
+    return (pinned["item"],) if pinned is not None else None
+
+
+def set_pinned_lookup(component_id, fingerprint, item_id):
+    """
+    Pins the id of the item (or None for a miss) resolved for the component
+    and the source fingerprint for `SHIPPING_TABLE_PIN_TTL` seconds.
+    """
+    cache.set(PIN_CACHE_KEY % (component_id, fingerprint), {"item": item_id}, get_setting("SHIPPING_TABLE_PIN_TTL"))
+
+
+def get_source_fingerprint(source, lookup_key):
+    """
+    Returns a digest of everything a resolution depends on: the source
+    contents, the component lookup key, the lookup generation of the shop
+    and its next table availability transition.
+
+    A resolution pinned with a fingerprint is still valid while the
+    fingerprint of the source does not change.
+    """
+    source_memo = _get_source_memo(source)
+    key = (source_memo["key"], lookup_key, source_memo["generation"], source_memo["expires_at"])
+    return hashlib.md5(force_bytes(repr(key))).hexdigest()
+
+
+def _get_source_memo(source):
+    source_key = get_source_key(source)
+    source_memo = getattr(source, SOURCE_CACHE_ATTR, None)
+    current_time = now()
+
+    if (not source_memo or source_memo["key"] != source_key or
+            (source_memo["expires_at"] is not None and current_time >= source_memo["expires_at"])):
+        generation = get_generation(source.shop.pk)
+        source_memo = {
+            "key": source_key,
+            "generation": generation,
+            "items": {},
+            "expires_at": get_next_transition(get_table_transitions(source.shop.pk, generation), current_time)
+        }
+        setattr(source, SOURCE_CACHE_ATTR, source_memo)
+
+    return source_memo
+
+
+def get_source_cache(source):
+    """
+    Returns the lookup cache dict attached to the source.
+
+    The cache is dropped whenever the source key changes, so a modified
+    basket never reuses a stale resolution, and when any table of the shop
+    becomes available or unavailable. The lookup generation of the shop
+    is checked once, when the cache is created: sources are built again
+    for every request, so table changes are seen by the next request,
+    or right away after `clear_source_cache`.
+    """
+    return _get_source_memo(source)["items"]
+
+
+def clear_source_cache(source):
+    """
+    Clears all the cached lookups of the source and
+    resolves its pinned items again.
+
+    Call this after changing the source in some way
+    the source key can't notice.
+    """
+    if hasattr(source, SOURCE_CACHE_ATTR):
+        delattr(source, SOURCE_CACHE_ATTR)
+    setattr(source, SKIP_PINS_ATTR, True)
+
+
+class LRUCache(object):
+    """
+    A thread safe in-process cache which keeps the `max_size` most recently used entries.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+
+            # move the entry to the end, it is the most recently used now
+            value = self._entries.pop(key)
+            self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def get_packaging_cache():
+    """
+    Returns the process cache of the cubic weight packing results.
+    """
+    global _packaging_cache
+
+    if _packaging_cache is None:
+        _packaging_cache = LRUCache(get_setting("SHIPPING_TABLE_PACKAGING_CACHE_SIZE"))
+
+    return _packaging_cache
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Shipping Table
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+from bisect import bisect_left
+from collections import defaultdict
+from itertools import chain
+
+from shuup_shipping_table.cache import get_generation, get_next_transition
+from shuup_shipping_table.intervals import IntervalIndex
+from shuup_shipping_table.models import ShippingTableItem, TABLE_ITEM_PREFETCH
+
+from django.utils.timezone import now
+
+# compiled rate indexes of this process, by shop id
+_rate_indexes = {}
+
+# weight breakpoints of this process, by shop id
+_weight_breakpoints = {}
+
+
+class RateIndex(object):
+    """
+    The table items of a shop available at the build time compiled into memory.
+
+    Items are grouped by region priority (highest first) and each group
+    holds an interval index over the item weight ranges, so a lookup is
+    a bisect plus a short scan per priority without any query.
+
+    The index expires at the next moment any of the tables becomes
+    available or unavailable, so lookups don't check the table dates.
+    """
+
+    def __init__(self, shop_id, table_items, generation=None, when=None):
+        self.shop_id = shop_id
+        self.generation = generation
+        self.built_at = when or now()
+
+        transitions = set()
+        items_by_priority = defaultdict(list)
+        for table_item in table_items:
+            transitions.update(table_item.table.get_availability_transitions())
+            if not table_item.table.is_available_at(self.built_at):
+                continue
+
+            items_by_priority[table_item.region.priority].append(
+                (table_item.start_weight, table_item.end_weight, table_item)
+            )
+
+        self.expires_at = get_next_transition(sorted(transitions), self.built_at)
+        self.groups = [
+            (priority, IntervalIndex(items_by_priority[priority]))
+            for priority in sorted(items_by_priority, reverse=True)
+        ]
+
+    def __len__(self):
+        return sum(len(index) for (priority, index) in self.groups)
+
+    def is_expired(self, when=None):
+        when = when or now()
+        return when < self.built_at or (self.expires_at is not None and when >= self.expires_at)
+
+    def get_table_items(self, weight):
+        """
+        Returns the items which contain the weight,
+        ordered by region priority (highest first) and id.
+        """
+        table_items = []
+
+        for priority, index in self.groups:
+            table_items.extend(sorted(index.find(weight), key=lambda table_item: table_item.pk))
+
+        return table_items
+
+
+def build_rate_index(shop):
+    generation = get_generation(shop.pk)
+    table_items = ShippingTableItem.objects.filter(
+        table__enabled=True,
+        table__carrier__enabled=True,
+        table__shops=shop
+    ).select_related("table").prefetch_related(*TABLE_ITEM_PREFETCH)
+
+    return RateIndex(shop.pk, table_items, generation)
+
+
+def get_rate_index(shop):
+    """
+    Returns the compiled rate index of the shop, building it
+    if needed, if its generation is stale or if it expired.
+    """
+    rate_index = _rate_indexes.get(shop.pk)
+
+    if rate_index is None or rate_index.generation != get_generation(shop.pk) or rate_index.is_expired():
+        rate_index = build_rate_index(shop)
+        _rate_indexes[shop.pk] = rate_index
+
+    return rate_index
+
+
+def invalidate_rate_indexes():
+    _rate_indexes.clear()
+
+
+def get_weight_breakpoints(shop):
+    """
+    Returns the sorted distinct start and end weights of the items
+    of the enabled tables of the shop, recomputed when tables change.
+    """
+    generation = get_generation(shop.pk)
+    weight_breakpoints = _weight_breakpoints.get(shop.pk)
+
+    if weight_breakpoints is None or weight_breakpoints[0] != generation:
+        weights = ShippingTableItem.objects.filter(
+            table__enabled=True,
+            table__carrier__enabled=True,
+            table__shops=shop
+        ).values_list("start_weight", "end_weight")
+        weight_breakpoints = (generation, sorted(set(chain.from_iterable(weights))))
+        _weight_breakpoints[shop.pk] = weight_breakpoints
+
+    return weight_breakpoints[1]
+
+
+def get_weight_band(breakpoints, weight):
+    """
+    Returns the band of the weight between the sorted breakpoints:
+    band `2i + 1` is the breakpoint `i` itself and band `2i` is
+    the open interval between the breakpoints `i - 1` and `i`.
+
+    The weight ranges are inclusive, so the items which contain
+    a weight are the same for every weight of its band.
+    """
+    position = bisect_left(breakpoints, weight)
+    on_breakpoint = position < len(breakpoints) and breakpoints[position] == weight
+    return position * 2 + int(on_breakpoint)
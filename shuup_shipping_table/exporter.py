@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Shipping Table
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Streaming exports of shipping tables, their items and the regions.
+
+Rows are read in primary key order, a chunk at a time, and written
+as they are read, so the memory used does not grow with the tables.
+The item CSV files have the columns of the item import.
+"""
+from __future__ import unicode_literals
+
+import csv
+import json
+import zlib
+from collections import defaultdict
+
+from shuup_shipping_table.importer import TABLE_ITEM_COLUMNS
+from shuup_shipping_table.models import ShippingRegion, ShippingTableItem
+
+from django.core import serializers
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import six
+from django.utils.encoding import force_bytes
+
+EXPORT_FORMATS = ("csv", "jsonl")
+
+# rows fetched per query and approximate size of the yielded chunks
+CHUNK_ROWS = 2000
+CHUNK_BYTES = 64 * 1024
+
+
+class _Echo(object):
+    """
+    A file-like object which returns what is written to it,
+    so a `csv.writer` formats a row without buffering it.
+    """
+
+    def write(self, value):
+        return value
+
+
+def iter_table_item_rows(table, chunk_size=CHUNK_ROWS):
+    """
+    Yields the `TABLE_ITEM_COLUMNS` values of the items of the table,
+    with a query per chunk keyed on the last primary key read.
+    """
+    last_pk = 0
+
+    while True:
+        rows = list(
+            ShippingTableItem.objects.filter(table=table, pk__gt=last_pk).order_by("pk").values_list(
+                "pk", *TABLE_ITEM_COLUMNS
+            )[:chunk_size].iterator()
+        )
+        if not rows:
+            return
+
+        for row in rows:
+            yield row[1:]
+
+        last_pk = rows[-1][0]
+
+
+def iter_csv_lines(table):
+    writer = csv.writer(_Echo())
+    yield force_bytes(writer.writerow(TABLE_ITEM_COLUMNS))
+
+    for row in iter_table_item_rows(table):
+        line = writer.writerow([force_bytes(value) if six.PY2 else value for value in row])
+        yield force_bytes(line)
+
+
+def iter_jsonl_lines(table):
+    def dumps(obj):
+        return force_bytes(json.dumps(obj, cls=DjangoJSONEncoder, sort_keys=True) + "\n")
+
+    yield dumps({
+        "type": "table",
+        "identifier": table.identifier,
+        "name": table.name,
+        "enabled": table.enabled,
+        "carrier": table.carrier_id,
+        "start_date": table.start_date,
+        "end_date": table.end_date,
+    })
+
+    for row in iter_table_item_rows(table):
+        item = dict(zip(TABLE_ITEM_COLUMNS, row))
+        item["type"] = "item"
+        yield dumps(item)
+
+
+def _join_chunks(lines, chunk_bytes=CHUNK_BYTES):
+    chunk = []
+    size = 0
+
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+        if size >= chunk_bytes:
+            yield b"".join(chunk)
+            chunk = []
+            size = 0
+
+    if chunk:
+        yield b"".join(chunk)
+
+
+def _gzip_chunks(chunks):
+    # 16 + MAX_WBITS writes the gzip header and trailer
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+
+    yield compressor.flush()
+
+
+def export_table(table, file_format, compress=False):
+    """
+    Returns an iterator of the bytes of the table export.
+
+    :param file_format: one of the `EXPORT_FORMATS`
+    :param compress: whether to gzip the export on the fly
+    """
+    if file_format == "csv":
+        lines = iter_csv_lines(table)
+    elif file_format == "jsonl":
+        lines = iter_jsonl_lines(table)
+    else:
+        raise ValueError("Invalid export format: %r" % file_format)
+
+    chunks = _join_chunks(lines)
+    return _gzip_chunks(chunks) if compress else chunks
+
+
+def get_export_filename(table, file_format, compress=False):
+    return "%s.%s%s" % (table.identifier, file_format, ".gz" if compress else "")
+
+
+def _serialize_records(objects):
+    # the serialized objects without the enclosing brackets of the JSON list
+    return serializers.serialize("json", objects, use_natural_foreign_keys=True).strip()[1:-1].strip()
+
+
+def iter_region_records(chunk_size=CHUNK_ROWS):
+    """
+    Yields the serialized records of each region: the base region,
+    the concrete region and its translations, in the format of the
+    Django serializers, with three queries per chunk of regions.
+    """
+    translation_model = ShippingRegion._parler_meta.root_model
+    last_pk = 0
+
+    while True:
+        base_regions = list(
+            ShippingRegion.objects.non_polymorphic().filter(pk__gt=last_pk).order_by("pk")[:chunk_size]
+        )
+        if not base_regions:
+            return
+
+        region_ids = [region.pk for region in base_regions]
+        regions = dict((region.pk, region) for region in ShippingRegion.objects.filter(pk__in=region_ids))
+        translations = defaultdict(list)
+        for translation in translation_model.objects.filter(master_id__in=region_ids).order_by("pk"):
+            translations[translation.master_id].append(translation)
+
+        for base_region in base_regions:
+            objects = [base_region]
+            region = regions.get(base_region.pk)
+            if region is not None and type(region) is not ShippingRegion:
+                objects.append(region)
+            yield _serialize_records(objects + translations[base_region.pk])
+
+        last_pk = region_ids[-1]
+
+
+def iter_region_json_lines():
+    yield b"["
+    separator = b"\n"
+
+    for records in iter_region_records():
+        yield separator + force_bytes(records)
+        separator = b",\n"
+
+    yield b"\n]\n"
+
+
+def export_regions():
+    """
+    Returns an iterator of the bytes of a JSON list with all the regions
+    and their translations, loadable by the Django deserializers.
+    """
+    return _join_chunks(iter_region_json_lines())
@@ -0,0 +1,961 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Shipping Table
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Bulk imports of shipping table items and of regions.
+
+The item files are CSV or XLSX, with a header row with the `TABLE_ITEM_COLUMNS`
+in any order. Regions are given by id or by name. XLSX files require openpyxl,
+which is an optional dependency (install with `pip install shuup-shipping-table[xlsx]`).
+
+The region files are JSON lists of records in the format of the Django
+serializers, like the ones of the region export.
+"""
+from __future__ import unicode_literals
+
+import codecs
+import csv
+import json
+import re
+import zipfile
+from collections import namedtuple, OrderedDict
+from decimal import Context, Decimal, InvalidOperation
+
+from shuup_shipping_table.models import ShippingRegion, ShippingTableItem
+from shuup_shipping_table.signal_handlers import bump_generation_on_commit, bump_table_generation
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Case, Value, When
+from django.utils import six
+from django.utils.encoding import force_text
+
+TABLE_ITEM_COLUMNS = ("region", "start_weight", "end_weight", "price", "delivery_time")
+
+RowError = namedtuple("RowError", ("line", "message"))
+RecordError = namedtuple("RecordError", ("record", "message"))
+TableItemImportResult = namedtuple("TableItemImportResult", ("created", "deleted", "errors"))
+TableItemSyncResult = namedtuple("TableItemSyncResult", ("created", "updated", "deleted", "unchanged", "errors"))
+RegionImportResult = namedtuple("RegionImportResult", ("created", "updated", "unchanged", "errors"))
+
+# rows updated by each UPDATE, with three query parameters per row
+UPDATE_BATCH_SIZE = 300
+
+# whitespace and separators between the objects of a JSON list
+_JSON_SEPARATORS = re.compile(r"[\s,]*")
+
+# marks region names shared by more than one region
+AMBIGUOUS = object()
+
+
+class InvalidFileError(ValueError):
+    """
+    Raised while reading a file which is not a valid CSV or XLSX file.
+    """
+
+
+def read_csv_rows(file, encoding="utf-8"):
+    """
+    Yields the rows of a CSV file opened in binary mode as lists of text.
+    """
+    try:
+        if six.PY2:
+            for row in csv.reader(file):
+                yield [force_text(value, encoding) for value in row]
+        else:
+            lines = (line.decode(encoding) if isinstance(line, bytes) else line for line in file)
+            for row in csv.reader(lines):
+                yield row
+    except (UnicodeDecodeError, csv.Error) as error:
+        raise InvalidFileError("Invalid CSV file: %s" % force_text(error))
+
+
+def read_xlsx_rows(file):
+    """
+    Yields the rows of the active sheet of a XLSX file as lists of values.
+    """
+    try:
+        import openpyxl
+        from openpyxl.utils.exceptions import InvalidFileException
+    except ImportError:  # pragma: no cover
+        raise ImportError("openpyxl is required to import XLSX files.")
+
+    try:
+        workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    except (zipfile.BadZipfile, InvalidFileException, KeyError) as error:
+        raise InvalidFileError("Invalid XLSX file: %s" % force_text(error))
+
+    for row in workbook.active.iter_rows():
+        yield [cell.value for cell in row]
+
+
+def read_rows(file, file_format):
+    if file_format == "csv":
+        return read_csv_rows(file)
+    if file_format == "xlsx":
+        return read_xlsx_rows(file)
+    raise ValueError("Invalid file format: %r" % file_format)
+
+
+def _iter_json_pieces(file, encoding, read_size):
+    """
+    Yields the pieces of text of the file, without the byte order mark,
+    and whether the file is over.
+    """
+    text_decoder = codecs.getincrementaldecoder(encoding)()
+    first_piece = True
+
+    while True:
+        data = file.read(read_size)
+        eof = not data
+        if isinstance(data, bytes):
+            data = text_decoder.decode(data, final=eof)
+        if first_piece and data:
+            data = data.lstrip("\ufeff")
+            first_piece = False
+
+        yield (data, eof)
+
+
+def _decode_json_object(decoder, buffer, index, eof):
+    """
+    Returns the object at the index of the buffer and the index after it,
+    or None when the object doesn't end in the buffer yet.
+    """
+    if buffer[index] != "{":
+        raise ValueError("Expected a JSON object at %r" % buffer[index:index + 20])
+
+    try:
+        return decoder.raw_decode(buffer, index)
+    except ValueError:
+        # an object split between the pieces, unless the file is over
+        if eof:
+            raise
+        return (None, index)
+
+
+def iter_json_records(file, encoding="utf-8", read_size=64 * 1024):
+    """
+    Yields the objects of a JSON list read from a file a piece at a time,
+    so the whole file is never held in memory.
+
+    Raises a ValueError when the file is not a JSON list of objects.
+    """
+    decoder = json.JSONDecoder()
+    pieces = _iter_json_pieces(file, encoding, read_size)
+    buffer = ""
+    index = 0
+    eof = False
+    started = False
+
+    while True:
+        index = _JSON_SEPARATORS.match(buffer, index).end()
+
+        if not started and index < len(buffer):
+            if buffer[index] != "[":
+                raise ValueError("Expected a JSON list")
+            started = True
+            index += 1
+            continue
+
+        if index < len(buffer):
+            if buffer[index] == "]":
+                return
+
+            (record, index) = _decode_json_object(decoder, buffer, index, eof)
+            if record is not None:
+                yield record
+                continue
+
+        if eof:
+            raise ValueError("Unexpected end of the JSON file")
+
+        (data, eof) = next(pieces)
+        buffer = buffer[index:] + data
+        index = 0
+
+
+def bulk_update_values(queryset, field, values):
+    """
+    Sets the field of the rows of the queryset to the values
+    of a `{pk: value}` dict, with an UPDATE per batch of rows.
+    """
+    pks = list(values)
+
+    for start in range(0, len(pks), UPDATE_BATCH_SIZE):
+        batch = pks[start:start + UPDATE_BATCH_SIZE]
+        queryset.filter(pk__in=batch).update(**{
+            field.name: Case(
+                *[When(pk=pk, then=Value(values[pk], output_field=field)) for pk in batch],
+                output_field=field
+            )
+        })
+
+
+def _parse_id(value, name):
+    try:
+        parsed_value = int(value)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid %s: %r" % (name, value))
+    if parsed_value <= 0:
+        raise ValueError("Invalid %s: %r" % (name, value))
+    return parsed_value
+
+
+def _clean_field(field, value):
+    try:
+        return field.clean(value, None)
+    except ValidationError as error:
+        raise ValueError("%s: %s" % (field.name, " ".join(error.messages)))
+
+
+def _parse_decimal(value, name):
+    try:
+        parsed_value = Decimal(force_text(value).strip())
+    except (InvalidOperation, ValueError):
+        raise ValueError("Invalid %s: %r" % (name, value))
+    # NaN can't be compared and infinities can't be stored
+    if not parsed_value.is_finite():
+        raise ValueError("Invalid %s: %r" % (name, value))
+    return parsed_value
+
+
+def _parse_decimal_field(field, value, name):
+    """
+    Returns the value rounded to the decimal places of the field,
+    as the database stores it, and cleaned by the field.
+    """
+    parsed_value = _parse_decimal(value, name)
+    try:
+        parsed_value = parsed_value.quantize(Decimal(1).scaleb(-field.decimal_places),
+                                             context=Context(prec=field.max_digits))
+    except InvalidOperation:
+        # more digits than the field allows
+        raise ValueError("Invalid %s: %r" % (name, value))
+    return _clean_field(field, parsed_value)
+
+
+def _parse_integer(value, name):
+    parsed_value = _parse_decimal(value, name)
+    # reject fractions instead of truncating them
+    if parsed_value != parsed_value.to_integral_value():
+        raise ValueError("Invalid %s: %r" % (name, value))
+    return int(parsed_value)
+
+
+class TableItemImporter(object):
+    """
+    Imports rows of items into a shipping table.
+
+    Rows are validated and written in chunks with `bulk_create`,
+    all of them in a single transaction: if any row is invalid,
+    the errors are reported and nothing is written.
+    """
+
+    def __init__(self, table, replace=False, chunk_size=5000, max_errors=100, progress=None):
+        """
+        :param replace: whether to delete the current items of the table first
+        :param max_errors: number of errors after which the import stops
+        :param progress: a function called after each chunk with the
+                         number of rows read and of items created so far
+        """
+        self.table = table
+        self.replace = replace
+        self.chunk_size = chunk_size
+        self.max_errors = max_errors
+        self.progress = progress
+        self._region_ids = None
+        self._region_names = None
+
+    def load_regions(self):
+        """
+        Loads the ids and the (case insensitive) names of all the regions at once.
+        """
+        self._region_ids = set(ShippingRegion.objects.non_polymorphic().values_list("pk", flat=True))
+        self._region_names = {}
+
+        translation_model = ShippingRegion._parler_meta.root_model
+        for (region_id, name) in translation_model.objects.values_list("master_id", "name").distinct():
+            key = name.strip().lower()
+            if self._region_names.get(key, region_id) != region_id:
+                self._region_names[key] = AMBIGUOUS
+            else:
+                self._region_names[key] = region_id
+
+    def get_region_id(self, value):
+        value = force_text(value if value is not None else "").strip()
+        if not value:
+            raise ValueError("Missing region")
+
+        if value.isdigit() and int(value) in self._region_ids:
+            return int(value)
+
+        region_id = self._region_names.get(value.lower())
+        if region_id is AMBIGUOUS:
+            raise ValueError("More than one region is named %r, use the region id" % value)
+        if region_id is None:
+            raise ValueError("Unknown region: %r" % value)
+        return region_id
+
+    def parse_row(self, values):
+        """
+        Returns an unsaved item with the values of the row,
+        or raises a ValueError when they are not valid.
+        """
+        opts = ShippingTableItem._meta
+        start_weight = _parse_decimal_field(opts.get_field("start_weight"), values["start_weight"], "start weight")
+        end_weight = _parse_decimal_field(opts.get_field("end_weight"), values["end_weight"], "end weight")
+        price = _parse_decimal_field(opts.get_field("price"), values["price"], "price")
+        delivery_time = _parse_integer(values["delivery_time"], "delivery time")
+
+        if start_weight < 0 or start_weight > end_weight:
+            raise ValueError("Invalid weight range: %s - %s" % (start_weight, end_weight))
+        if price < 0:
+            raise ValueError("Invalid price: %s" % price)
+        if not (0 <= delivery_time <= 32767):
+            raise ValueError("Invalid delivery time: %s" % delivery_time)
+
+        return ShippingTableItem(table_id=self.table.pk,
+                                 region_id=self.get_region_id(values["region"]),
+                                 start_weight=start_weight,
+                                 end_weight=end_weight,
+                                 price=price,
+                                 delivery_time=delivery_time)
+
+    def delete_items(self):
+        # a plain delete, the queryset delete would send
+        # a signal (and bump the generations) per item
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM %s WHERE %s = %%s" % (
+                connection.ops.quote_name(ShippingTableItem._meta.db_table),
+                connection.ops.quote_name(ShippingTableItem._meta.get_field("table").column)
+            ), [self.table.pk])
+            return cursor.rowcount
+
+    def get_columns(self, header):
+        """
+        Returns the index of each of the `TABLE_ITEM_COLUMNS` in the header row.
+        """
+        header = [force_text(name or "").lstrip("\ufeff").strip().lower() for name in header]
+        missing_columns = [name for name in TABLE_ITEM_COLUMNS if name not in header]
+        if missing_columns:
+            raise ValueError("Missing columns: %s" % ", ".join(missing_columns))
+
+        return dict((name, header.index(name)) for name in TABLE_ITEM_COLUMNS)
+
+    def iter_row_values(self, rows, columns):
+        """
+        Yields the line number and the values by column of the rows which aren't empty.
+        """
+        for (line, row) in enumerate(rows, 2):
+            if not any(value not in (None, "") for value in row):
+                continue
+
+            yield (line, dict((name, row[index] if index < len(row) else None)
+                              for (name, index) in columns.items()))
+
+    def import_rows(self, rows):
+        """
+        Imports the rows, the first one being the header.
+
+        :param rows: an iterable of lists of values, e.g. from `read_rows`
+        :rtype: TableItemImportResult
+        """
+        rows = iter(rows)
+        header = next(rows, [])
+        try:
+            columns = self.get_columns(header)
+        except ValueError as error:
+            return TableItemImportResult(0, 0, [RowError(1, force_text(error))])
+
+        self.load_regions()
+        errors = []
+
+        with transaction.atomic():
+            deleted = (self.delete_items() if self.replace else 0)
+            created = self._create_items(self.iter_row_values(rows, columns), errors)
+
+            if errors:
+                transaction.set_rollback(True)
+                return TableItemImportResult(0, 0, errors)
+
+            # bulk writes don't send signals
+            bump_table_generation(self.table.pk)
+
+        return TableItemImportResult(created, deleted, errors)
+
+    def _create_items(self, row_values, errors):
+        """
+        Creates the items of the rows in chunks and returns how many were created.
+
+        The errors of the rows are appended to `errors`.
+        """
+        created = read = 0
+        chunk = []
+
+        for (line, values) in row_values:
+            read += 1
+            try:
+                chunk.append(self.parse_row(values))
+            except ValueError as error:
+                errors.append(RowError(line, force_text(error)))
+                if len(errors) >= self.max_errors:
+                    break
+
+            if len(chunk) >= self.chunk_size:
+                created += self._write_chunk(chunk, errors)
+                chunk = []
+                if self.progress:
+                    self.progress(read, created)
+
+        created += self._write_chunk(chunk, errors)
+        if self.progress:
+            self.progress(read, created)
+        return created
+
+    def _write_chunk(self, chunk, errors):
+        # keep validating after an error, to report all of them, but stop writing
+        if errors or not chunk:
+            return 0
+
+        ShippingTableItem.objects.bulk_create(chunk)
+        return len(chunk)
+
+    def import_file(self, file, file_format):
+        return self.import_rows(read_rows(file, file_format))
+
+
+class TableItemSynchronizer(TableItemImporter):
+    """
+    Synchronizes the items of a table with the rows of a file.
+
+    Rows are matched to the items of the table by region and weight range:
+    new rows are created, the items whose price or delivery time changed
+    are updated, and the items without a row are deleted. The other items
+    are kept as they are, so syncing a file without changes writes nothing
+    and keeps the cached lookups of the table.
+    """
+
+    def __init__(self, table, max_errors=100, progress=None):
+        super(TableItemSynchronizer, self).__init__(table, max_errors=max_errors, progress=progress)
+
+    def load_items(self):
+        """
+        Returns the current items of the table by `(region_id, start_weight, end_weight)`,
+        as `(pk, price, delivery_time)`, and the ids of the items with repeated keys.
+        """
+        items = {}
+        repeated_ids = []
+
+        for (pk, region_id, start_weight, end_weight, price, delivery_time) in ShippingTableItem.objects.filter(
+                table=self.table).order_by("pk").values_list(
+                "pk", "region_id", "start_weight", "end_weight", "price", "delivery_time"):
+            key = (region_id, start_weight, end_weight)
+            if key in items:
+                repeated_ids.append(pk)
+            else:
+                items[key] = (pk, price, delivery_time)
+
+        return (items, repeated_ids)
+
+    def delete_item_ids(self, item_ids):
+        # a plain delete, for the same reason as `delete_items`
+        for start in range(0, len(item_ids), UPDATE_BATCH_SIZE):
+            batch = item_ids[start:start + UPDATE_BATCH_SIZE]
+            with connection.cursor() as cursor:
+                cursor.execute("DELETE FROM %s WHERE %s IN (%s)" % (
+                    connection.ops.quote_name(ShippingTableItem._meta.db_table),
+                    connection.ops.quote_name(ShippingTableItem._meta.pk.column),
+                    ", ".join(["%s"] * len(batch))
+                ), batch)
+
+    def import_rows(self, rows):
+        """
+        Synchronizes the items with the rows, the first one being the header.
+
+        :param rows: an iterable of lists of values, e.g. from `read_rows`
+        :rtype: TableItemSyncResult
+        """
+        rows = iter(rows)
+        header = next(rows, [])
+        try:
+            columns = self.get_columns(header)
+        except ValueError as error:
+            return TableItemSyncResult(0, 0, 0, 0, [RowError(1, force_text(error))])
+
+        self.load_regions()
+        errors = []
+
+        items = self.iter_items(self.iter_row_values(rows, columns), errors)
+        (new_items, updates, deleted_ids, unchanged) = self.diff_items(items)
+        if errors:
+            return TableItemSyncResult(0, 0, 0, 0, errors)
+
+        updated = len(set(updates["price"]) | set(updates["delivery_time"]))
+        if new_items or updated or deleted_ids:
+            self.apply_changes(new_items, updates, deleted_ids)
+
+        if self.progress:
+            self.progress(len(new_items) + updated + unchanged, len(new_items) + updated)
+
+        return TableItemSyncResult(len(new_items), updated, len(deleted_ids), unchanged, errors)
+
+    def iter_items(self, row_values, errors):
+        """
+        Yields the unsaved items of the valid rows.
+
+        The errors of the rows, including repeated regions and weight
+        ranges, are appended to `errors` until there are `max_errors`.
+        """
+        lines = {}
+
+        for (line, values) in row_values:
+            try:
+                item = self.parse_row(values)
+                key = (item.region_id, item.start_weight, item.end_weight)
+                if key in lines:
+                    raise ValueError("Repeated region and weight range, also on line %d" % lines[key])
+            except ValueError as error:
+                errors.append(RowError(line, force_text(error)))
+                if len(errors) >= self.max_errors:
+                    return
+                continue
+
+            lines[key] = line
+            yield item
+
+    def diff_items(self, items):
+        """
+        Compares the items with the current items of the table.
+
+        :return: the new items, the changed values by field and item id,
+                 the ids of the items to delete and the number of unchanged items
+        """
+        (current_items, deleted_ids) = self.load_items()
+        new_items = []
+        updates = {"price": {}, "delivery_time": {}}
+        unchanged = 0
+
+        for item in items:
+            current = current_items.pop((item.region_id, item.start_weight, item.end_weight), None)
+            if current is None:
+                new_items.append(item)
+                continue
+
+            (pk, price, delivery_time) = current
+            if item.price == price and item.delivery_time == delivery_time:
+                unchanged += 1
+                continue
+
+            if item.price != price:
+                updates["price"][pk] = item.price
+            if item.delivery_time != delivery_time:
+                updates["delivery_time"][pk] = item.delivery_time
+
+        deleted_ids.extend(pk for (pk, price, delivery_time) in current_items.values())
+        return (new_items, updates, deleted_ids, unchanged)
+
+    def apply_changes(self, new_items, updates, deleted_ids):
+        """
+        Writes the changes found by `diff_items` in a single transaction.
+        """
+        with transaction.atomic():
+            self.delete_item_ids(deleted_ids)
+            ShippingTableItem.objects.bulk_create(new_items)
+            for (field_name, field_values) in updates.items():
+                if field_values:
+                    bulk_update_values(ShippingTableItem.objects.all(),
+                                       ShippingTableItem._meta.get_field(field_name),
+                                       field_values)
+
+            # bulk writes don't send signals
+            bump_table_generation(self.table.pk)
+
+
+def get_region_fields(model):
+    """
+    Returns the fields of the table of the concrete region model,
+    apart from the link to the base region.
+    """
+    if model is ShippingRegion:
+        return []
+    return [field for field in model._meta.local_concrete_fields if not field.primary_key]
+
+
+class RegionImporter(object):
+    """
+    Imports regions and their translations from a region export.
+
+    Regions are matched by id: the new ones are created and the others
+    are updated where their values differ. Records are validated and
+    written in chunks, with a few bulk queries per region type, all of
+    them in a single transaction: if any record is invalid, the errors
+    are reported and nothing is written.
+    """
+
+    def __init__(self, chunk_size=500, max_errors=100, progress=None):
+        """
+        :param max_errors: number of errors after which the import stops
+        :param progress: a function called after each chunk with the
+                         number of records read and of regions written so far
+        """
+        self.chunk_size = chunk_size
+        self.max_errors = max_errors
+        self.progress = progress
+        self.translation_model = ShippingRegion._parler_meta.root_model
+        self._region_models = None
+        self._created = set()
+        self._updated = set()
+        self._seen = set()
+
+    def load_regions(self):
+        """
+        Loads the models of all the current regions at once.
+        """
+        self._region_models = dict(
+            (region_id, ContentType.objects.get_for_id(ctype_id).model_class())
+            for (region_id, ctype_id) in ShippingRegion.objects.non_polymorphic().values_list(
+                "pk", "polymorphic_ctype_id"
+            )
+        )
+
+    def parse_record(self, record):
+        """
+        Returns the model, the id and the fields of a record.
+        """
+        if not isinstance(record, dict) or not isinstance(record.get("fields"), dict):
+            raise ValueError("Invalid record")
+
+        try:
+            model = apps.get_model(record.get("model") or "")
+        except (LookupError, ValueError):
+            raise ValueError("Unknown model: %r" % record.get("model"))
+
+        if model is self.translation_model:
+            return (model, None, record["fields"])
+        if not issubclass(model, ShippingRegion):
+            raise ValueError("Not a region: %r" % record.get("model"))
+        return (model, _parse_id(record.get("pk"), "region id"), record["fields"])
+
+    def get_type_model(self, fields):
+        # the model of the polymorphic content type of a base region record
+        ctype = fields.get("polymorphic_ctype")
+        if ctype is None:
+            return None
+
+        try:
+            if isinstance(ctype, (list, tuple)):
+                content_type = ContentType.objects.get_by_natural_key(*ctype)
+            else:
+                content_type = ContentType.objects.get_for_id(ctype)
+        except (ContentType.DoesNotExist, TypeError, ValueError):
+            raise ValueError("Unknown region type: %r" % (ctype,))
+
+        model = content_type.model_class()
+        if model is None or not issubclass(model, ShippingRegion):
+            raise ValueError("Unknown region type: %r" % (ctype,))
+        return model
+
+    def clean_region(self, region_id, region):
+        """
+        Returns the model of the region and the clean values of its fields.
+        New regions get the defaults of the missing fields, while existing
+        regions keep their current values.
+        """
+        current_model = self._region_models.get(region_id)
+        model = region["model"] or self.get_type_model(region["base"]) or current_model
+        if model is None:
+            raise ValueError("Missing the type of region %d" % region_id)
+        if current_model is not None and current_model is not model:
+            raise ValueError("Region %d is a %s, not a %s" % (
+                region_id, current_model._meta.model_name, model._meta.model_name
+            ))
+
+        values = {}
+        fields = [(ShippingRegion._meta.get_field("priority"), region["base"])]
+        fields += [(field, region["fields"]) for field in get_region_fields(model)]
+
+        for (field, record_fields) in fields:
+            if field.name in record_fields:
+                values[field.name] = _clean_field(field, record_fields[field.name])
+            elif current_model is None:
+                values[field.name] = _clean_field(field, field.get_default())
+
+        return (model, values)
+
+    def clean_translation(self, fields):
+        """
+        Returns the region id, the language and the clean values of a translation.
+        """
+        region_id = _parse_id(fields.get("master"), "region id")
+        if region_id not in self._region_models:
+            raise ValueError("Unknown region: %d" % region_id)
+
+        values = {}
+        for name in ("language_code", "name", "description"):
+            field = self.translation_model._meta.get_field(name)
+            values[name] = _clean_field(field, fields.get(name, field.get_default()))
+
+        return (region_id, values.pop("language_code"), values)
+
+    def import_records(self, records):
+        """
+        Imports the records, e.g. from `iter_json_records`.
+
+        :rtype: RegionImportResult
+        """
+        self.load_regions()
+        self._created, self._updated, self._seen = set(), set(), set()
+        errors = []
+
+        with transaction.atomic():
+            self._import_chunks(records, errors)
+
+            if errors:
+                transaction.set_rollback(True)
+                return RegionImportResult(0, 0, 0, errors)
+
+            if self._created:
+                self.reset_sequence()
+
+            if self._created or self._updated:
+                # bulk writes don't send signals
+                bump_generation_on_commit()
+
+        return RegionImportResult(
+            len(self._created),
+            len(self._updated),
+            len(self._seen - self._created - self._updated),
+            errors
+        )
+
+    def _iter_records(self, records, errors):
+        """
+        Yields the number and the contents of each record until
+        `max_errors` errors are reported or the JSON is invalid.
+        """
+        records = iter(records)
+        read = 0
+
+        while len(errors) < self.max_errors:
+            try:
+                record = next(records)
+            except StopIteration:
+                return
+            except ValueError as error:
+                errors.append(RecordError(read + 1, "Invalid JSON: %s" % force_text(error)))
+                return
+
+            read += 1
+            yield (read, record)
+
+    def _import_chunks(self, records, errors):
+        regions = OrderedDict()
+        translations = []
+        read = 0
+
+        for (read, record) in self._iter_records(records, errors):
+            try:
+                (model, region_id, fields) = self.parse_record(record)
+            except ValueError as error:
+                errors.append(RecordError(read, force_text(error)))
+                continue
+
+            # don't split the records of a region between chunks
+            if (len(regions) + len(translations) >= self.chunk_size and
+                    (region_id is None or region_id not in regions)):
+                self._import_chunk(regions, translations, errors)
+                regions.clear()
+                del translations[:]
+                self._report_progress(read - 1)
+
+            if region_id is None:
+                self._add_translation_record(translations, read, fields)
+            elif model is ShippingRegion:
+                self._add_base_record(regions, read, region_id, fields)
+            else:
+                self._add_concrete_record(regions, read, region_id, model, fields)
+
+        self._import_chunk(regions, translations, errors)
+        self._report_progress(read)
+
+    def _get_chunk_region(self, regions, record, region_id):
+        return regions.setdefault(region_id, {"record": record, "model": None, "base": {}, "fields": {}})
+
+    def _add_base_record(self, regions, record, region_id, fields):
+        # the fields of the `ShippingRegion` table
+        self._get_chunk_region(regions, record, region_id)["base"] = fields
+
+    def _add_concrete_record(self, regions, record, region_id, model, fields):
+        # the fields of the table of the region type
+        region = self._get_chunk_region(regions, record, region_id)
+        region["model"] = model
+        region["fields"] = fields
+
+    def _add_translation_record(self, translations, record, fields):
+        translations.append((record, fields))
+
+    def _report_progress(self, read):
+        if self.progress:
+            self.progress(read, len(self._created) + len(self._updated))
+
+    def _import_chunk(self, regions, translations, errors):
+        new_regions = []
+        changed_regions = []
+
+        for (region_id, region) in regions.items():
+            try:
+                (model, values) = self.clean_region(region_id, region)
+            except ValueError as error:
+                errors.append(RecordError(region["record"], force_text(error)))
+                continue
+
+            self._seen.add(region_id)
+            if region_id in self._region_models:
+                changed_regions.append((region_id, model, values))
+            else:
+                new_regions.append((region_id, model, values))
+                self._region_models[region_id] = model
+
+        clean_translations = []
+        for (record, fields) in translations:
+            try:
+                clean_translations.append(self.clean_translation(fields))
+            except ValueError as error:
+                errors.append(RecordError(record, force_text(error)))
+
+        # keep validating after an error, to report all of them, but stop writing
+        if errors:
+            return
+
+        self.create_regions(new_regions)
+        self.update_regions(changed_regions)
+        self.write_translations(clean_translations)
+
+    def create_regions(self, new_regions):
+        ShippingRegion.objects.non_polymorphic().bulk_create([
+            ShippingRegion(pk=region_id,
+                           priority=values["priority"],
+                           polymorphic_ctype=ContentType.objects.get_for_model(model, for_concrete_model=False))
+            for (region_id, model, values) in new_regions
+        ])
+
+        regions_by_model = OrderedDict()
+        for (region_id, model, values) in new_regions:
+            regions_by_model.setdefault(model, []).append((region_id, values))
+            self._created.add(region_id)
+
+        for (model, model_regions) in regions_by_model.items():
+            self._insert_region_rows(model, model_regions)
+
+    def _insert_region_rows(self, model, model_regions):
+        # bulk_create can't write models with multi-table inheritance,
+        # so the rows of the tables of the region types are inserted directly
+        if model is ShippingRegion:
+            return
+
+        fields = get_region_fields(model)
+        columns = [model._meta.pk.column] + [field.column for field in fields]
+        sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+            connection.ops.quote_name(model._meta.db_table),
+            ", ".join(connection.ops.quote_name(column) for column in columns),
+            ", ".join(["%s"] * len(columns))
+        )
+
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, [
+                [region_id] + [field.get_db_prep_save(values[field.name], connection) for field in fields]
+                for (region_id, values) in model_regions
+            ])
+
+    def update_regions(self, changed_regions):
+        """
+        Updates the values of the existing regions which differ from the current ones.
+        """
+        regions_by_model = OrderedDict()
+        for (region_id, model, values) in changed_regions:
+            regions_by_model.setdefault(model, {})[region_id] = values
+
+        for (model, model_regions) in regions_by_model.items():
+            fields = [ShippingRegion._meta.get_field("priority")] + get_region_fields(model)
+            current_rows = model.objects.non_polymorphic().filter(pk__in=list(model_regions)).values(
+                "pk", *[field.name for field in fields]
+            )
+
+            updates = dict((field, {}) for field in fields)
+            for current_values in current_rows:
+                values = model_regions[current_values["pk"]]
+                for field in fields:
+                    if field.name not in values:
+                        continue
+                    if field.get_prep_value(values[field.name]) != field.get_prep_value(current_values[field.name]):
+                        updates[field][current_values["pk"]] = values[field.name]
+                        self._updated.add(current_values["pk"])
+
+            for (field, field_values) in updates.items():
+                if field_values:
+                    # the table of the model which declares the field
+                    bulk_update_values(field.model.objects.non_polymorphic(), field, field_values)
+
+    def write_translations(self, translations):
+        """
+        Creates the new translations and updates the ones which differ.
+        """
+        if not translations:
+            return
+
+        current_translations = dict(
+            ((region_id, language_code), (pk, name, description))
+            for (pk, region_id, language_code, name, description) in self.translation_model.objects.filter(
+                master_id__in=set(region_id for (region_id, language_code, values) in translations)
+            ).values_list("pk", "master_id", "language_code", "name", "description")
+        )
+
+        new_translations = OrderedDict()
+        updates = {"name": {}, "description": {}}
+
+        for (region_id, language_code, values) in translations:
+            current = current_translations.get((region_id, language_code))
+            if current is None:
+                new_translations[(region_id, language_code)] = self.translation_model(
+                    master_id=region_id, language_code=language_code, **values
+                )
+                continue
+
+            (pk, name, description) = current
+            for (field_name, current_value) in (("name", name), ("description", description)):
+                if values[field_name] != current_value:
+                    updates[field_name][pk] = values[field_name]
+                    self._mark_updated(region_id)
+
+        self.translation_model.objects.bulk_create(list(new_translations.values()))
+        for (region_id, language_code) in new_translations:
+            self._mark_updated(region_id)
+
+        for (field_name, field_values) in updates.items():
+            if field_values:
+                bulk_update_values(self.translation_model.objects.all(),
+                                   self.translation_model._meta.get_field(field_name),
+                                   field_values)
+
+    def _mark_updated(self, region_id):
+        if region_id not in self._created:
+            self._updated.add(region_id)
+
+    def reset_sequence(self):
+        # regions were created with explicit ids, which the
+        # sequences of some databases don't know about
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [ShippingRegion]):
+                cursor.execute(sql)
+
+    def import_file(self, file):
+        return self.import_records(iter_json_records(file))
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Shipping Table
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+from bisect import bisect_right
+
+
+class IntervalIndex(object):
+    """
+    A static index of closed intervals `[start, end]` queried by point.
+
+    Intervals are sorted by start and augmented with the running max of
+    the ends, so a query is a bisect on the starts followed by a backwards
+    scan which stops as soon as no earlier interval can reach the point.
+    """
+
+    def __init__(self, intervals):
+        """
+        :param intervals: iterable of `(start, end, value)` tuples
+        """
+        intervals = sorted(intervals, key=lambda interval: interval[0])
+
+        self.starts = [interval[0] for interval in intervals]
+        self.ends = [interval[1] for interval in intervals]
+        self.values = [interval[2] for interval in intervals]
+        self.max_ends = []
+
+        max_end = None
+        for end in self.ends:
+            if max_end is None or end > max_end:
+                max_end = end
+            self.max_ends.append(max_end)
+
+    def __len__(self):
+        return len(self.values)
+
+    def find(self, point):
+        """
+        Returns the values of all intervals that contain the point,
+        in ascending start order.
+        """
+        matches = []
+        index = bisect_right(self.starts, point) - 1
+
+        while index >= 0 and self.max_ends[index] >= point:
+            if self.ends[index] >= point:
+                matches.append(self.values[index])
+            index -= 1
+
+        matches.reverse()
+        return matches
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Shipping Table
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+from shuup_shipping_table.snapshot import write_snapshot
+from shuup_shipping_table.utils import get_setting
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shuup.core.models import Shop
+
+
+class Command(BaseCommand):
+    help = "Compiles the shipping table rate snapshots of the shops."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--shop", action="append", type=int, dest="shops",
+                            help="Id of a shop to compile (default: all the shops)")
+        parser.add_argument("--directory", dest="directory",
+                            help="Output directory (default: SHIPPING_TABLE_SNAPSHOT_DIR)")
+
+    def handle(self, *args, **options):
+        directory = options.get("directory") or get_setting("SHIPPING_TABLE_SNAPSHOT_DIR")
+        if not directory:
+            raise CommandError("Set SHIPPING_TABLE_SNAPSHOT_DIR or pass --directory.")
+
+        shops = Shop.objects.all()
+        if options.get("shops"):
+            shops = shops.filter(pk__in=options["shops"])
+
+        for shop in shops:
+            path = write_snapshot(shop, directory)
+            self.stdout.write("Wrote %s" % path)
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Shipping Table
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+import sys
+
+from shuup_shipping_table.exporter import EXPORT_FORMATS, export_table
+from shuup_shipping_table.models import ShippingTable
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = "Exports a shipping table and its items to CSV or JSONL."
+
+    def add_arguments(self, parser):
+        parser.add_argument("table", help="Identifier of the shipping table")
+        parser.add_argument("--format", dest="format", choices=EXPORT_FORMATS, default="csv",
+                            help="Export format (default: csv)")
+        parser.add_argument("--gzip", action="store_true", dest="gzip", default=False,
+                            help="Compress the export with gzip")
+        parser.add_argument("--output", dest="output", default="-",
+                            help="Output file path (default: the standard output)")
+
+    def handle(self, *args, **options):
+        try:
+            table = ShippingTable.objects.get(identifier=options["table"])
+        except ShippingTable.DoesNotExist:
+            raise CommandError("Shipping table %s does not exist." % options["table"])
+
+        chunks = export_table(table, options["format"], options["gzip"])
+
+        if options["output"] == "-":
+            output = getattr(sys.stdout, "buffer", sys.stdout)
+            for chunk in chunks:
+                output.write(chunk)
+            output.flush()
+        else:
+            with open(options["output"], "wb") as output:
+                for chunk in chunks:
+                    output.write(chunk)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Shipping Table
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+import os
+
+from shuup_shipping_table.importer import InvalidFileError, TableItemImporter, TableItemSynchronizer
+from shuup_shipping_table.models import ShippingTable
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.encoding import force_text
+
+
+class Command(BaseCommand):
+    help = "Imports the items of a shipping table from a CSV or XLSX file."
+
+    def add_arguments(self, parser):
+        parser.add_argument("table", help="Identifier of the shipping table")
+        parser.add_argument("file", help="Path of the CSV or XLSX file")
+        parser.add_argument("--format", dest="format", choices=("csv", "xlsx"),
+                            help="File format (default: from the file extension)")
+        parser.add_argument("--replace", action="store_true", dest="replace", default=False,
+                            help="Delete the current items of the table first")
+        parser.add_argument("--sync", action="store_true", dest="sync", default=False,
+                            help="Update the current items of the table to match the file, "
+                                 "matching them by region and weight range")
+        parser.add_argument("--chunk-size", type=int, dest="chunk_size", default=5000,
+                            help="Number of rows validated and written at once")
+
+    def get_importer(self, table, options):
+        if options["sync"] and options["replace"]:
+            raise CommandError("Use either --sync or --replace.")
+
+        def progress(read, written):
+            self.stdout.write("%d rows read, %d items written" % (read, written))
+
+        if options["sync"]:
+            return TableItemSynchronizer(table, progress=progress)
+
+        return TableItemImporter(table,
+                                 replace=options["replace"],
+                                 chunk_size=options["chunk_size"],
+                                 progress=progress)
+
+    def handle(self, *args, **options):
+        try:
+            table = ShippingTable.objects.get(identifier=options["table"])
+        except ShippingTable.DoesNotExist:
+            raise CommandError("Shipping table %s does not exist." % options["table"])
+
+        file_format = options.get("format") or os.path.splitext(options["file"])[1].lstrip(".").lower()
+        if file_format not in ("csv", "xlsx"):
+            raise CommandError("Unknown file format, use --format.")
+
+        importer = self.get_importer(table, options)
+
+        with open(options["file"], "rb") as items_file:
+            try:
+                result = importer.import_file(items_file, file_format)
+            except InvalidFileError as error:
+                raise CommandError(force_text(error))
+
+        if result.errors:
+            for error in result.errors:
+                self.stderr.write("Line %d: %s" % (error.line, error.message))
+            raise CommandError("No items imported, fix the errors above.")
+
+        if options["sync"]:
+            self.stdout.write("Synchronized items: %d created, %d updated, %d deleted, %d unchanged." % (
+                result.created, result.updated, result.deleted, result.unchanged
+            ))
+        else:
+            self.stdout.write("Imported %d items (%d deleted)." % (result.created, result.deleted))
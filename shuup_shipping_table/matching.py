@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Shipping Table
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+from shuup_shipping_table.cache import get_generation
+from shuup_shipping_table.intervals import IntervalIndex
+from shuup_shipping_table.models import (
+    ADDRESS_REGION_ATTRS, address_matches, AddressShippingRegion, compile_address_matchers,
+    CountryShippingRegion, PostalCodeRangeShippingRegion, ShippingRegion
+)
+from shuup_shipping_table.utils import parse_postal_code
+
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
+from django.utils.encoding import force_text
+
+# region types which can be matched in the database
+DATABASE_REGION_TYPES = (PostalCodeRangeShippingRegion, CountryShippingRegion, AddressShippingRegion)
+
+# compiled region indexes of this process
+_region_indexes = {}
+
+
+class PostalCodeRangeIndex(object):
+    """
+    Interval indexes of the postal code range regions, by country.
+
+    Finding the regions which contain a postal code is a bisect
+    plus a scan of the matches, instead of testing every region.
+    """
+
+    def __init__(self, regions, generation=None):
+        """
+        :param regions: iterable of `(id, country, start_postal_code, end_postal_code)` tuples
+        """
+        self.generation = generation
+
+        ranges_by_country = defaultdict(list)
+        for (region_id, country, start_postal_code, end_postal_code) in regions:
+            ranges_by_country[force_text(country)].append((start_postal_code, end_postal_code, region_id))
+
+        self.indexes = dict(
+            (country, IntervalIndex(ranges))
+            for (country, ranges) in ranges_by_country.items()
+        )
+
+    def find(self, country, postal_code):
+        """
+        Returns the ids of the regions of the country which contain the parsed postal code.
+        """
+        index = self.indexes.get(force_text(country))
+        if index is None or postal_code is None:
+            return []
+        return index.find(postal_code)
+
+
+def get_postal_code_index():
+    """
+    Returns the postal code range index, rebuilding it when regions change.
+    """
+    generation = get_generation()
+    postal_code_index = _region_indexes.get("postal_code")
+
+    if postal_code_index is None or postal_code_index.generation != generation:
+        postal_code_index = PostalCodeRangeIndex(
+            PostalCodeRangeShippingRegion.objects.values_list(
+                "pk", "country", "start_postal_code", "end_postal_code"
+            ),
+            generation
+        )
+        _region_indexes["postal_code"] = postal_code_index
+
+    return postal_code_index
+
+
+class AddressRegionIndex(object):
+    """
+    Compiled matchers of the address regions with an inverted
+    index from `(country, city)` to the region ids.
+
+    Regions without cities are indexed with a `None` city,
+    so they are candidates for every address of the country.
+    """
+
+    def __init__(self, regions, generation=None):
+        """
+        :param regions: iterable of `(id, country) + ADDRESS_REGION_ATTRS` value tuples
+        """
+        self.generation = generation
+        self.matchers = {}
+        self.region_ids = defaultdict(list)
+
+        for region in regions:
+            region_id, country, values = region[0], force_text(region[1]), region[2:]
+            matchers = compile_address_matchers(values)
+            self.matchers[region_id] = matchers
+
+            cities = dict(matchers).get("city")
+            for city in (cities or [None]):
+                self.region_ids[(country, city)].append(region_id)
+
+    def find(self, address):
+        """
+        Returns the ids of the regions which match the address.
+        """
+        country = force_text(address.country)
+        city = (address.city or "").upper().strip()
+
+        return [
+            region_id
+            for region_id in self.region_ids.get((country, city), []) + self.region_ids.get((country, None), [])
+            if address_matches(self.matchers[region_id], address)
+        ]
+
+
+def get_address_index():
+    """
+    Returns the address region index, rebuilding it when regions change.
+    """
+    generation = get_generation()
+    address_index = _region_indexes.get("address")
+
+    if address_index is None or address_index.generation != generation:
+        address_index = AddressRegionIndex(
+            AddressShippingRegion.objects.values_list("pk", "country", *ADDRESS_REGION_ATTRS),
+            generation
+        )
+        _region_indexes["address"] = address_index
+
+    return address_index
+
+
+def has_custom_regions():
+    """
+    Returns whether there are regions of other types than the
+    `DATABASE_REGION_TYPES`, which can only be matched in Python.
+    """
+    generation = get_generation()
+    custom_regions = _region_indexes.get("custom_regions")
+
+    if custom_regions is None or custom_regions[0] != generation:
+        content_types = ContentType.objects.get_for_models(*DATABASE_REGION_TYPES, for_concrete_models=False)
+        custom_regions = (
+            generation,
+            ShippingRegion.objects.non_polymorphic().exclude(
+                polymorphic_ctype__in=list(content_types.values())
+            ).exists()
+        )
+        _region_indexes["custom_regions"] = custom_regions
+
+    return custom_regions[1]
+
+
+def get_region_match_q(address, prefix=""):
+    """
+    Returns a `Q` which matches the regions of the `DATABASE_REGION_TYPES`
+    compatible with the address, or None when no region can be.
+
+    Postal code ranges and countries are compared in SQL and the address
+    regions are matched by the compiled address index.
+
+    :param prefix: the lookup path to the regions, e.g. `region__`
+    """
+    if not address or not address.country:
+        return None
+
+    country = force_text(address.country)
+    region_q = Q(**{prefix + "countryshippingregion__country": country})
+
+    postal_code = parse_postal_code(address.postal_code) if address.postal_code else None
+    if postal_code is not None:
+        region_q |= Q(**{
+            prefix + "postalcoderangeshippingregion__country": country,
+            prefix + "postalcoderangeshippingregion__start_postal_code__lte": postal_code,
+            prefix + "postalcoderangeshippingregion__end_postal_code__gte": postal_code
+        })
+
+    address_region_ids = get_address_index().find(address)
+    if address_region_ids:
+        region_q |= Q(**{prefix + "pk__in": address_region_ids})
+
+    return region_q
+
+
+class QuoteSource(object):
+    """
+    A minimal source to match regions when there is only a shop and an address.
+    """
+
+    def __init__(self, shop, shipping_address):
+        self.shop = shop
+        self.shipping_address = shipping_address
+
+
+class RegionMatcher(object):
+    """
+    Checks whether regions are compatible with a source.
+
+    Results are memoized by region, and regions of the built-in types
+    are matched through the compiled region indexes. Any other region
+    falls back to its own `is_compatible_with`.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self._results = {}
+        self._postal_code_region_ids = None
+        self._address_region_ids = None
+
+    def is_compatible(self, region):
+        if region.pk is None:
+            # unsaved regions are neither in the indexes nor told apart by the memo
+            return region.is_compatible_with(self.source)
+
+        if region.pk not in self._results:
+            self._results[region.pk] = self._is_compatible(region)
+        return self._results[region.pk]
+
+    def _is_compatible(self, region):
+        # subclasses may override the matching, so check the exact type
+        if type(region) is PostalCodeRangeShippingRegion:
+            return region.pk in self.get_postal_code_region_ids()
+
+        if type(region) is AddressShippingRegion:
+            return region.pk in self.get_address_region_ids()
+
+        return region.is_compatible_with(self.source)
+
+    def get_postal_code_region_ids(self):
+        if self._postal_code_region_ids is None:
+            address = self.source.shipping_address
+            region_ids = []
+
+            if address and address.country:
+                region_ids = get_postal_code_index().find(address.country, parse_postal_code(address.postal_code))
+
+            self._postal_code_region_ids = set(region_ids)
+
+        return self._postal_code_region_ids
+
+    def get_address_region_ids(self):
+        if self._address_region_ids is None:
+            address = self.source.shipping_address
+            region_ids = []
+
+            if address and address.country:
+                region_ids = get_address_index().find(address)
+
+            self._address_region_ids = set(region_ids)
+
+        return self._address_region_ids
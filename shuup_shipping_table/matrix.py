@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Shipping Table
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Vectorized evaluation of shipping table rates for bulk estimates.
+
+This module requires NumPy, which is an optional dependency
+(install with `pip install shuup-shipping-table[matrix]`).
+"""
+from __future__ import unicode_literals
+
+from decimal import Decimal, ROUND_CEILING
+
+from shuup_shipping_table.matching import QuoteSource, RegionMatcher
+from shuup_shipping_table.models import ShippingTableItem
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+# most cells of the bands x items arrays built at once
+MAX_MATRIX_CELLS = 2 ** 20
+
+# weights and prices are stored as integers at the decimal places of
+# the item fields, so they are compared and returned exactly
+WEIGHT_PLACES = ShippingTableItem._meta.get_field("start_weight").decimal_places
+PRICE_PLACES = ShippingTableItem._meta.get_field("price").decimal_places
+
+
+def _scale(value, places):
+    return int(Decimal(value).scaleb(places))
+
+
+class RateMatrix(object):
+    """
+    The table items of a component stored as arrays.
+
+    The items are kept in the component preference order (region priority
+    and then the `FetchTableMode` ordering), so the item picked for an
+    address and a weight is the masked argmin of that order among the items
+    whose region matches the address and whose weight range contains the weight.
+
+    Weights are mapped with `searchsorted` into the bands delimited by the
+    distinct start and end weights, where the set of items containing a weight
+    does not change, so the winner is computed once per band and address.
+    Weights and prices are stored as integers scaled by their decimal places.
+    Only the weights between the `min_weight` and `max_weight` of the matrix
+    can be evaluated, as the items outside of them are not loaded.
+    """
+
+    def __init__(self, component, shop, min_weight, max_weight):
+        """
+        :param component: the shipping table behavior component which picks the items
+        :param min_weight: the lowest weight (in kg) that will be evaluated
+        :param max_weight: the highest weight (in kg) that will be evaluated
+        """
+        if np is None:
+            raise ImportError("NumPy is required to use the shipping table rate matrix.")
+
+        self.component = component
+        self.shop = shop
+        self.min_weight = min_weight
+        self.max_weight = max_weight
+        self.table_items = list(component.get_table_items(shop, min_weight, max_weight))
+
+        self.item_ids = np.array([item.pk for item in self.table_items], dtype=np.int64)
+        self.start_weights = np.array([_scale(item.start_weight, WEIGHT_PLACES) for item in self.table_items],
+                                      dtype=np.int64)
+        self.end_weights = np.array([_scale(item.end_weight, WEIGHT_PLACES) for item in self.table_items],
+                                    dtype=np.int64)
+        self.prices = np.array([_scale(item.price + component.add_price, PRICE_PLACES) for item in self.table_items],
+                               dtype=np.int64)
+        self.delivery_times = np.array(
+            [item.delivery_time + component.add_delivery_time_days for item in self.table_items], dtype=np.int64
+        )
+        self.ranks = np.arange(len(self.table_items), dtype=np.int64)
+        self.breakpoints = np.unique(np.concatenate([self.start_weights, self.end_weights]))
+
+        # each item contains the contiguous bands from the one of
+        # its start weight breakpoint to the one of its end weight
+        self.first_bands = np.searchsorted(self.breakpoints, self.start_weights) * 2 + 1
+        self.last_bands = np.searchsorted(self.breakpoints, self.end_weights) * 2 + 1
+
+    def get_address_mask(self, address):
+        """
+        Returns a boolean array of the items available for the address:
+        those whose region matches it and whose table does not exclude it.
+        """
+        region_matcher = RegionMatcher(QuoteSource(self.shop, address))
+        return np.array([
+            region_matcher.is_compatible(item.region) and not any(
+                region_matcher.is_compatible(excluded_region)
+                for excluded_region in item.table.get_excluded_regions()
+            )
+            for item in self.table_items
+        ], dtype=bool)
+
+    def get_weight_bands(self, weights):
+        """
+        Maps the weights into bands: band `2i + 1` is the breakpoint `i` itself
+        and band `2i` is the open interval between the breakpoints `i - 1` and `i`.
+        """
+        if not len(self.breakpoints):
+            return np.zeros(len(weights), dtype=np.int64)
+
+        # weights with more decimal places than the breakpoints are never on one,
+        # and their first breakpoint is the first one after their scaled ceiling
+        scaled_weights = [Decimal(weight).scaleb(WEIGHT_PLACES) for weight in weights]
+        ceilings = np.array([int(weight.to_integral_value(ROUND_CEILING)) for weight in scaled_weights],
+                            dtype=np.int64)
+        exact = np.array([weight == weight.to_integral_value() for weight in scaled_weights], dtype=bool)
+
+        positions = np.searchsorted(self.breakpoints, ceilings, side="left")
+        capped_positions = np.minimum(positions, len(self.breakpoints) - 1)
+        on_breakpoint = exact & (positions < len(self.breakpoints)) & (self.breakpoints[capped_positions] == ceilings)
+        return positions * 2 + on_breakpoint
+
+    def get_band_winners(self, mask):
+        """
+        Returns the index of the item picked for each weight band,
+        or -1 when no item is available.
+
+        The bands are compared with chunks of the items, so the memory
+        used stays bounded by `MAX_MATRIX_CELLS` for large tables.
+        """
+        bands = len(self.breakpoints) * 2 + 1
+        no_rank = len(self.table_items)
+        best = np.full(bands, no_rank, dtype=np.int64)
+
+        first_bands = self.first_bands[mask]
+        last_bands = self.last_bands[mask]
+        ranks = self.ranks[mask]
+        band_numbers = np.arange(bands, dtype=np.int64)[:, None]
+        chunk_size = max(1, MAX_MATRIX_CELLS // bands)
+
+        for start in range(0, len(ranks), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            contains = (first_bands[None, chunk] <= band_numbers) & (last_bands[None, chunk] >= band_numbers)
+            np.minimum(best, np.where(contains, ranks[None, chunk], no_rank).min(axis=1), out=best)
+
+        return np.where(best < no_rank, best, -1)
+
+    def evaluate(self, addresses, weights):
+        """
+        Evaluates every address and weight pair.
+
+        :param addresses: the addresses to evaluate, e.g. one per postal code bucket
+        :param weights: the weights (in kg) to evaluate
+        :return: three `len(addresses) x len(weights)` arrays: the table item ids,
+                 the prices (as `Decimal` objects) and the delivery times (in days) with
+                 the component extra price and days; -1 (None for the prices) when no item is available
+        :rtype: tuple[numpy.ndarray,numpy.ndarray,numpy.ndarray]
+        :raises ValueError: when some weight is outside of the weights of the matrix
+        """
+        outside_weights = [weight for weight in weights if not (self.min_weight <= weight <= self.max_weight)]
+        if outside_weights:
+            raise ValueError("Weights outside of the rate matrix weights (%s - %s): %s" % (
+                self.min_weight, self.max_weight, ", ".join(str(weight) for weight in outside_weights)
+            ))
+
+        weight_bands = self.get_weight_bands(weights)
+        winners = np.empty((len(addresses), len(weight_bands)), dtype=np.int64)
+
+        for row, address in enumerate(addresses):
+            winners[row] = self.get_band_winners(self.get_address_mask(address))[weight_bands]
+
+        found = winners >= 0
+        safe_winners = np.where(found, winners, 0)
+
+        prices = np.full(winners.shape, None, dtype=object)
+
+        if not len(self.table_items):
+            item_ids = np.full(winners.shape, -1, dtype=np.int64)
+            delivery_times = np.full(winners.shape, -1, dtype=np.int64)
+        else:
+            item_ids = np.where(found, self.item_ids[safe_winners], -1)
+            delivery_times = np.where(found, self.delivery_times[safe_winners], -1)
+            for (row, column) in zip(*np.nonzero(found)):
+                prices[row, column] = Decimal(int(self.prices[winners[row, column]])).scaleb(-PRICE_PLACES)
+
+        return (item_ids, prices, delivery_times)
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.10 on 2026-10-17 10:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shuup_shipping_table', '0002_cubic_weight'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='shippingregion',
+            name='priority',
+            field=models.IntegerField(db_index=True, default=0, help_text='A higher number means this region is most important than other with a lower priority', verbose_name='priority'),
+        ),
+        migrations.AlterIndexTogether(
+            name='shippingtableitem',
+            index_together=set([('table', 'start_weight', 'end_weight'), ('start_weight', 'end_weight')]),
+        ),
+    ]
@@ -10,8 +10,10 @@
 from __future__ import unicode_literals
 
 import logging
+from collections import defaultdict, namedtuple
 from datetime import timedelta
 from decimal import Decimal
+from functools import partial
 
 from enumfields import Enum, EnumIntegerField
 from parler.fields import TranslatedField
@@ -21,6 +23,13 @@ from shuup_order_packager.algorithms import SimplePackager
 from shuup_order_packager.constraints import (
     SimplePackageDimensionConstraint, WeightPackageConstraint
 )
+from shuup_shipping_table.cache import (
+    clear_component_filters, get_address_key, get_cached_lookup, get_component_filters, get_lookup_cache_key,
+    get_packaging_cache, get_pinned_lookup, get_source_cache, get_source_fingerprint, get_source_lines_key,
+    set_cached_lookup, set_pinned_lookup, SKIP_PINS_ATTR
+)
+from shuup_shipping_table.intervals import IntervalIndex
+from shuup_shipping_table.utils import get_setting, on_commit, parse_postal_code
 
 from django.core.exceptions import ValidationError
 from django.db import models
@@ -38,9 +47,22 @@ from shuup.utils.dates import DurationRange
 
 logger = logging.getLogger(__name__)
 
-G_TO_KG = Decimal(0.001)
+G_TO_KG = Decimal("0.001")
 KG_TO_G = Decimal(1000)
 
+# related objects used to check if a table item is compatible with a source
+TABLE_ITEM_PREFETCH = ("region", "table__excluded_regions")
+
+# a table item with the final price and delivery time of a component
+ShippingTableQuote = namedtuple("ShippingTableQuote", ("table_item", "price", "delivery_time"))
+
+# groupings of `ShippingTableBehaviorComponent.get_all_options`
+OPTIONS_BY_CARRIER = "carrier"
+OPTIONS_BY_TABLE = "table"
+
+# address attributes matched by the address regions
+ADDRESS_REGION_ATTRS = ("region", "city", "street1", "street2", "street3")
+
 
 class FetchTableMode(Enum):
     LOWEST_PRICE = 0
@@ -51,6 +73,40 @@ class FetchTableMode(Enum):
         LOWEST_DELIVERY_TIME = _('Lowest delivery time')
 
 
+def get_shop_table_items(shop, start_weight, end_weight=None):
+    """
+    Fetches the available table items of the shop whose weight range
+    intersects `start_weight..end_weight` (just `start_weight` by default),
+    ordered by region priority
+    """
+    now_dt = now()
+    if end_weight is None:
+        end_weight = start_weight
+
+    # 1) source total weight must be in a range
+    # 2) enabled tables
+    # 3) enabled table carriers
+    # 4) valid shops
+    # 5) valid date range tables
+    # 6) order by priority (and id, so equal rows always come in the same order)
+    # 7) distinct rows
+    # 8) load the concrete regions and the table excluded regions in bulk,
+    #    so checking the candidates costs the same queries no matter how many they are
+
+    qs = ShippingTableItem.objects.select_related('table').filter(
+        end_weight__gte=start_weight,
+        start_weight__lte=end_weight,
+        table__enabled=True,
+        table__carrier__enabled=True,
+        table__shops__in=[shop]
+    ).filter(
+        Q(Q(table__start_date__lte=now_dt) | Q(table__start_date=None)),
+        Q(Q(table__end_date__gte=now_dt) | Q(table__end_date=None))
+    ).order_by('-region__priority', 'pk').distinct().prefetch_related(*TABLE_ITEM_PREFETCH)
+
+    return qs
+
+
 class ShippingTableBehaviorComponent(ServiceBehaviorComponent):
     add_delivery_time_days = models.PositiveSmallIntegerField(verbose_name=_("additional delivery time"),
                                                               default=0,
@@ -122,6 +178,74 @@ class ShippingTableBehaviorComponent(ServiceBehaviorComponent):
     class Meta:
         abstract = True
 
+    def get_packaging_config(self):
+        """
+        Returns a hashable key with the configuration used to split sources into packages.
+        """
+        return (
+            self.cubic_weight_factor,
+            self.cubic_weight_exemption,
+            self.max_package_width,
+            self.max_package_height,
+            self.max_package_length,
+            self.max_package_edges_sum,
+            self.max_package_weight
+        )
+
+    def pack_source(self, source):
+        """
+        Splits the source into packages.
+
+        :return: the packages and their billable weight (in kg)
+        :rtype: tuple[list,decimal.Decimal]
+        """
+        # create the packager
+        packager = SimplePackager()
+
+        # add the constraints, if configured
+        if self.max_package_height and self.max_package_length and \
+                self.max_package_width and self.max_package_edges_sum:
+
+            packager.add_constraint(SimplePackageDimensionConstraint(
+                self.max_package_width,
+                self.max_package_length,
+                self.max_package_height,
+                self.max_package_edges_sum
+            ))
+
+        if self.max_package_weight:
+            packager.add_constraint(WeightPackageConstraint(self.max_package_weight * KG_TO_G))
+
+        # split products into packages
+        packages = packager.pack_source(source)
+        total_weight = 0
+
+        for package in packages:
+
+            if package.weight > self.cubic_weight_exemption:
+                total_weight = total_weight + (package.volume / self.cubic_weight_factor * G_TO_KG)
+            else:
+                total_weight = total_weight + package.weight * G_TO_KG
+
+        return (packages, total_weight)
+
+    def get_source_packages(self, source):
+        """
+        Returns the packages of the source and their billable weight (in kg).
+
+        Results are kept in a bounded LRU cache keyed on the packaging configuration
+        and the source contents, so they are shared between calls and components.
+        """
+        cache_key = (self.get_packaging_config(), get_source_lines_key(source))
+        packaging_cache = get_packaging_cache()
+        packing = packaging_cache.get(cache_key)
+
+        if packing is None:
+            packing = self.pack_source(source)
+            packaging_cache.set(cache_key, packing)
+
+        return packing
+
     def get_source_weight(self, source):
         """
         Calculates the source weight (in kg) based on behavior component configuration.
@@ -129,96 +253,346 @@ class ShippingTableBehaviorComponent(ServiceBehaviorComponent):
         weight = source.total_gross_weight * G_TO_KG  # transform g in kg
 
         if self.use_cubic_weight and weight > self.cubic_weight_exemption:
-            # create the packager
-            packager = SimplePackager()
+            packages, packages_weight = self.get_source_packages(source)
 
-            # add the constraints, if configured
-            if self.max_package_height and self.max_package_length and \
-                    self.max_package_width and self.max_package_edges_sum:
+            # check if some package was created
+            if packages:
+                weight = packages_weight
 
-                packager.add_constraint(SimplePackageDimensionConstraint(
-                    self.max_package_width,
-                    self.max_package_length,
-                    self.max_package_height,
-                    self.max_package_edges_sum
-                ))
+        return weight
 
-            if self.max_package_weight:
-                packager.add_constraint(WeightPackageConstraint(self.max_package_weight * KG_TO_G))
+    def get_available_table_items(self, source):
+        """
+        Fetches the available table items
+        """
+        return self.get_table_items(source.shop, self.get_source_weight(source))
 
-            # split products into packages
-            packages = packager.pack_source(source)
+    def get_table_items(self, shop, start_weight, end_weight=None):
+        """
+        Fetches the available table items of the shop whose weight range
+        intersects `start_weight..end_weight` (just `start_weight` by default)
+        """
+        return get_shop_table_items(shop, start_weight, end_weight)
 
-            # check if some package was created
-            if packages:
-                total_weight = 0
+    def filter_indexed_items(self, table_items):
+        """
+        Filters and sorts the items returned by the rate index
+        the same way `get_available_table_items` does in SQL.
+        """
+        return table_items
 
-                for package in packages:
+    def get_candidate_pool(self, source, weight):
+        """
+        Returns the available items of the shop which contain the weight,
+        fetched once per source and shared by all the components.
+        """
+        source_cache = get_source_cache(source)
+        pool_key = ("candidate_pool", weight)
 
-                    if package.weight > self.cubic_weight_exemption:
-                        total_weight = total_weight + (package.volume / self.cubic_weight_factor * G_TO_KG)
-                    else:
-                        total_weight = total_weight + package.weight * G_TO_KG
+        if pool_key not in source_cache:
+            source_cache[pool_key] = list(get_shop_table_items(source.shop, weight))
 
-                weight = total_weight
+        return source_cache[pool_key]
 
-        return weight
+    def get_region_matcher(self, source):
+        """
+        Returns the region matcher of the source, shared by all the components
+        """
+        from shuup_shipping_table.matching import RegionMatcher
 
-    def get_available_table_items(self, source):
+        source_cache = get_source_cache(source)
+        if "region_matcher" not in source_cache:
+            source_cache["region_matcher"] = RegionMatcher(source)
+        return source_cache["region_matcher"]
+
+    def get_table_item_candidates(self, source):
         """
-        Fetches the available table items
+        Returns the table items to check for the source, ordered by preference
         """
-        now_dt = now()
-        weight = self.get_source_weight(source)
-
-        # 1) source total weight must be in a range
-        # 2) enabled tables
-        # 3) enabled table carriers
-        # 4) valid shops
-        # 5) valid date range tables
-        # 6) order by priority
-        # 7) distinct rows
-
-        qs = ShippingTableItem.objects.select_related('table').filter(
-            end_weight__gte=weight,
-            start_weight__lte=weight,
-            table__enabled=True,
-            table__carrier__enabled=True,
-            table__shops__in=[source.shop]
-        ).filter(
-            Q(Q(table__start_date__lte=now_dt) | Q(table__start_date=None)),
-            Q(Q(table__end_date__gte=now_dt) | Q(table__end_date=None))
-        ).order_by('-region__priority').distinct()
+        if get_setting("SHIPPING_TABLE_SNAPSHOT_DIR"):
+            from shuup_shipping_table.snapshot import get_snapshot
+            snapshot = get_snapshot(source.shop)
+            if snapshot is not None:
+                return self.filter_indexed_items(snapshot.get_table_items(self.get_source_weight(source)))
 
-        return qs
+        if get_setting("SHIPPING_TABLE_USE_RATE_INDEX"):
+            from shuup_shipping_table.engine import get_rate_index
+            weight = self.get_source_weight(source)
+            return self.filter_indexed_items(get_rate_index(source.shop).get_table_items(weight))
+
+        if get_setting("SHIPPING_TABLE_SHARE_CANDIDATES"):
+            return self.filter_indexed_items(self.get_candidate_pool(source, self.get_source_weight(source)))
+
+        return self.get_available_table_items(source)
+
+    def get_lookup_config(self):
+        """
+        Returns a hashable key with the component configuration
+        which changes the result of a table lookup.
+        """
+        return (self.use_cubic_weight,) + self.get_packaging_config()
+
+    def get_lookup_key(self):
+        return (self.pk or id(self), self.get_lookup_config())
+
+    def get_weight_band(self, shop, weight):
+        """
+        Returns the index of the band between the table weight breakpoints of
+        the shop which contains the weight. All the weights of a band
+        resolve to the same table items.
+        """
+        from shuup_shipping_table.engine import get_weight_band, get_weight_breakpoints
+        return get_weight_band(get_weight_breakpoints(shop), weight)
+
+    def resolve_table_item(self, source):
+        """
+        Returns the first available item, memoized in the source.
+
+        `get_costs`, `get_delivery_time` and `get_unavailability_reasons`
+        share the same resolution while the source contents do not change.
+        """
+        source_cache = get_source_cache(source)
+        lookup_key = self.get_lookup_key()
+
+        if lookup_key not in source_cache:
+            (pinned, table_item) = self.get_pinned_table_item(source, lookup_key)
+            if not pinned:
+                table_item = self.resolve_shared_table_item(source, lookup_key)
+                self.pin_table_item(source, lookup_key, table_item)
+            source_cache[lookup_key] = table_item
+
+        return source_cache[lookup_key]
+
+    def _can_pin(self):
+        return self.pk is not None and bool(get_setting("SHIPPING_TABLE_PIN_ITEMS"))
+
+    def get_pinned_table_item(self, source, lookup_key):
+        """
+        Returns the item pinned by a previous checkout phase
+        for the fingerprint of the source contents.
+
+        :return: a tuple of whether a valid pin was found and the pinned item
+        :rtype: tuple[bool,ShippingTableItem|None]
+        """
+        if not self._can_pin() or getattr(source, SKIP_PINS_ATTR, False):
+            return (False, None)
+
+        pinned = get_pinned_lookup(self.pk, get_source_fingerprint(source, lookup_key))
+        if pinned is None:
+            return (False, None)
+
+        if pinned[0] is None:
+            return (True, None)
+
+        table_item = ShippingTableItem.objects.select_related("table").filter(pk=pinned[0]).first()
+        return (table_item is not None, table_item)
+
+    def pin_table_item(self, source, lookup_key, table_item):
+        """
+        Pins the resolved item (or the miss) in the cache,
+        under the fingerprint of the source contents.
+
+        The source itself is left untouched, so baskets are not
+        saved again and orders don't inherit the pins.
+        """
+        if self._can_pin():
+            fingerprint = get_source_fingerprint(source, lookup_key)
+            set_pinned_lookup(self.pk, fingerprint, (table_item.pk if table_item else None))
+
+    def resolve_shared_table_item(self, source, lookup_key):
+        """
+        Returns the first available item, shared through the cache by all the
+        sources with the same shop, address and weight band.
+
+        Found items are cached for `SHIPPING_TABLE_QUOTE_CACHE_TTL` seconds
+        and misses for `SHIPPING_TABLE_MISS_CACHE_TTL` seconds, when set.
+        Cached items are unsaved instances with the item fields only.
+        """
+        hit_timeout = get_setting("SHIPPING_TABLE_QUOTE_CACHE_TTL")
+        miss_timeout = get_setting("SHIPPING_TABLE_MISS_CACHE_TTL")
+        if not (hit_timeout or miss_timeout):
+            return self.get_first_available_item(source)
+
+        weight_band = self.get_weight_band(source.shop, self.get_source_weight(source))
+        lookup_cache_key = get_lookup_cache_key(source.shop.pk, source.shipping_address, weight_band, lookup_key)
+        cached = get_cached_lookup(lookup_cache_key)
+
+        if cached is not None:
+            # False marks a miss
+            return ShippingTableItem(**cached) if cached else None
+
+        table_item = self.get_first_available_item(source)
+
+        if table_item is None and miss_timeout:
+            set_cached_lookup(lookup_cache_key, False, source.shop.pk, miss_timeout)
+        elif table_item is not None and hit_timeout:
+            set_cached_lookup(lookup_cache_key, table_item.get_field_values(), source.shop.pk, hit_timeout)
+
+        return table_item
 
     def get_first_available_item(self, source):
-        table_items = self.get_available_table_items(source)
+        from shuup_shipping_table.matching import has_custom_regions
 
-        for table_item in table_items:
-            # check if the table exclude region is compatible
-            # with the source.. if True, check next one
-            invalid_region = False
-            for excluded_region in table_item.table.excluded_regions.all():
-                if excluded_region.is_compatible_with(source):
-                    invalid_region = True
-                    break
-            if invalid_region:
-                continue
+        if get_setting("SHIPPING_TABLE_RESOLVE_IN_DATABASE") and not has_custom_regions():
+            return self.get_first_available_item_from_database(source)
+
+        table_items = self.get_table_item_candidates(source)
+        return self.get_first_compatible_item(table_items, self.get_region_matcher(source))
+
+    def get_first_available_item_from_database(self, source):
+        """
+        Returns the first available item with a single query, which matches
+        the item regions and excludes the tables with a matching excluded
+        region in SQL.
+
+        Only the region types of `matching.DATABASE_REGION_TYPES` are supported.
+        """
+        from shuup_shipping_table.matching import get_region_match_q
+
+        region_q = get_region_match_q(source.shipping_address, "region__")
+        if region_q is None:
+            return None
 
+        excluded_regions = ShippingRegion.objects.non_polymorphic().filter(
+            get_region_match_q(source.shipping_address)
+        ).values("pk")
+
+        return self.get_available_table_items(source).filter(region_q).exclude(
+            table__excluded_regions__in=excluded_regions
+        ).prefetch_related(None).first()
+
+    def get_first_compatible_item(self, table_items, region_matcher):
+        for table_item in table_items:
             # a valid table item was found! get out of here
-            if table_item.region.is_compatible_with(source):
+            if self.is_compatible_item(table_item, region_matcher):
                 return table_item
 
+    def is_compatible_item(self, table_item, region_matcher):
+        # check if the table exclude region is compatible
+        # with the source.. if True, the item is not
+        for excluded_region in table_item.table.get_excluded_regions():
+            if region_matcher.is_compatible(excluded_region):
+                return False
+
+        return region_matcher.is_compatible(table_item.region)
+
+    def get_all_options(self, source, group_by=OPTIONS_BY_CARRIER):
+        """
+        Returns the quote of the best available item of each carrier
+        (or of each table, with `OPTIONS_BY_TABLE`) for the source.
+
+        The candidates are fetched and matched once, and the options come
+        in the component preference order, so the first one is the item
+        `get_first_available_item` would return.
+
+        :rtype: list[ShippingTableQuote]
+        """
+        if group_by == OPTIONS_BY_CARRIER:
+            get_group = (lambda table_item: table_item.table.carrier_id)
+        elif group_by == OPTIONS_BY_TABLE:
+            get_group = (lambda table_item: table_item.table_id)
+        else:
+            raise ValueError("Invalid options grouping: %r" % group_by)
+
+        region_matcher = self.get_region_matcher(source)
+        options = []
+        groups = set()
+
+        for table_item in self.get_table_item_candidates(source):
+            group = get_group(table_item)
+            if group not in groups and self.is_compatible_item(table_item, region_matcher):
+                groups.add(group)
+                options.append(self.get_quote(source.shop, table_item))
+
+        return options
+
+    def get_quote(self, shop, table_item):
+        """
+        Returns the quote of the table item with the component extra price and days.
+
+        :rtype: ShippingTableQuote
+        """
+        return ShippingTableQuote(
+            table_item,
+            shop.create_price(table_item.price + self.add_price),
+            DurationRange(timedelta(days=(table_item.delivery_time + self.add_delivery_time_days)))
+        )
+
+    def get_quotes(self, quote_requests):
+        """
+        Quotes many shipping addresses and weights at once.
+
+        The candidate items of each shop are fetched once and the requests
+        are grouped by address, so each region is matched once per address.
+        The results are the same as quoting each request with a source.
+
+        Regions are matched against a `QuoteSource`, which only has
+        the shop and the shipping address.
+
+        :param quote_requests: list of `(shop, address, weight)` tuples, the weight in kg
+        :return: a `ShippingTableQuote` for each request (in the same order), or None
+                 when no table item is available
+        :rtype: list[ShippingTableQuote|None]
+        """
+        from shuup_shipping_table.matching import QuoteSource, RegionMatcher
+
+        quotes = [None] * len(quote_requests)
+        requests_by_shop = defaultdict(list)
+
+        for index, (shop, address, weight) in enumerate(quote_requests):
+            requests_by_shop[shop].append((index, address, weight))
+
+        for shop, shop_requests in requests_by_shop.items():
+            get_weight_candidates = self.get_weight_candidates(shop, [weight for (_, _, weight) in shop_requests])
+
+            requests_by_address = defaultdict(list)
+            for (index, address, weight) in shop_requests:
+                requests_by_address[get_address_key(address)].append((index, address, weight))
+
+            for address_requests in requests_by_address.values():
+                region_matcher = RegionMatcher(QuoteSource(shop, address_requests[0][1]))
+
+                for (index, address, weight) in address_requests:
+                    table_item = self.get_first_compatible_item(get_weight_candidates(weight), region_matcher)
+                    if table_item:
+                        quotes[index] = self.get_quote(shop, table_item)
+
+        return quotes
+
+    def get_weight_candidates(self, shop, weights):
+        """
+        Fetches the candidate items of the shop for all the weights at once.
+
+        :return: a function which returns the candidates of one of the weights,
+                 ordered by preference
+        """
+        if get_setting("SHIPPING_TABLE_SNAPSHOT_DIR"):
+            from shuup_shipping_table.snapshot import get_snapshot
+            snapshot = get_snapshot(shop)
+            if snapshot is not None:
+                return lambda weight: self.filter_indexed_items(snapshot.get_table_items(weight))
+
+        if get_setting("SHIPPING_TABLE_USE_RATE_INDEX"):
+            from shuup_shipping_table.engine import get_rate_index
+            rate_index = get_rate_index(shop)
+            return lambda weight: self.filter_indexed_items(rate_index.get_table_items(weight))
+
+        table_items = self.get_table_items(shop, min(weights), max(weights))
+        weight_index = IntervalIndex(
+            (table_item.start_weight, table_item.end_weight, (position, table_item))
+            for (position, table_item) in enumerate(table_items)
+        )
+        return lambda weight: [table_item for (position, table_item) in sorted(weight_index.find(weight))]
+
     def get_unavailability_reasons(self, service, source):
-        table_item = self.get_first_available_item(source)
+        table_item = self.resolve_table_item(source)
 
         if not table_item:
             return [ValidationError(_("No table found"))]
         return ()
 
     def get_costs(self, service, source):
-        table_item = self.get_first_available_item(source)
+        table_item = self.resolve_table_item(source)
 
         if table_item:
             return [ServiceCost(source.create_price(table_item.price + self.add_price))]
@@ -226,7 +600,7 @@ class ShippingTableBehaviorComponent(ServiceBehaviorComponent):
         return ()
 
     def get_delivery_time(self, service, source):
-        table_item = self.get_first_available_item(source)
+        table_item = self.resolve_table_item(source)
 
         if table_item:
             return DurationRange(
@@ -259,29 +633,86 @@ class ShippingTableByModeBehaviorComponent(ShippingTableBehaviorComponent):
                                                   "to calculate shipping. "
                                                   "Blank means all carriers."))
 
-    def get_available_table_items(self, source):
+    def get_filter_ids(self):
+        """
+        Returns the ids of the tables and of the carriers to filter by,
+        an empty set meaning no filter.
+
+        The sets are cached, on the instance and in the cache,
+        until the filters of the component change.
+
+        :rtype: tuple[frozenset,frozenset]
+        """
+        if self.pk is None:
+            return (frozenset(), frozenset())
+
+        filter_ids = getattr(self, "_filter_ids", None)
+        if filter_ids is None:
+            filter_ids = get_component_filters(self.pk, self._load_filter_ids)
+            self._filter_ids = filter_ids
+
+        return filter_ids
+
+    def _load_filter_ids(self):
+        return (
+            frozenset(self.tables.values_list("pk", flat=True)),
+            frozenset(self.carriers.values_list("pk", flat=True))
+        )
+
+    def clear_filter_ids(self):
+        self._filter_ids = None
+        if self.pk is not None:
+            # the shared filters are cleared once the change commits, or concurrent
+            # requests could cache the filters of before the change again, so
+            # until then this instance reads its filters from the database
+            self._filter_ids = self._load_filter_ids()
+            on_commit(partial(clear_component_filters, self.pk))
+
+    def get_lookup_config(self):
+        (table_ids, carrier_ids) = self.get_filter_ids()
+        return super(ShippingTableByModeBehaviorComponent, self).get_lookup_config() + (
+            self.mode,
+            tuple(sorted(table_ids)),
+            tuple(sorted(carrier_ids))
+        )
+
+    def get_table_items(self, shop, start_weight, end_weight=None):
         """
         Add extra filtering
         """
 
         table_items = super(
             ShippingTableByModeBehaviorComponent, self
-        ).get_available_table_items(source)
+        ).get_table_items(shop, start_weight, end_weight)
 
-        if self.tables.exists():
-            table_items = table_items.filter(
-                table__in=self.tables.all()
-            )
+        (table_ids, carrier_ids) = self.get_filter_ids()
 
-        if self.carriers.exists():
-            table_items = table_items.filter(
-                table__carrier__in=self.carriers.all()
-            )
+        if table_ids:
+            table_items = table_items.filter(table_id__in=table_ids)
+
+        if carrier_ids:
+            table_items = table_items.filter(table__carrier_id__in=carrier_ids)
+
+        if self.mode == FetchTableMode.LOWEST_PRICE:
+            table_items = table_items.order_by('-region__priority', 'price', 'pk')
+        elif self.mode == FetchTableMode.LOWEST_DELIVERY_TIME:
+            table_items = table_items.order_by('-region__priority', 'delivery_time', 'pk')
+
+        return table_items
+
+    def filter_indexed_items(self, table_items):
+        (table_ids, carrier_ids) = self.get_filter_ids()
+
+        if table_ids:
+            table_items = [item for item in table_items if item.table_id in table_ids]
+
+        if carrier_ids:
+            table_items = [item for item in table_items if item.table.carrier_id in carrier_ids]
 
         if self.mode == FetchTableMode.LOWEST_PRICE:
-            table_items = table_items.order_by('-region__priority', 'price')
+            table_items = sorted(table_items, key=lambda item: (-item.region.priority, item.price))
         elif self.mode == FetchTableMode.LOWEST_DELIVERY_TIME:
-            table_items = table_items.order_by('-region__priority', 'delivery_time')
+            table_items = sorted(table_items, key=lambda item: (-item.region.priority, item.delivery_time))
 
         return table_items
 
@@ -294,17 +725,26 @@ class SpecificShippingTableBehaviorComponent(ShippingTableBehaviorComponent):
                               verbose_name=_("table"),
                               help_text=_("Select the table to fetch the price and delivery time."))
 
-    def get_available_table_items(self, source):
+    def get_lookup_config(self):
+        return super(SpecificShippingTableBehaviorComponent, self).get_lookup_config() + (self.table_id,)
+
+    def get_table_items(self, shop, start_weight, end_weight=None):
         """ Add extra filtering """
 
         qs = super(
             SpecificShippingTableBehaviorComponent, self
-        ).get_available_table_items(source).filter(
+        ).get_table_items(shop, start_weight, end_weight).filter(
             table=self.table
-        ).order_by('-region__priority', 'price')
+        ).order_by('-region__priority', 'price', 'pk')
 
         return qs
 
+    def filter_indexed_items(self, table_items):
+        return sorted(
+            [item for item in table_items if item.table_id == self.table_id],
+            key=lambda item: (-item.region.priority, item.price)
+        )
+
 
 @python_2_unicode_compatible
 class ShippingCarrier(models.Model):
@@ -330,6 +770,7 @@ class ShippingRegion(PolymorphicTranslatableShuupModel):
     description = TranslatedField()
     priority = models.IntegerField(verbose_name=_("priority"),
                                    default=0,
+                                   db_index=True,
                                    help_text=_("A higher number means this region is most "
                                                "important than other with a lower priority"))
 
@@ -375,12 +816,12 @@ class PostalCodeRangeShippingRegion(ShippingRegion):
                 source.shipping_address.country != self.country:
             return False
 
-        try:
-            postal_code_int = int("".join([d for d in source.shipping_address.postal_code if d.isdigit()]))
-            return (self.start_postal_code <= postal_code_int <= self.end_postal_code)
-        except ValueError:
+        postal_code_int = parse_postal_code(source.shipping_address.postal_code)
+        if postal_code_int is None:
             return False
 
+        return (self.start_postal_code <= postal_code_int <= self.end_postal_code)
+
     def __str__(self):
         return self.name
 
@@ -402,6 +843,34 @@ class CountryShippingRegion(ShippingRegion):
         return self.name
 
 
+def compile_address_matchers(values):
+    """
+    Compiles the comma-separated values of the `ADDRESS_REGION_ATTRS`
+    into a tuple of `(attr_name, frozenset)`, skipping the blank ones.
+    """
+    matchers = []
+
+    for attr_name, attr_value in zip(ADDRESS_REGION_ATTRS, values):
+        if attr_value:
+            # split, transform to upper and strip
+            matchers.append((attr_name, frozenset(v.upper().strip() for v in attr_value.split(","))))
+
+    return tuple(matchers)
+
+
+def address_matches(matchers, address):
+    """
+    Returns whether the address attributes match all the compiled matchers.
+    """
+    for attr_name, values in matchers:
+        addr_value = getattr(address, attr_name, None)
+
+        if not addr_value or addr_value.upper().strip() not in values:
+            return False
+
+    return True
+
+
 @python_2_unicode_compatible
 class AddressShippingRegion(ShippingRegion):
     country = CountryField(verbose_name=_("country"))
@@ -430,29 +899,32 @@ class AddressShippingRegion(ShippingRegion):
         verbose_name = _("shipping region by address")
         verbose_name_plural = _("shipping regions by address")
 
-    def is_compatible_with(self, source):
-        if not source.shipping_address or not source.shipping_address.country or \
-                source.shipping_address.country != self.country:
-            return False
+    def save(self, *args, **kwargs):
+        self._compiled_matchers = None
+        return super(AddressShippingRegion, self).save(*args, **kwargs)
 
-        attrs_check = ('region', 'city', 'street1', 'street2', 'street3')
+    def get_matchers(self):
+        """
+        Returns the compiled matchers of the address attributes.
 
-        # address attributes to check, those configured must match
-        for attr_name in attrs_check:
-            attr_value = getattr(self, attr_name, None)
+        The matchers are cached in the instance and compiled
+        again when the attribute values change.
+        """
+        values = tuple(getattr(self, attr_name, None) for attr_name in ADDRESS_REGION_ATTRS)
+        compiled_matchers = getattr(self, "_compiled_matchers", None)
 
-            if attr_value:
-                if not getattr(source.shipping_address, attr_name, None):
-                    return False
+        if not compiled_matchers or compiled_matchers[0] != values:
+            compiled_matchers = (values, compile_address_matchers(values))
+            self._compiled_matchers = compiled_matchers
 
-                # split, transform to upper and strip
-                values = [v.upper().strip() for v in attr_value.split(",")]
-                addr_value = getattr(source.shipping_address, attr_name).upper().strip()
+        return compiled_matchers[1]
 
-                if addr_value not in values:
-                    return False
+    def is_compatible_with(self, source):
+        if not source.shipping_address or not source.shipping_address.country or \
+                source.shipping_address.country != self.country:
+            return False
 
-        return True
+        return address_matches(self.get_matchers(), source.shipping_address)
 
     def __str__(self):
         return self.name
@@ -485,6 +957,37 @@ class ShippingTable(models.Model):
     def __str__(self):
         return self.name
 
+    def is_available_at(self, dt):
+        """
+        Returns whether the table date range contains the given datetime
+        """
+        return (
+            (self.start_date is None or self.start_date <= dt) and
+            (self.end_date is None or self.end_date >= dt)
+        )
+
+    def get_availability_transitions(self):
+        """
+        Returns the moments when the table becomes available or unavailable:
+        it is available from `start_date` and until `end_date`, inclusive.
+        """
+        transitions = []
+        if self.start_date is not None:
+            transitions.append(self.start_date)
+        if self.end_date is not None:
+            transitions.append(self.end_date + timedelta(microseconds=1))
+        return transitions
+
+    def get_excluded_regions(self):
+        """
+        Returns the excluded regions, or those attached by a snapshot
+        when the table was loaded from one
+        """
+        excluded_regions = getattr(self, "_excluded_regions", None)
+        if excluded_regions is not None:
+            return excluded_regions
+        return self.excluded_regions.all()
+
 
 @python_2_unicode_compatible
 class ShippingTableItem(models.Model):
@@ -500,6 +1003,38 @@ class ShippingTableItem(models.Model):
     class Meta:
         verbose_name = _("shipping price table")
         verbose_name_plural = _("shipping price tables")
+        # match the weight range lookup of `get_available_table_items`
+        index_together = (
+            ("table", "start_weight", "end_weight"),
+            ("start_weight", "end_weight"),
+        )
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(ShippingTableItem, cls).from_db(db, field_names, values)
+        # the table the item was loaded with, to bump both tables when the item moves
+        instance._loaded_table_id = instance.__dict__.get("table_id")
+        return instance
+
+    def delete(self, *args, **kwargs):
+        """
+        Deletes the item and bumps the lookup generations of its table.
+
+        There are no delete signal receivers for items, which would make
+        Django fetch and delete the items of a table or region one by one;
+        bulk deletes and cascades are bumped by the table or region change.
+        """
+        from shuup_shipping_table.signal_handlers import bump_table_generation
+        table_id = self.table_id
+        result = super(ShippingTableItem, self).delete(*args, **kwargs)
+        bump_table_generation(table_id)
+        return result
+
+    def get_field_values(self):
+        """
+        Returns the field values of the item, to create an unsaved copy of it
+        """
+        return dict((field.attname, getattr(self, field.attname)) for field in self._meta.concrete_fields)
 
     def __str__(self):
         return "ID {0} {1} {2} - {3}->{4}: {5}-{6}".format(self.id,
@@ -509,3 +1044,34 @@ class ShippingTableItem(models.Model):
                                                            self.end_weight,
                                                            self.price,
                                                            self.delivery_time)
+
+
+class ShippingTableVersion(models.Model):
+    """
+    A version stamp of the shipping table data, stored in the database.
+
+    It is bumped in the same transaction as every table, item, carrier
+    or region change, so nodes which do not share a cache can find out
+    whether their process caches are stale with a single row read.
+    """
+    VERSION_ID = 1
+
+    version = models.BigIntegerField(verbose_name=_("version"), default=0)
+
+    class Meta:
+        verbose_name = _("shipping table version")
+        verbose_name_plural = _("shipping table versions")
+
+    @classmethod
+    def get_current(cls):
+        return cls.objects.filter(pk=cls.VERSION_ID).values_list("version", flat=True).first() or 0
+
+    @classmethod
+    def bump(cls):
+        if cls.objects.filter(pk=cls.VERSION_ID).update(version=models.F("version") + 1):
+            return
+
+        # the first change ever, unless another transaction just created the row
+        (_, created) = cls.objects.get_or_create(pk=cls.VERSION_ID, defaults={"version": 1})
+        if not created:
+            cls.objects.filter(pk=cls.VERSION_ID).update(version=models.F("version") + 1)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Shipping Table
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+#: Whether to resolve table items through the compiled in-memory
+#: rate index of the shop instead of querying the database on every lookup.
+#:
+#: The index is rebuilt when tables, items, carriers or regions change.
+SHIPPING_TABLE_USE_RATE_INDEX = False
+
+#: Number of cubic weight packing results kept in the process cache.
+#:
+#: Results are keyed on the packaging configuration and on the product ids,
+#: quantities and dimensions of the source, so they are reused across calls
+#: and across components with the same package limits.
+SHIPPING_TABLE_PACKAGING_CACHE_SIZE = 1000
+
+#: Directory of the compiled rate snapshots built by the
+#: `build_shipping_table_snapshots` management command.
+#:
+#: When set, lookups read the candidate items of a shop from its snapshot,
+#: memory-mapped and shared by all the worker processes of the node.
+#: Snapshots older than the current lookup generation are ignored.
+SHIPPING_TABLE_SNAPSHOT_DIR = None
+
+#: Interval, in seconds, between the checks of the table version stamp
+#: stored in the database, or None to disable the checks.
+#:
+#: Set it when the nodes do not share the cache backend: every process
+#: then notices the changes made on other nodes within the interval
+#: and drops its compiled indexes and cached lookups.
+SHIPPING_TABLE_VERSION_CHECK_INTERVAL = None
+
+#: Whether to resolve the table item of a source with a single query
+#: which matches the regions and excludes the tables with a matching
+#: excluded region in the database, instead of checking the candidates in Python.
+#:
+#: Only used when all the regions are postal code range, country or
+#: address regions, any other region type falls back to Python matching.
+SHIPPING_TABLE_RESOLVE_IN_DATABASE = False
+
+#: Number of seconds the lookups which found no table item are cached,
+#: by shop, address and weight band, or None to not cache them.
+#:
+#: Addresses out of the coverage of every table then cost a single cache
+#: read on each basket refresh. Table changes invalidate the cached misses.
+SHIPPING_TABLE_MISS_CACHE_TTL = None
+
+#: Number of seconds the lookups which found a table item are cached,
+#: or None to not cache them.
+#:
+#: Lookups are cached by shop, address and weight band, the range between
+#: two consecutive weight breakpoints of the shop tables, so all the baskets
+#: of a band share the same result. Table changes invalidate the cached lookups.
+SHIPPING_TABLE_QUOTE_CACHE_TTL = None
+
+#: Whether the components of the shipping methods of a basket share
+#: their candidate items.
+#:
+#: The available items which contain the basket weight are then fetched
+#: once per basket, and each component filters them by its own tables,
+#: carriers or table and sorts them by its own mode in memory.
+SHIPPING_TABLE_SHARE_CANDIDATES = False
+
+#: Whether to pin the resolved table items in the cache,
+#: under a fingerprint of the basket contents.
+#:
+#: The following checkout phases then reuse the pinned item while the
+#: address, the lines and the tables of the shop don't change.
+#: Pins are never stored in the basket or order shipping data.
+SHIPPING_TABLE_PIN_ITEMS = False
+
+#: The time in seconds the pinned table items are kept in the cache.
+SHIPPING_TABLE_PIN_TTL = 1800
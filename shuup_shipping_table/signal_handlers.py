@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Shipping Table
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+import threading
+from functools import partial
+
+from shuup_shipping_table.cache import bump_generation, clear_component_filters
+from shuup_shipping_table.models import (
+    ShippingCarrier, ShippingRegion, ShippingTable, ShippingTableByModeBehaviorComponent, ShippingTableItem,
+    ShippingTableVersion
+)
+from shuup_shipping_table.utils import on_commit
+
+from django.apps import apps
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+
+# the changes of the current transaction of each thread
+_pending_changes = threading.local()
+
+
+def _bump_changes(changes):
+    if changes["all"]:
+        bump_generation()
+        return
+
+    shop_ids = set(changes["shops"])
+    if changes["tables"]:
+        shop_ids.update(ShippingTable.shops.through.objects.filter(
+            shippingtable_id__in=changes["tables"]).values_list("shop_id", flat=True))
+
+    for shop_id in shop_ids:
+        bump_generation(shop_id)
+
+
+def _get_pending_changes():
+    """
+    Returns the changes of the current transaction, or None outside of
+    transactions and on Django 1.8, which has no commit hooks.
+
+    The first change of each transaction stamps the version and registers
+    the hook which bumps the generations of all the changes on commit, so
+    large transactions don't write the stamp or queue a hook per row.
+    Django replaces its list of commit hooks on every commit and rollback,
+    which tells whether the changes belong to the current transaction.
+    """
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block or not hasattr(connection, "run_on_commit"):
+        return None
+
+    changes = getattr(_pending_changes, "changes", None)
+    if changes is None or changes["hooks"] is not connection.run_on_commit:
+        changes = {"tables": set(), "shops": set(), "all": False}
+        ShippingTableVersion.bump()
+        transaction.on_commit(partial(_bump_changes, changes))
+        changes["hooks"] = connection.run_on_commit
+        _pending_changes.changes = changes
+
+    return changes
+
+
+def bump_table_generation(table_id):
+    """
+    Stamps the version and bumps the lookup generations of the shops
+    of the table once the current transaction commits.
+
+    Bumping before the commit would let concurrent requests cache
+    lookups of the rows of before the change under the new generation.
+    """
+    changes = _get_pending_changes()
+    if changes is None:
+        ShippingTableVersion.bump()
+        _bump_changes({"tables": [table_id], "shops": (), "all": False})
+    else:
+        changes["tables"].add(table_id)
+
+
+def bump_generation_on_commit(shop_id=None):
+    """
+    Stamps the version and bumps the lookup generation of the shop,
+    or of all the shops when `shop_id` is None, once the current
+    transaction commits.
+    """
+    changes = _get_pending_changes()
+    if changes is None:
+        ShippingTableVersion.bump()
+        bump_generation(shop_id)
+    elif shop_id is None:
+        changes["all"] = True
+    else:
+        changes["shops"].add(shop_id)
+
+
+@receiver(post_save, sender=ShippingTable, dispatch_uid="shipping_table:table_saved")
+def handle_table_save(sender, instance, **kwargs):
+    bump_table_generation(instance.pk)
+
+
+@receiver(post_save, sender=ShippingTableItem, dispatch_uid="shipping_table:table_item_saved")
+def handle_table_item_save(sender, instance, **kwargs):
+    # items are deleted without signals, see `ShippingTableItem.delete`
+    bump_table_generation(instance.table_id)
+
+    # the table the item was loaded with, when it moved to another table
+    loaded_table_id = getattr(instance, "_loaded_table_id", None)
+    if loaded_table_id is not None and loaded_table_id != instance.table_id:
+        bump_table_generation(loaded_table_id)
+    instance._loaded_table_id = instance.table_id
+
+
+@receiver(post_delete, sender=ShippingTable, dispatch_uid="shipping_table:table_deleted")
+@receiver(post_save, sender=ShippingCarrier, dispatch_uid="shipping_table:carrier_saved")
+@receiver(post_delete, sender=ShippingCarrier, dispatch_uid="shipping_table:carrier_deleted")
+def handle_global_change(sender, **kwargs):
+    # the shops relations may already be gone (or may be too many to fetch),
+    # so just invalidate the lookups of every shop
+    bump_generation_on_commit()
+
+
+def handle_region_change(sender, instance, **kwargs):
+    bump_generation_on_commit()
+
+
+def connect_region_signals():
+    """
+    Connects the region handlers to `ShippingRegion` and each of its subclasses.
+
+    Signals are sent with the concrete region class as the sender, and
+    receivers without a sender would disable the fast deletes of every model.
+    """
+    for model in apps.get_models():
+        if not issubclass(model, ShippingRegion):
+            continue
+
+        dispatch_uid = "shipping_table:region_changed:%s.%s" % (model._meta.app_label, model._meta.model_name)
+        post_save.connect(handle_region_change, sender=model, dispatch_uid=dispatch_uid)
+        post_delete.connect(handle_region_change, sender=model, dispatch_uid=dispatch_uid)
+
+
+@receiver(m2m_changed, sender=ShippingTable.shops.through, dispatch_uid="shipping_table:table_shops_changed")
+def handle_table_shops_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+
+    if reverse:
+        # instance is a shop
+        bump_generation_on_commit(instance.pk)
+
+    elif action in ("post_add", "post_remove"):
+        for shop_id in pk_set:
+            bump_generation_on_commit(shop_id)
+
+    elif action == "post_clear":
+        # the removed shops are unknown at this point
+        bump_generation_on_commit()
+
+
+@receiver(m2m_changed, sender=ShippingTable.excluded_regions.through,
+          dispatch_uid="shipping_table:table_excluded_regions_changed")
+def handle_table_excluded_regions_change(sender, instance, action, reverse, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+
+    if reverse:
+        # instance is a region, which may be excluded from tables of any shop
+        bump_generation_on_commit()
+    else:
+        bump_table_generation(instance.pk)
+
+
+@receiver(m2m_changed, sender=ShippingTableByModeBehaviorComponent.tables.through,
+          dispatch_uid="shipping_table:component_tables_changed")
+@receiver(m2m_changed, sender=ShippingTableByModeBehaviorComponent.carriers.through,
+          dispatch_uid="shipping_table:component_carriers_changed")
+def handle_component_filters_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+
+    if not reverse:
+        instance.clear_filter_ids()
+    elif pk_set is not None:
+        # instance is a table or a carrier
+        for component_id in pk_set:
+            on_commit(partial(clear_component_filters, component_id))
+    else:
+        # the components are unknown at this point
+        bump_generation_on_commit()
@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Shipping Table
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Compiled, read-only rate snapshots shared by the worker processes.
+
+A snapshot holds the enabled table items of a shop in fixed-width records
+(fixed-point weight bounds and price, delivery days, table and region ids),
+grouped by region priority and sorted by start weight, plus the tables
+and the regions they reference. Workers open it with `mmap`, so the pages
+are shared, and only the candidates of a lookup become model instances.
+
+Snapshots are stamped with the `ShippingTableVersion` they were built from,
+so every node can tell when they are outdated, whether or not it shares
+the cache with the others.
+"""
+from __future__ import unicode_literals
+
+import calendar
+import logging
+import mmap
+import os
+import struct
+import tempfile
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal, ROUND_CEILING, ROUND_FLOOR
+
+from shuup_shipping_table.cache import get_generation
+from shuup_shipping_table.models import (
+    CountryShippingRegion, PostalCodeRangeShippingRegion, ShippingRegion, ShippingTable, ShippingTableItem,
+    ShippingTableVersion, TABLE_ITEM_PREFETCH
+)
+from shuup_shipping_table.utils import get_setting
+
+from django.utils.timezone import now, utc
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"STSNAP02"
+# weights and prices are stored as integers, scaled by the decimal places of their fields
+WEIGHT_SCALE = 10 ** 9
+PRICE_SCALE = 10 ** 9
+
+# magic, shop id, version stamp,
+# number of groups, items, tables, regions and excluded regions
+HEADER = struct.Struct("<8sqqqqqqq")
+# priority, first item, number of items
+GROUP = struct.Struct("<qqq")
+# start weight, end weight, max end weight of the group so far (fixed-point),
+# item id, table id, region id, price (fixed-point), delivery time
+ITEM = struct.Struct("<qqqqqqqi4x")
+# table id, carrier id, start and end timestamps, first excluded region, number of excluded regions
+TABLE = struct.Struct("<qqddqq")
+# region id, priority, kind, country, start and end postal codes
+REGION = struct.Struct("<qqB2sqq")
+EXCLUDED = struct.Struct("<q")
+
+REGION_OTHER = 0
+REGION_POSTAL_CODE = 1
+REGION_COUNTRY = 2
+
+# opened snapshots of this process, by shop id
+_snapshots = {}
+
+
+def _to_timestamp(dt, default):
+    if dt is None:
+        return default
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+
+def _from_timestamp(timestamp):
+    if timestamp in (float("inf"), float("-inf")):
+        return None
+    return datetime.fromtimestamp(timestamp, utc)
+
+
+def _scale_weight(weight):
+    """
+    Returns the weight scaled by `WEIGHT_SCALE`, rounded down and up,
+    to compare it with the stored weights exactly as the database would.
+    """
+    scaled_weight = Decimal(weight) * WEIGHT_SCALE
+    return (int(scaled_weight.to_integral_value(ROUND_FLOOR)), int(scaled_weight.to_integral_value(ROUND_CEILING)))
+
+
+def get_snapshot_path(shop_id, directory=None):
+    return os.path.join(directory or get_setting("SHIPPING_TABLE_SNAPSHOT_DIR"), "shop-%d.snapshot" % shop_id)
+
+
+def _get_region_record(region):
+    if type(region) is PostalCodeRangeShippingRegion:
+        return (region.pk, region.priority, REGION_POSTAL_CODE, str(region.country).encode("ascii"),
+                region.start_postal_code, region.end_postal_code)
+    if type(region) is CountryShippingRegion:
+        return (region.pk, region.priority, REGION_COUNTRY, str(region.country).encode("ascii"), 0, 0)
+    return (region.pk, region.priority, REGION_OTHER, b"", 0, 0)
+
+
+def write_snapshot(shop, directory=None):
+    """
+    Compiles the enabled table items of the shop into its snapshot file.
+
+    The file is written to a temporary file and renamed over the
+    previous snapshot, so readers never see a partial snapshot.
+
+    :return: the snapshot path
+    """
+    # read before the items: a change in between makes the snapshot outdated, not wrong
+    version = ShippingTableVersion.get_current()
+    table_items = list(ShippingTableItem.objects.filter(
+        table__enabled=True,
+        table__carrier__enabled=True,
+        table__shops=shop
+    ).select_related("table").prefetch_related(*TABLE_ITEM_PREFETCH))
+
+    tables = {}
+    regions = {}
+    items_by_priority = defaultdict(list)
+
+    for table_item in table_items:
+        tables[table_item.table_id] = table_item.table
+        regions[table_item.region_id] = table_item.region
+        for excluded_region in table_item.table.excluded_regions.all():
+            regions[excluded_region.pk] = excluded_region
+        items_by_priority[table_item.region.priority].append(table_item)
+
+    groups = []
+    item_records = []
+    for priority in sorted(items_by_priority, reverse=True):
+        group_items = sorted(items_by_priority[priority], key=lambda item: (item.start_weight, item.pk))
+        groups.append((priority, len(item_records), len(group_items)))
+
+        max_end = None
+        for table_item in group_items:
+            end_weight = int(table_item.end_weight * WEIGHT_SCALE)
+            max_end = end_weight if max_end is None else max(max_end, end_weight)
+            item_records.append((
+                int(table_item.start_weight * WEIGHT_SCALE),
+                end_weight,
+                max_end,
+                table_item.pk,
+                table_item.table_id,
+                table_item.region_id,
+                int(table_item.price * PRICE_SCALE),
+                table_item.delivery_time
+            ))
+
+    table_records = []
+    excluded_records = []
+    for table in tables.values():
+        excluded_ids = [region.pk for region in table.excluded_regions.all()]
+        table_records.append((
+            table.pk,
+            table.carrier_id,
+            _to_timestamp(table.start_date, float("-inf")),
+            _to_timestamp(table.end_date, float("inf")),
+            len(excluded_records),
+            len(excluded_ids)
+        ))
+        excluded_records.extend((region_id,) for region_id in excluded_ids)
+
+    region_records = [_get_region_record(region) for region in regions.values()]
+
+    path = get_snapshot_path(shop.pk, directory)
+    (fd, temp_path) = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".shop-%d." % shop.pk)
+
+    try:
+        with os.fdopen(fd, "wb") as snapshot_file:
+            snapshot_file.write(HEADER.pack(
+                MAGIC, shop.pk, version, len(groups),
+                len(item_records), len(table_records), len(region_records), len(excluded_records)
+            ))
+            for (records, record_struct) in ((groups, GROUP), (item_records, ITEM), (table_records, TABLE),
+                                             (region_records, REGION), (excluded_records, EXCLUDED)):
+                for record in records:
+                    snapshot_file.write(record_struct.pack(*record))
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+
+        os.chmod(temp_path, 0o644)
+        os.rename(temp_path, path)
+    except Exception:
+        os.unlink(temp_path)
+        raise
+
+    return path
+
+
+class RateSnapshot(object):
+    """
+    A memory-mapped snapshot of the table items of a shop.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as snapshot_file:
+            self.stat = os.fstat(snapshot_file.fileno())
+            self.buffer = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, self.shop_id, self.version, groups_count, items_count,
+         tables_count, regions_count, excluded_count) = HEADER.unpack_from(self.buffer, 0)
+
+        if magic != MAGIC:
+            self.buffer.close()
+            raise ValueError("%s is not a shipping table snapshot" % path)
+
+        offset = HEADER.size
+
+        self.groups = [GROUP.unpack_from(self.buffer, offset + index * GROUP.size) for index in range(groups_count)]
+        offset += groups_count * GROUP.size
+
+        # the items stay in the mapped buffer
+        self.items_offset = offset
+        offset += items_count * ITEM.size
+
+        tables = [TABLE.unpack_from(self.buffer, offset + index * TABLE.size) for index in range(tables_count)]
+        offset += tables_count * TABLE.size
+
+        regions = [REGION.unpack_from(self.buffer, offset + index * REGION.size) for index in range(regions_count)]
+        offset += regions_count * REGION.size
+
+        excluded = [EXCLUDED.unpack_from(self.buffer, offset + index * EXCLUDED.size)[0]
+                    for index in range(excluded_count)]
+
+        self.tables = dict(
+            (table_id, (carrier_id, start, end, excluded[excluded_offset:excluded_offset + excluded_count]))
+            for (table_id, carrier_id, start, end, excluded_offset, excluded_count) in tables
+        )
+        self.region_records = dict((record[0], record) for record in regions)
+        self._table_cache = {}
+        self._region_cache = {}
+        self._available_table_ids = None
+        self._available_since = None
+        self._available_until = None
+        self._checked_generation = None
+        self._is_current = False
+        self.outdated_logged = False
+
+    def is_current(self):
+        """
+        Returns whether the snapshot was built from the current version stamp.
+
+        The stamp is read again only when the lookup generation of the shop
+        changes, so this costs a database query per table change at most.
+        """
+        generation = get_generation(self.shop_id)
+        if generation != self._checked_generation:
+            self._is_current = (self.version == ShippingTableVersion.get_current())
+            self._checked_generation = generation
+        return self._is_current
+
+    def _get_start_weight(self, index):
+        return struct.unpack_from("<q", self.buffer, self.items_offset + index * ITEM.size)[0]
+
+    def get_region(self, region_id):
+        if region_id not in self._region_cache:
+            (_, priority, kind, country, start, end) = self.region_records[region_id]
+            country = country.decode("ascii")
+
+            if kind == REGION_POSTAL_CODE:
+                region = PostalCodeRangeShippingRegion(id=region_id, shippingregion_ptr_id=region_id,
+                                                       priority=priority, country=country,
+                                                       start_postal_code=start, end_postal_code=end)
+            elif kind == REGION_COUNTRY:
+                region = CountryShippingRegion(id=region_id, shippingregion_ptr_id=region_id,
+                                               priority=priority, country=country)
+            else:
+                # other region types may match on anything, load them
+                region = ShippingRegion.objects.get(pk=region_id)
+
+            self._region_cache[region_id] = region
+
+        return self._region_cache[region_id]
+
+    def get_table(self, table_id):
+        if table_id not in self._table_cache:
+            (carrier_id, start, end, excluded_ids) = self.tables[table_id]
+            table = ShippingTable(id=table_id, carrier_id=carrier_id,
+                                  start_date=_from_timestamp(start), end_date=_from_timestamp(end))
+            table._excluded_regions = [self.get_region(region_id) for region_id in excluded_ids]
+            self._table_cache[table_id] = table
+
+        return self._table_cache[table_id]
+
+    def get_available_table_ids(self, when):
+        """
+        Returns the ids of the tables available at the `when` timestamp.
+
+        The set is reused until the next moment any table
+        becomes available or unavailable.
+        """
+        if (self._available_table_ids is None or
+                not (self._available_since <= when < self._available_until)):
+            # the end dates are inclusive, tables become unavailable just after them
+            transitions = sorted(
+                transition
+                for (carrier_id, start, end, excluded_ids) in self.tables.values()
+                for transition in (start, end + 1e-6)
+            )
+            self._available_table_ids = set(
+                table_id
+                for (table_id, (carrier_id, start, end, excluded_ids)) in self.tables.items()
+                if start <= when <= end
+            )
+            self._available_since = when
+            self._available_until = next((transition for transition in transitions if transition > when),
+                                         float("inf"))
+
+        return self._available_table_ids
+
+    def get_table_items(self, weight):
+        """
+        Returns the items which contain the weight and whose table is
+        available, ordered by region priority (highest first) and id.
+
+        Like the rate index, but the items are read from the mapped buffer
+        and only the matches become (unsaved) model instances.
+        """
+        (weight_floor, weight_ceiling) = _scale_weight(weight)
+        available_table_ids = self.get_available_table_ids(_to_timestamp(now(), None))
+        table_items = []
+
+        for (priority, first, count) in self.groups:
+            # bisect right on the start weights of the group
+            low, high = 0, count
+            while low < high:
+                middle = (low + high) // 2
+                if self._get_start_weight(first + middle) <= weight_floor:
+                    low = middle + 1
+                else:
+                    high = middle
+
+            records = []
+            index = first + low - 1
+            while index >= first:
+                record = ITEM.unpack_from(self.buffer, self.items_offset + index * ITEM.size)
+                if record[2] < weight_ceiling:
+                    break
+
+                if record[1] >= weight_ceiling and record[4] in available_table_ids:
+                    records.append(record)
+                index -= 1
+
+            for record in sorted(records, key=lambda record: record[3]):
+                table_items.append(self.make_table_item(record))
+
+        return table_items
+
+    def make_table_item(self, record):
+        (start_weight, end_weight, _, item_id, table_id, region_id, price, delivery_time) = record
+        return ShippingTableItem(id=item_id,
+                                 table=self.get_table(table_id),
+                                 region=self.get_region(region_id),
+                                 start_weight=Decimal(start_weight) / WEIGHT_SCALE,
+                                 end_weight=Decimal(end_weight) / WEIGHT_SCALE,
+                                 price=Decimal(price) / PRICE_SCALE,
+                                 delivery_time=delivery_time)
+
+    def close(self):
+        self.buffer.close()
+
+
+def get_snapshot(shop):
+    """
+    Returns the snapshot of the shop if it is up to date, None otherwise.
+
+    Snapshots are reopened when their file is replaced, closing the previous one.
+    """
+    path = get_snapshot_path(shop.pk)
+    snapshot = _snapshots.get(shop.pk)
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    if snapshot is None or (snapshot.stat.st_ino, snapshot.stat.st_mtime) != (stat.st_ino, stat.st_mtime):
+        try:
+            snapshot = RateSnapshot(path)
+        except (IOError, OSError, ValueError, struct.error):
+            logger.exception("Failed to open the shipping table snapshot %s", path)
+            return None
+
+        previous_snapshot = _snapshots.get(shop.pk)
+        if previous_snapshot is not None:
+            previous_snapshot.close()
+        _snapshots[shop.pk] = snapshot
+
+    if not snapshot.is_current():
+        if not snapshot.outdated_logged:
+            logger.warning("The shipping table snapshot of shop %s is outdated and ignored until it is built "
+                           "again with the build_shipping_table_snapshots command", shop.pk)
+            snapshot.outdated_logged = True
+        return None
+
+    return snapshot
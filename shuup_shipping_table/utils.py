@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Shipping Table
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+from __future__ import unicode_literals
+
+from shuup_shipping_table import settings as app_settings
+
+from django.conf import settings
+from django.db import transaction
+
+
+def get_setting(name):
+    """
+    Returns the value of a shipping table setting,
+    falling back to the default declared in `shuup_shipping_table.settings`.
+    """
+    return getattr(settings, name, getattr(app_settings, name))
+
+
+def on_commit(func):
+    """
+    Calls the function once the current transaction commits,
+    or right away outside of transactions.
+
+    Django 1.8 has no commit hooks, so there it is called right away.
+    """
+    if hasattr(transaction, "on_commit"):
+        transaction.on_commit(func)
+    else:
+        func()
+
+
+def parse_postal_code(postal_code):
+    """
+    Returns the digits of the postal code as an integer,
+    or None if the postal code has no digits.
+    """
+    digits = "".join([d for d in (postal_code or "") if d.isdigit()])
+    return int(digits) if digits else None
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Shipping Table
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Benchmark of the weight range lookup with and without the table item indexes.
+
+This module is not collected by default, run it explicitly with::
+
+    py.test -s shuup_shipping_table_tests/bench_weight_lookup.py
+
+Use `SHIPPING_TABLE_BENCH_ROWS` to change the number of table items (default 200000)
+and `SHIPPING_TABLE_BENCH_LOOKUPS` to change the number of timed lookups (default 200).
+"""
+from __future__ import print_function, unicode_literals
+
+import os
+import random
+import time
+from decimal import Decimal
+
+import pytest
+from shuup_shipping_table.models import (
+    CountryShippingRegion, FetchTableMode, KG_TO_G, ShippingCarrier, ShippingRegion, ShippingTable,
+    ShippingTableByModeBehaviorComponent, ShippingTableItem
+)
+
+from django.db import connection
+
+from shuup.testing.factories import get_default_shop
+
+ROWS = int(os.environ.get("SHIPPING_TABLE_BENCH_ROWS", 200000))
+LOOKUPS = int(os.environ.get("SHIPPING_TABLE_BENCH_LOOKUPS", 200))
+TABLES = 5
+REGIONS = 20
+
+
+class BenchmarkSource(object):
+    def __init__(self, shop, weight):
+        self.shop = shop
+        self.total_gross_weight = weight * KG_TO_G
+
+
+def create_synthetic_tables(shop):
+    carrier = ShippingCarrier.objects.create(name="Benchmark carrier")
+    regions = [
+        CountryShippingRegion.objects.create(name="Region %d" % index, priority=index % 3, country="BR")
+        for index in range(REGIONS)
+    ]
+
+    items_per_table = ROWS // TABLES
+    ranges_per_region = items_per_table // REGIONS
+
+    for table_index in range(TABLES):
+        table = ShippingTable.objects.create(identifier="benchmark-%d" % table_index,
+                                             name="Benchmark %d" % table_index,
+                                             carrier=carrier)
+        table.shops.add(shop)
+
+        table_items = []
+        for region in regions:
+            for range_index in range(ranges_per_region):
+                table_items.append(ShippingTableItem(table=table,
+                                                     region=region,
+                                                     start_weight=Decimal(range_index),
+                                                     end_weight=Decimal(range_index) + Decimal("0.999"),
+                                                     price=Decimal(range_index),
+                                                     delivery_time=range_index % 30))
+        ShippingTableItem.objects.bulk_create(table_items, batch_size=100)
+
+    return ranges_per_region
+
+
+def get_query_plan(queryset):
+    sql, params = queryset.query.sql_with_params()
+    explain = "EXPLAIN QUERY PLAN " if connection.vendor == "sqlite" else "EXPLAIN "
+
+    with connection.cursor() as cursor:
+        cursor.execute(explain + sql, params)
+        return "\n".join(" ".join(str(column) for column in row) for row in cursor.fetchall())
+
+
+def time_lookups(component, shop, weights):
+    start = time.time()
+    for weight in weights:
+        list(component.get_available_table_items(BenchmarkSource(shop, weight)).values_list("pk", flat=True))
+    return (time.time() - start) / len(weights)
+
+
+def drop_lookup_indexes():
+    priority_field = ShippingRegion._meta.get_field("priority")
+    unindexed_priority_field = priority_field.clone()
+    unindexed_priority_field.db_index = False
+    unindexed_priority_field.set_attributes_from_name("priority")
+    unindexed_priority_field.model = ShippingRegion
+
+    with connection.schema_editor() as schema_editor:
+        schema_editor.alter_index_together(ShippingTableItem, ShippingTableItem._meta.index_together, [])
+        schema_editor.alter_field(ShippingRegion, priority_field, unindexed_priority_field)
+
+
+@pytest.mark.django_db
+def test_benchmark_weight_lookup():
+    shop = get_default_shop()
+    ranges = create_synthetic_tables(shop)
+    component = ShippingTableByModeBehaviorComponent.objects.create(mode=FetchTableMode.LOWEST_PRICE)
+
+    random.seed(0)
+    weights = [Decimal(random.randint(0, ranges * 1000 - 1)) / 1000 for _ in range(LOOKUPS)]
+    queryset = component.get_available_table_items(BenchmarkSource(shop, weights[0]))
+
+    results = []
+    results.append(("indexed", get_query_plan(queryset), time_lookups(component, shop, weights)))
+    drop_lookup_indexes()
+    results.append(("not indexed", get_query_plan(queryset), time_lookups(component, shop, weights)))
+
+    print("\n%d table items, %d lookups (%s)" % (ShippingTableItem.objects.count(), LOOKUPS, connection.vendor))
+    for (name, plan, duration) in results:
+        print("\n== %s: %.2f ms per lookup\n%s" % (name, duration * 1000, plan))
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Shipping Table
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+from __future__ import unicode_literals
+
+import pytest
+from shuup_shipping_table import cache as shipping_table_cache
+from shuup_shipping_table import engine, matching, snapshot
+
+from django.core.cache import cache
+
+
+@pytest.fixture(autouse=True)
+def clear_shipping_table_caches():
+    """
+    Starts every test without the lookups, generations and indexes of the
+    previous ones, since the generations are only bumped when changes commit.
+    """
+    cache.clear()
+    engine.invalidate_rate_indexes()
+    engine._weight_breakpoints.clear()
+    matching._region_indexes.clear()
+    snapshot._snapshots.clear()
+    shipping_table_cache._version_check.update(checked_at=None, version=None)
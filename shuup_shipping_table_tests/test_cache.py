@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Shipping Table
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+from __future__ import unicode_literals
+
+from decimal import Decimal
+
+import pytest
+from shuup_shipping_table.cache import clear_source_cache, get_packaging_cache, LRUCache
+from shuup_shipping_table.models import (
+    FetchTableMode, ShippingCarrier, ShippingTable, ShippingTableByModeBehaviorComponent,
+    SpecificShippingTableBehaviorComponent
+)
+from shuup_shipping_table_tests.test_models import (
+    add_product_line, count_lookups, create_test_data, get_custom_carrier_service, get_source
+)
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from shuup.core.models._order_lines import OrderLineType
+from shuup.testing.factories import get_default_product, get_default_supplier
+
+
+def test_lru_cache():
+    lru_cache = LRUCache(2)
+    lru_cache.set("a", 1)
+    lru_cache.set("b", 2)
+    assert lru_cache.get("a") == 1
+
+    # "b" is the least recently used
+    lru_cache.set("c", 3)
+    assert len(lru_cache) == 2
+    assert lru_cache.get("b") is None
+    assert lru_cache.get("a") == 1
+    assert lru_cache.get("c") == 3
+
+    lru_cache.clear()
+    assert lru_cache.get("a", "missing") == "missing"
+
+
+@pytest.mark.django_db
+def test_packing_reused(admin_user, monkeypatch):
+    get_packaging_cache().clear()
+    service = get_custom_carrier_service()
+    source = get_source(admin_user, service)
+
+    product = get_default_product()
+    product.gross_weight = Decimal(700)
+    product.width = Decimal(340)
+    product.depth = Decimal(320)
+    product.height = Decimal(180)
+    product.save()
+
+    source.add_line(
+        type=OrderLineType.PRODUCT,
+        product=product,
+        supplier=get_default_supplier(),
+        quantity=8,
+        base_unit_price=source.create_price(10),
+    )
+
+    packings = []
+    pack_source = ShippingTableByModeBehaviorComponent.pack_source
+
+    def counting_pack_source(self, source):
+        packings.append(source)
+        return pack_source(self, source)
+
+    monkeypatch.setattr(ShippingTableByModeBehaviorComponent, "pack_source", counting_pack_source)
+
+    components = [
+        ShippingTableByModeBehaviorComponent.objects.create(
+            mode=mode, use_cubic_weight=True, cubic_weight_exemption=Decimal(3)
+        )
+        for mode in (FetchTableMode.LOWEST_PRICE, FetchTableMode.LOWEST_DELIVERY_TIME)
+    ]
+
+    # same package limits, same contents: packed only once
+    weight = components[0].get_source_weight(source)
+    assert components[0].get_source_weight(source) == weight
+    assert components[1].get_source_weight(source) == weight
+    assert len(packings) == 1
+
+    # other package limits
+    components[1].max_package_weight = Decimal(2)
+    components[1].get_source_weight(source)
+    assert len(packings) == 2
+
+    # other contents
+    source.add_line(
+        type=OrderLineType.PRODUCT,
+        product=product,
+        supplier=get_default_supplier(),
+        quantity=1,
+        base_unit_price=source.create_price(10),
+    )
+    components[0].get_source_weight(source)
+    assert len(packings) == 3
+
+
+@pytest.mark.django_db(transaction=True)
+def test_component_filters_cached():
+    create_test_data()
+    table = ShippingTable.objects.get(identifier="table-1")
+    carrier = ShippingCarrier.objects.first()
+    component = ShippingTableByModeBehaviorComponent.objects.create(mode=FetchTableMode.LOWEST_PRICE)
+    component.tables.add(table)
+
+    def get_filter_ids():
+        # a fresh instance, like the ones loaded on every request
+        return ShippingTableByModeBehaviorComponent.objects.get(pk=component.pk).get_filter_ids()
+
+    assert get_filter_ids() == (frozenset([table.pk]), frozenset())
+
+    fresh_component = ShippingTableByModeBehaviorComponent.objects.get(pk=component.pk)
+    with CaptureQueriesContext(connection) as context:
+        assert fresh_component.get_filter_ids() == (frozenset([table.pk]), frozenset())
+        fresh_component.get_lookup_config()
+    assert len(context.captured_queries) == 0
+
+    component.carriers.add(carrier)
+    assert get_filter_ids() == (frozenset([table.pk]), frozenset([carrier.pk]))
+
+    carrier.shippingtablebymodebehaviorcomponent_set.remove(component)
+    assert get_filter_ids() == (frozenset([table.pk]), frozenset())
+
+    table.delete()
+    assert get_filter_ids() == (frozenset(), frozenset())
+
+
+@pytest.mark.django_db
+def test_source_cache_checked_once(admin_user, monkeypatch):
+    create_test_data()
+    service = get_custom_carrier_service()
+    component = ShippingTableByModeBehaviorComponent.objects.create(mode=FetchTableMode.LOWEST_PRICE)
+
+    source = get_source(admin_user, service)
+    add_product_line(source)
+    source.shipping_address.postal_code = "89060201"
+    table_item = component.resolve_table_item(source)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("The source cache was validated again")
+
+    # the hooks of the same source don't read the generations again
+    monkeypatch.setattr("shuup_shipping_table.cache.get_generation", fail)
+    monkeypatch.setattr("shuup_shipping_table.cache.get_table_transitions", fail)
+    for hook in range(3):
+        assert component.resolve_table_item(source) == table_item
+
+
+@pytest.mark.django_db(transaction=True)
+def test_misses_cached(admin_user, settings, monkeypatch):
+    settings.SHIPPING_TABLE_MISS_CACHE_TTL = 60
+    create_test_data()
+    service = get_custom_carrier_service()
+    component = ShippingTableByModeBehaviorComponent.objects.create(mode=FetchTableMode.LOWEST_PRICE)
+
+    source = get_source(admin_user, service)
+    add_product_line(source)
+    # no table covers this country
+    source.shipping_address.country = "AR"
+
+    lookups = count_lookups(monkeypatch)
+
+    def get_reasons():
+        clear_source_cache(source)
+        return list(component.get_unavailability_reasons(service, source))
+
+    assert len(get_reasons()) == 1
+    assert len(get_reasons()) == 1
+    assert len(lookups) == 1
+
+    # table changes invalidate the misses
+    ShippingTable.objects.get(identifier="table-1").save()
+    assert len(get_reasons()) == 1
+    assert len(lookups) == 2
+
+    # and so do other addresses
+    source.shipping_address.country = "BR"
+    source.shipping_address.postal_code = "89060201"
+    assert get_reasons() == []
+    assert len(lookups) == 3
+
+
+@pytest.mark.django_db
+def test_lookups_shared_by_weight_band(admin_user, settings, monkeypatch):
+    settings.SHIPPING_TABLE_QUOTE_CACHE_TTL = 60
+    create_test_data()
+    service = get_custom_carrier_service()
+    component = ShippingTableByModeBehaviorComponent.objects.create(mode=FetchTableMode.LOWEST_PRICE)
+
+    lookups = count_lookups(monkeypatch)
+
+    product = get_default_product()
+    product.gross_weight = Decimal(100)
+    product.save()
+
+    def resolve(quantity):
+        source = get_source(admin_user, service)
+        add_product_line(source, quantity=quantity, weight=None, product=product)
+        source.shipping_address.postal_code = "89060201"
+        return component.resolve_table_item(source)
+
+    # 0.2kg, 0.3kg and 0.9kg are in the 0..1 band
+    table_item = resolve(2)
+    assert table_item is not None
+    assert resolve(3) == table_item
+    assert resolve(9).price == table_item.price
+    assert len(lookups) == 1
+
+    # 2kg is in the 1.01..5 band
+    assert resolve(20) != table_item
+    assert len(lookups) == 2
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("postal_code", ["89060201", "89040001", "99090001", "89060100"])
+def test_candidates_shared_by_components(admin_user, settings, postal_code):
+    create_test_data()
+    service = get_custom_carrier_service()
+
+    carrier_component = ShippingTableByModeBehaviorComponent.objects.create(mode=FetchTableMode.LOWEST_PRICE)
+    carrier_component.carriers.add(ShippingCarrier.objects.first())
+    components = [
+        ShippingTableByModeBehaviorComponent.objects.create(mode=FetchTableMode.LOWEST_PRICE),
+        ShippingTableByModeBehaviorComponent.objects.create(mode=FetchTableMode.LOWEST_DELIVERY_TIME),
+        SpecificShippingTableBehaviorComponent.objects.create(table=ShippingTable.objects.get(identifier="table-2")),
+        carrier_component
+    ]
+
+    source = get_source(admin_user, service)
+    add_product_line(source)
+    source.shipping_address.postal_code = postal_code
+
+    expected = [component.get_first_available_item(source) for component in components]
+    clear_source_cache(source)
+
+    settings.SHIPPING_TABLE_SHARE_CANDIDATES = True
+    assert components[0].get_first_available_item(source) == expected[0]
+
+    # the other components reuse the candidates and the region matches
+    with CaptureQueriesContext(connection) as context:
+        for component, expected_item in zip(components[1:], expected[1:]):
+            assert component.get_first_available_item(source) == expected_item
+    assert len(context.captured_queries) == 0
+
+
+@pytest.mark.django_db(transaction=True)
+def test_items_pinned_through_checkout(admin_user, settings, monkeypatch):
+    settings.SHIPPING_TABLE_PIN_ITEMS = True
+    create_test_data()
+    service = get_custom_carrier_service()
+    component = ShippingTableByModeBehaviorComponent.objects.create(mode=FetchTableMode.LOWEST_PRICE)
+
+    lookups = count_lookups(monkeypatch)
+
+    def get_phase_source(postal_code="89060201"):
+        # each checkout phase builds its source again from the basket data
+        source = get_source(admin_user, service)
+        source.shipping_data = shipping_data
+        source.shipping_address.postal_code = postal_code
+        add_product_line(source)
+        return source
+
+    shipping_data = {}
+    table_item = component.resolve_table_item(get_phase_source())
+    assert table_item is not None
+    assert len(lookups) == 1
+
+    assert component.resolve_table_item(get_phase_source()) == table_item
+    assert len(lookups) == 1
+
+    # the address changed
+    component.resolve_table_item(get_phase_source("99090001"))
+    assert len(lookups) == 2
+    assert component.resolve_table_item(get_phase_source()) == table_item
+    assert len(lookups) == 2
+
+    # the tables changed
+    ShippingTable.objects.get(identifier="table-1").save()
+    assert component.resolve_table_item(get_phase_source()) == table_item
+    assert len(lookups) == 3
+    assert component.resolve_table_item(get_phase_source()) == table_item
+    assert len(lookups) == 3
+
+    # explicit invalidation resolves and pins again
+    source = get_phase_source()
+    clear_source_cache(source)
+    assert component.resolve_table_item(source) == table_item
+    assert len(lookups) == 4
+
+    # the basket data is never touched
+    assert shipping_data == {}
+
+
+@pytest.mark.django_db
+def test_items_not_pinned_by_default(admin_user, monkeypatch):
+    create_test_data()
+    service = get_custom_carrier_service()
+    component = ShippingTableByModeBehaviorComponent.objects.create(mode=FetchTableMode.LOWEST_PRICE)
+
+    lookups = count_lookups(monkeypatch)
+
+    for _ in range(2):
+        source = get_source(admin_user, service)
+        source.shipping_address.postal_code = "89060201"
+        add_product_line(source)
+        assert component.resolve_table_item(source) is not None
+    assert len(lookups) == 2
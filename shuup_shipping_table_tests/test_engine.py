@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Shipping Table
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+from __future__ import unicode_literals
+
+from datetime import timedelta
+from decimal import Decimal
+
+import pytest
+from shuup_shipping_table.cache import (
+    check_version, get_generation, get_next_transition, get_table_transitions
+)
+from shuup_shipping_table.engine import get_rate_index, get_weight_band, RateIndex
+from shuup_shipping_table.intervals import IntervalIndex
+from shuup_shipping_table.models import (
+    AddressShippingRegion, CountryShippingRegion, FetchTableMode, get_shop_table_items,
+    PostalCodeRangeShippingRegion, ShippingCarrier, ShippingRegion, ShippingTable,
+    ShippingTableByModeBehaviorComponent, ShippingTableItem, ShippingTableVersion,
+    SpecificShippingTableBehaviorComponent
+)
+from shuup_shipping_table_tests.test_models import (
+    add_product_line, create_test_data, get_custom_carrier_service, get_source
+)
+
+from django.core.management import call_command
+from django.db import transaction
+from django.db.models.deletion import Collector
+from django.db.models.signals import post_delete, post_save
+from django.utils.encoding import force_text
+from django.utils.timezone import now
+
+from shuup.core.models import Shop, ShopStatus
+from shuup.testing.factories import get_address, get_default_shop
+
+# the smallest weight step of the table items
+EPSILON = Decimal("0.000000001")
+
+
+def test_interval_index():
+    index = IntervalIndex([
+        (0, 10, "a"),
+        (5, 6, "b"),
+        (8, 20, "c"),
+        (30, 40, "d"),
+    ])
+    assert len(index) == 4
+    assert index.find(-1) == []
+    assert index.find(0) == ["a"]
+    assert index.find(5) == ["a", "b"]
+    assert index.find(9) == ["a", "c"]
+    assert index.find(20) == ["c"]
+    assert index.find(25) == []
+    assert index.find(40) == ["d"]
+    assert IntervalIndex([]).find(1) == []
+
+
+def test_weight_band():
+    breakpoints = [Decimal(0), Decimal(1), Decimal("1.01"), Decimal(5)]
+    assert get_weight_band(breakpoints, Decimal(-1)) == 0
+    assert get_weight_band(breakpoints, Decimal(0)) == 1
+    assert get_weight_band(breakpoints, Decimal("0.2")) == get_weight_band(breakpoints, Decimal("0.9")) == 2
+    assert get_weight_band(breakpoints, Decimal(1)) == 3
+    assert get_weight_band(breakpoints, Decimal("1.005")) == 4
+    assert get_weight_band(breakpoints, Decimal(5)) == 7
+    assert get_weight_band(breakpoints, Decimal(6)) == 8
+    assert get_weight_band([], Decimal(1)) == 0
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("postal_code", ["89060201", "89040001", "99090001", "89060100", "89060003"])
+@pytest.mark.parametrize("mode", [FetchTableMode.LOWEST_PRICE, FetchTableMode.LOWEST_DELIVERY_TIME])
+def test_rate_index_matches_database(admin_user, settings, postal_code, mode):
+    create_test_data()
+
+    service = get_custom_carrier_service()
+    components = [
+        ShippingTableByModeBehaviorComponent.objects.create(mode=mode),
+        SpecificShippingTableBehaviorComponent.objects.create(table=ShippingTable.objects.get(identifier='table-1'))
+    ]
+    source = get_source(admin_user, service)
+    add_product_line(source)
+    source.shipping_address.postal_code = postal_code
+
+    for component in components:
+        settings.SHIPPING_TABLE_USE_RATE_INDEX = False
+        expected = component.get_first_available_item(source)
+        settings.SHIPPING_TABLE_USE_RATE_INDEX = True
+        assert component.get_first_available_item(source) == expected
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize("postal_code", ["89060201", "89040001", "99090001", "89060100"])
+def test_snapshot_matches_database(admin_user, settings, tmpdir, postal_code):
+    from shuup_shipping_table.snapshot import get_snapshot
+
+    create_test_data()
+    shop = get_default_shop()
+    service = get_custom_carrier_service()
+    components = [
+        ShippingTableByModeBehaviorComponent.objects.create(mode=FetchTableMode.LOWEST_PRICE),
+        ShippingTableByModeBehaviorComponent.objects.create(mode=FetchTableMode.LOWEST_DELIVERY_TIME),
+        SpecificShippingTableBehaviorComponent.objects.create(table=ShippingTable.objects.get(identifier='table-1'))
+    ]
+    source = get_source(admin_user, service)
+    add_product_line(source)
+    source.shipping_address.postal_code = postal_code
+
+    expected = [component.get_first_available_item(source) for component in components]
+
+    settings.SHIPPING_TABLE_SNAPSHOT_DIR = str(tmpdir)
+    assert get_snapshot(shop) is None
+    call_command("build_shipping_table_snapshots")
+    assert get_snapshot(shop) is not None
+
+    for (component, expected_item) in zip(components, expected):
+        table_item = component.get_first_available_item(source)
+        assert table_item == expected_item
+        if table_item:
+            assert table_item.price == expected_item.price
+            assert table_item.delivery_time == expected_item.delivery_time
+
+    # weights on the boundaries of the items, and just around them
+    snapshot = get_snapshot(shop)
+    for boundary in ShippingTableItem.objects.values_list("start_weight", "end_weight"):
+        for weight in boundary + tuple(weight + delta for weight in boundary for delta in (-EPSILON, EPSILON)):
+            assert (set(item.pk for item in snapshot.get_table_items(weight)) ==
+                    set(get_shop_table_items(shop, weight).values_list("pk", flat=True)))
+
+    # outdated snapshots are ignored
+    ShippingTable.objects.get(identifier="table-1").save()
+    assert get_snapshot(shop) is None
+
+    # and replaced when built again
+    call_command("build_shipping_table_snapshots")
+    assert get_snapshot(shop) is not None
+    with pytest.raises(ValueError):
+        snapshot.buffer[0]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_rate_index_rebuilt_on_change():
+    create_test_data()
+    shop = get_default_shop()
+
+    rate_index = get_rate_index(shop)
+    assert get_rate_index(shop) is rate_index
+    # expired, disabled and shopless tables are not available
+    assert len(rate_index.get_table_items(Decimal(500))) == 0
+
+    table_item = ShippingTableItem.objects.filter(table__identifier="table-1").first()
+    table_item.end_weight = 1000
+    table_item.save()
+
+    rate_index = get_rate_index(shop)
+    assert rate_index.get_table_items(Decimal(500)) == [table_item]
+
+
+@pytest.mark.django_db
+def test_rate_index_expires_on_table_transitions():
+    create_test_data()
+    shop = get_default_shop()
+    table = ShippingTable.objects.get(identifier="table-1")
+    table.start_date = now() + timedelta(hours=1)
+    table.end_date = None
+    table.save()
+
+    rate_index = get_rate_index(shop)
+    table_items = list(table.shippingtableitem_set.all())
+    assert not any(table_item in rate_index.get_table_items(Decimal("0.2")) for table_item in table_items)
+
+    # the other tables of the shop end in a day
+    assert rate_index.expires_at == table.start_date
+    assert not rate_index.is_expired(table.start_date - timedelta(microseconds=1))
+    assert rate_index.is_expired(table.start_date)
+
+    later_index = RateIndex(shop.pk, table_items, when=table.start_date)
+    assert later_index.get_table_items(Decimal("0.2"))
+    assert later_index.expires_at is None
+
+    # the resolutions memoized in a source expire at the same moment
+    assert get_next_transition(get_table_transitions(shop.pk), now()) == table.start_date
+
+
+@pytest.mark.django_db(transaction=True)
+def test_generation_bumped_on_changes():
+    create_test_data()
+    shop = get_default_shop()
+    table = ShippingTable.objects.get(identifier="table-1")
+
+    def assert_bumped(func):
+        generation = get_generation(shop.pk)
+        func()
+        assert get_generation(shop.pk) != generation
+
+    assert_bumped(lambda: table.save())
+    assert_bumped(lambda: table.shippingtableitem_set.first().save())
+    assert_bumped(lambda: table.shippingtableitem_set.first().delete())
+    assert_bumped(lambda: ShippingCarrier.objects.first().save())
+    assert_bumped(lambda: CountryShippingRegion.objects.first().save())
+    assert_bumped(lambda: PostalCodeRangeShippingRegion.objects.last().delete())
+    assert_bumped(lambda: table.excluded_regions.add(CountryShippingRegion.objects.first()))
+    assert_bumped(lambda: table.excluded_regions.clear())
+    assert_bumped(lambda: table.shops.remove(shop))
+    assert_bumped(lambda: shop.shop_shipping_tables.add(table))
+    assert_bumped(lambda: table.delete())
+
+
+def test_region_receivers_have_senders():
+    for model in (ShippingRegion, PostalCodeRangeShippingRegion, CountryShippingRegion, AddressShippingRegion):
+        assert post_save.has_listeners(model)
+        assert post_delete.has_listeners(model)
+
+    # a receiver without a sender would turn off the fast deletes of every model
+    for signal in (post_save, post_delete):
+        assert not [lookup_key for (lookup_key, receiver) in signal.receivers
+                    if force_text(lookup_key[0]).startswith("shipping_table:") and lookup_key[1] == id(None)]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_generation_bumped_on_commit():
+    create_test_data()
+    shop = get_default_shop()
+    other_shop = Shop.objects.create(identifier="other", status=ShopStatus.ENABLED)
+    table = ShippingTable.objects.get(identifier="table-1")
+    other_table = ShippingTable.objects.get(identifier="table-2")
+    other_table.shops.clear()
+    other_table.shops.add(other_shop)
+
+    generation = get_generation(shop.pk)
+    with transaction.atomic():
+        table.save()
+        # concurrent requests would still read the rows of before the change
+        assert get_generation(shop.pk) == generation
+    assert get_generation(shop.pk) != generation
+
+    # both tables of an item moved to another table are bumped
+    generations = (get_generation(shop.pk), get_generation(other_shop.pk))
+    table_item = table.shippingtableitem_set.first()
+    table_item.table = other_table
+    table_item.save()
+    assert get_generation(shop.pk) != generations[0]
+    assert get_generation(other_shop.pk) != generations[1]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_changes_bumped_once_per_transaction():
+    create_test_data()
+    shop = get_default_shop()
+    table = ShippingTable.objects.get(identifier="table-1")
+
+    version = ShippingTableVersion.get_current()
+    generation = get_generation(shop.pk)
+    with transaction.atomic():
+        for table_item in table.shippingtableitem_set.all():
+            table_item.price += 1
+            table_item.save()
+        assert ShippingTableVersion.get_current() == version + 1
+        assert get_generation(shop.pk) == generation
+    assert get_generation(shop.pk) != generation
+
+    # the changes of a rolled back transaction don't leak into the next one
+    with pytest.raises(ValueError):
+        with transaction.atomic():
+            table.save()
+            raise ValueError()
+
+    version = ShippingTableVersion.get_current()
+    generation = get_generation(shop.pk)
+    with transaction.atomic():
+        table.save()
+    assert ShippingTableVersion.get_current() == version + 1
+    assert get_generation(shop.pk) != generation
+
+    # without delete receivers, the items of a table are deleted without fetching them
+    assert Collector(using="default").can_fast_delete(table.shippingtableitem_set.all())
+
+
+@pytest.mark.django_db(transaction=True)
+def test_version_stamp(settings):
+    create_test_data()
+    shop = get_default_shop()
+
+    version = ShippingTableVersion.get_current()
+    ShippingTable.objects.get(identifier="table-1").save()
+    assert ShippingTableVersion.get_current() == version + 1
+
+    settings.SHIPPING_TABLE_VERSION_CHECK_INTERVAL = 0
+    check_version()
+    generation = get_generation(shop.pk)
+    assert get_generation(shop.pk) == generation
+
+    # a change made by another node: the version moves, but not the cached generations
+    ShippingTableVersion.objects.update(version=version + 10)
+    assert get_generation(shop.pk) != generation
+
+    # not checked again before the interval is over
+    settings.SHIPPING_TABLE_VERSION_CHECK_INTERVAL = 3600
+    generation = get_generation(shop.pk)
+    ShippingTableVersion.objects.update(version=version + 20)
+    assert get_generation(shop.pk) == generation
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("mode", [FetchTableMode.LOWEST_PRICE, FetchTableMode.LOWEST_DELIVERY_TIME])
+def test_rate_matrix_matches_quotes(monkeypatch, mode):
+    pytest.importorskip("numpy")
+    from shuup_shipping_table.matrix import RateMatrix
+
+    create_test_data()
+    shop = get_default_shop()
+    component = ShippingTableByModeBehaviorComponent.objects.create(mode=mode, add_price=Decimal(2))
+
+    addresses = [
+        get_address(country=country, postal_code=postal_code)
+        for (country, postal_code) in [("BR", "89060201"), ("BR", "89040001"), ("BR", "99090001"),
+                                       ("BR", "89060100"), ("US", ""), ("AR", "89090001")]
+    ]
+    weights = [Decimal(weight) for weight in ("0", "0.2", "1", "1.005", "1.0099999999", "1.01", "1.0100000001",
+                                              "5", "10", "15", "20", "35", "150", "999")]
+
+    rate_matrix = RateMatrix(component, shop, min(weights), max(weights))
+    item_ids, prices, delivery_times = rate_matrix.evaluate(addresses, weights)
+    assert item_ids.shape == (len(addresses), len(weights))
+
+    quotes = component.get_quotes([(shop, address, weight) for address in addresses for weight in weights])
+    for index, quote in enumerate(quotes):
+        row, column = divmod(index, len(weights))
+        if quote is None:
+            assert item_ids[row, column] == -1
+            assert prices[row, column] is None
+        else:
+            assert item_ids[row, column] == quote.table_item.pk
+            # prices are kept exact
+            assert prices[row, column] == quote.price.value
+            assert delivery_times[row, column] == quote.delivery_time.min_duration.days
+
+    # the items of other weights are not loaded
+    with pytest.raises(ValueError):
+        RateMatrix(component, shop, Decimal(1), Decimal(10)).evaluate(addresses, weights)
+
+    # the items are compared in chunks
+    monkeypatch.setattr("shuup_shipping_table.matrix.MAX_MATRIX_CELLS", 1)
+    assert (rate_matrix.evaluate(addresses, weights)[0] == item_ids).all()
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Shipping Table
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+from __future__ import unicode_literals
+
+import gzip
+import json
+from decimal import Decimal
+from io import BytesIO
+
+import pytest
+from shuup_shipping_table.cache import get_generation
+from shuup_shipping_table.exporter import export_regions, export_table, iter_region_records, iter_table_item_rows
+from shuup_shipping_table.importer import (
+    InvalidFileError, iter_json_records, read_csv_rows, RegionImporter, TableItemImporter, TableItemSynchronizer
+)
+from shuup_shipping_table.models import (
+    CountryShippingRegion, PostalCodeRangeShippingRegion, ShippingCarrier, ShippingRegion, ShippingTable
+)
+
+from django.contrib import messages
+from django.core import serializers
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.encoding import force_text
+
+from shuup.testing.factories import get_default_shop
+from shuup.testing.utils import apply_request_middleware
+from shuup.utils.importing import load
+
+
+def create_table(identifier="table"):
+    carrier = ShippingCarrier.objects.create(name="Carrier")
+    table = ShippingTable.objects.create(identifier=identifier, name="Table", carrier=carrier)
+    table.shops.add(get_default_shop())
+    return table
+
+
+def test_read_csv_rows():
+    csv_file = BytesIO("\ufeffregion,price\n\"São Paulo, SP\",1.5\n".encode("utf-8"))
+    assert list(read_csv_rows(csv_file)) == [["\ufeffregion", "price"], ["São Paulo, SP", "1.5"]]
+
+
+@pytest.mark.django_db
+def test_import_invalid_files(rf, admin_user):
+    table = create_table()
+    CountryShippingRegion.objects.create(name="Brasil", country="BR")
+    csv_data = b"region,start_weight,end_weight,price,delivery_time\nBrasil,0,1,10,5\n\xff,0,2,10,5\n"
+
+    with pytest.raises(InvalidFileError):
+        TableItemImporter(table).import_file(BytesIO(csv_data), "csv")
+    assert not table.shippingtableitem_set.exists()
+
+    view = load("shuup_shipping_table.admin.views.table.TableItemImportView").as_view()
+    request = apply_request_middleware(rf.post("/", {
+        "items_file": SimpleUploadedFile("items.csv", csv_data),
+        "mode": "replace"
+    }), user=admin_user)
+    response = view(request, pk=table.pk)
+    assert response.status_code == 302
+    assert [force_text(message) for message in messages.get_messages(request)][0].startswith("Invalid CSV file")
+
+    pytest.importorskip("openpyxl")
+    with pytest.raises(InvalidFileError):
+        TableItemImporter(table).import_file(BytesIO(b"not a XLSX file"), "xlsx")
+
+
+@pytest.mark.django_db(transaction=True)
+def test_import_items():
+    table = create_table()
+    region_br = CountryShippingRegion.objects.create(name="Brasil", country="BR")
+    region_pcr = PostalCodeRangeShippingRegion.objects.create(name="São Paulo", country="BR",
+                                                              start_postal_code=1000000, end_postal_code=1999999)
+
+    csv_file = BytesIO((
+        "\ufeffprice,region,start_weight,end_weight,delivery_time\n"
+        "10.5,brasil,0,1,5\n"
+        "12,%d,1.001,2,6\n"
+        ",,,,\n"
+        "3.25,São Paulo,0,30,2\n" % region_br.pk
+    ).encode("utf-8"))
+
+    progress = []
+    generation = get_generation(get_default_shop().pk)
+    result = TableItemImporter(table, chunk_size=2, progress=lambda *args: progress.append(args)).import_file(
+        csv_file, "csv"
+    )
+
+    assert result.errors == []
+    assert result.created == 3
+    assert progress == [(2, 2), (3, 3)]
+    assert get_generation(get_default_shop().pk) != generation
+
+    items = list(table.shippingtableitem_set.order_by("pk"))
+    assert [(item.region_id, item.start_weight, item.end_weight, item.price, item.delivery_time) for item in items] == [
+        (region_br.pk, Decimal(0), Decimal(1), Decimal("10.5"), 5),
+        (region_br.pk, Decimal("1.001"), Decimal(2), Decimal(12), 6),
+        (region_pcr.pk, Decimal(0), Decimal(30), Decimal("3.25"), 2),
+    ]
+
+    # replace the items
+    csv_file = BytesIO(b"region,start_weight,end_weight,price,delivery_time\nBrasil,0,100,1,1\n")
+    result = TableItemImporter(table, replace=True).import_file(csv_file, "csv")
+    assert (result.created, result.deleted) == (1, 3)
+    assert table.shippingtableitem_set.count() == 1
+
+
+@pytest.mark.django_db
+def test_import_items_errors():
+    table = create_table()
+    CountryShippingRegion.objects.create(name="Brasil", country="BR")
+
+    csv_file = BytesIO(b"region,start_weight\nBrasil,0\n")
+    result = TableItemImporter(table).import_file(csv_file, "csv")
+    assert [error.line for error in result.errors] == [1]
+
+    csv_file = BytesIO((
+        "region,start_weight,end_weight,price,delivery_time\n"
+        "Brasil,0,1,10,5\n"
+        "Nowhere,0,1,10,5\n"
+        "Brasil,2,1,10,5\n"
+        "Brasil,0,1,abc,5\n"
+        "Brasil,0,1,10,-1\n"
+        "Brasil,0,1,10,1.5\n"
+        "Brasil,0,1,NaN,5\n"
+        "Brasil,0,Infinity,10,5\n"
+        "Brasil,0,1,1e40,5\n"
+        "Brasil,0,1,10,5\n"
+    ).encode("utf-8"))
+    result = TableItemImporter(table, chunk_size=1).import_file(csv_file, "csv")
+    assert result.created == 0
+    assert [error.line for error in result.errors] == [3, 4, 5, 6, 7, 8, 9, 10]
+
+    # nothing is written when some row is invalid
+    assert not table.shippingtableitem_set.exists()
+
+
+@pytest.mark.django_db
+def test_export_items():
+    table = create_table()
+    region = CountryShippingRegion.objects.create(name="Brasil", country="BR")
+    rows = "".join("Brasil,%d,%d.999,%d.5,%d\n" % (index, index, index, index % 10) for index in range(50))
+    TableItemImporter(table).import_file(
+        BytesIO(("region,start_weight,end_weight,price,delivery_time\n" + rows).encode("utf-8")), "csv"
+    )
+
+    # read in several chunks
+    assert len(list(iter_table_item_rows(table, chunk_size=7))) == 50
+
+    csv_data = b"".join(export_table(table, "csv"))
+    lines = csv_data.decode("utf-8").splitlines()
+    assert len(lines) == 51
+    assert lines[0] == "region,start_weight,end_weight,price,delivery_time"
+    assert lines[1].split(",")[0] == str(region.pk)
+
+    compressed = b"".join(export_table(table, "csv", compress=True))
+    assert gzip.GzipFile(fileobj=BytesIO(compressed)).read() == csv_data
+
+    jsonl_lines = [json.loads(line) for line in b"".join(export_table(table, "jsonl")).decode("utf-8").splitlines()]
+    assert jsonl_lines[0]["type"] == "table"
+    assert jsonl_lines[0]["identifier"] == table.identifier
+    assert len(jsonl_lines) == 51
+    assert Decimal(jsonl_lines[-1]["price"]) == Decimal("49.5")
+
+    # the CSV export can be imported again
+    other_table = create_table("other")
+    result = TableItemImporter(other_table).import_file(BytesIO(csv_data), "csv")
+    assert result.created == 50
+    assert list(iter_table_item_rows(other_table)) == list(iter_table_item_rows(table))
+
+
+@pytest.mark.django_db
+def test_export_regions():
+    region_br = CountryShippingRegion.objects.create(name="Brasil", country="BR")
+    region_br.set_current_language("en")
+    region_br.name = "Brazil"
+    region_br.save()
+    region_pcr = PostalCodeRangeShippingRegion.objects.create(name="São Paulo", country="BR",
+                                                              start_postal_code=1000000, end_postal_code=1999999)
+
+    # read in several chunks
+    assert len(list(iter_region_records(chunk_size=1))) == 2
+
+    data = b"".join(export_regions())
+    records = json.loads(data.decode("utf-8"))
+    models = [record["model"] for record in records]
+    assert models == [
+        "shuup_shipping_table.shippingregion",
+        "shuup_shipping_table.countryshippingregion",
+        "shuup_shipping_table.shippingregiontranslation",
+        "shuup_shipping_table.shippingregiontranslation",
+        "shuup_shipping_table.shippingregion",
+        "shuup_shipping_table.postalcoderangeshippingregion",
+        "shuup_shipping_table.shippingregiontranslation",
+    ]
+    names = set(record["fields"]["name"] for record in records if record["model"].endswith("translation"))
+    assert names == set(["Brasil", "Brazil", "São Paulo"])
+
+    # the export can be loaded again
+    ShippingRegion.objects.all().delete()
+    for deserialized_object in serializers.deserialize("json", data.decode("utf-8")):
+        deserialized_object.save()
+
+    assert CountryShippingRegion.objects.get(pk=region_br.pk).country == "BR"
+    region_pcr = ShippingRegion.objects.get(pk=region_pcr.pk)
+    assert isinstance(region_pcr, PostalCodeRangeShippingRegion)
+    assert region_pcr.end_postal_code == 1999999
+    assert region_pcr.name == "São Paulo"
+
+
+@pytest.mark.django_db(transaction=True)
+def test_sync_items():
+    table = create_table()
+    CountryShippingRegion.objects.create(name="Brasil", country="BR")
+    header = "region,start_weight,end_weight,price,delivery_time\n"
+    TableItemImporter(table).import_file(BytesIO((
+        header +
+        "Brasil,0,1,10,5\n"
+        "Brasil,1.001,2,12,6\n"
+        "Brasil,2.001,3,14,7\n"
+    ).encode("utf-8")), "csv")
+    item_ids = dict((item.start_weight, item.pk) for item in table.shippingtableitem_set.all())
+
+    # nothing changes
+    generation = get_generation(get_default_shop().pk)
+    csv_data = b"".join(export_table(table, "csv"))
+    result = TableItemSynchronizer(table).import_file(BytesIO(csv_data), "csv")
+    assert result == (0, 0, 0, 3, [])
+    assert get_generation(get_default_shop().pk) == generation
+
+    result = TableItemSynchronizer(table).import_file(BytesIO((
+        header +
+        "Brasil,0.000,1,10.00,5\n"
+        "Brasil,1.001,2,12.5,6\n"
+        "Brasil,3.001,4,16,8\n"
+    ).encode("utf-8")), "csv")
+    assert result == (1, 1, 1, 1, [])
+    assert get_generation(get_default_shop().pk) != generation
+
+    items = dict((item.start_weight, item) for item in table.shippingtableitem_set.all())
+    assert sorted(items) == [Decimal(0), Decimal("1.001"), Decimal("3.001")]
+    # the items are kept, not created again
+    assert items[Decimal(0)].pk == item_ids[Decimal(0)]
+    assert items[Decimal("1.001")].pk == item_ids[Decimal("1.001")]
+    assert items[Decimal("1.001")].price == Decimal("12.5")
+
+    result = TableItemSynchronizer(table).import_file(BytesIO((
+        header +
+        "Brasil,0,1,10,5\n"
+        "Brasil,0,1,11,5\n"
+    ).encode("utf-8")), "csv")
+    assert [error.line for error in result.errors] == [3]
+    assert table.shippingtableitem_set.count() == 3
+
+
+@pytest.mark.django_db
+def test_sync_items_twice():
+    table = create_table()
+    CountryShippingRegion.objects.create(name="Brasil", country="BR")
+    # more decimal places than the fields store
+    csv_data = (
+        "region,start_weight,end_weight,price,delivery_time\n"
+        "Brasil,0,1.0000000001,10.1234567891,5\n"
+        "Brasil,1.0000000011,2,12,6\n"
+    ).encode("utf-8")
+
+    result = TableItemSynchronizer(table).import_file(BytesIO(csv_data), "csv")
+    assert result == (2, 0, 0, 0, [])
+    assert table.shippingtableitem_set.get(start_weight=0).price == Decimal("10.123456789")
+
+    with CaptureQueriesContext(connection) as context:
+        result = TableItemSynchronizer(table).import_file(BytesIO(csv_data), "csv")
+    assert result == (0, 0, 0, 2, [])
+    assert not [query for query in context.captured_queries
+                if query["sql"].split()[0].upper() in ("INSERT", "UPDATE", "DELETE")]
+
+
+def test_iter_json_records():
+    data = '\ufeff [{"a": "São Paulo"},\n {"b": [1, 2]} ] '.encode("utf-8")
+    assert list(iter_json_records(BytesIO(data), read_size=3)) == [{"a": "São Paulo"}, {"b": [1, 2]}]
+    assert list(iter_json_records(BytesIO(b"[]"))) == []
+
+    for invalid_data in (b"", b"{}", b'[{"a": 1}', b"[1]"):
+        with pytest.raises(ValueError):
+            list(iter_json_records(BytesIO(invalid_data)))
+
+
+@pytest.mark.django_db(transaction=True)
+def test_import_regions():
+    region_br = CountryShippingRegion.objects.create(name="Brasil", country="BR")
+    region_pcr = PostalCodeRangeShippingRegion.objects.create(name="São Paulo", country="BR",
+                                                              start_postal_code=1000000, end_postal_code=1999999)
+    records = json.loads(b"".join(export_regions()).decode("utf-8"))
+
+    # nothing changes
+    generation = get_generation()
+    result = RegionImporter().import_file(BytesIO(json.dumps(records).encode("utf-8")))
+    assert result == (0, 0, 2, [])
+    assert get_generation() == generation
+
+    for record in records:
+        if record["model"] == "shuup_shipping_table.postalcoderangeshippingregion":
+            record["fields"]["end_postal_code"] = 1500000
+        if record["model"] == "shuup_shipping_table.shippingregiontranslation" and record["fields"]["name"] == "Brasil":
+            record["fields"]["name"] = "Brazil"
+
+    # a new region, without the base record, as in the older exports
+    records.append({"model": "shuup_shipping_table.countryshippingregion", "pk": 100, "fields": {"country": "AR"}})
+    records.append({"model": "shuup_shipping_table.shippingregiontranslation", "pk": None,
+                    "fields": {"master": 100, "language_code": "en", "name": "Argentina"}})
+
+    progress = []
+    result = RegionImporter(chunk_size=2, progress=lambda *args: progress.append(args)).import_file(
+        BytesIO(json.dumps(records).encode("utf-8"))
+    )
+    assert result == (1, 2, 0, [])
+    assert progress[-1] == (len(records), 3)
+    assert get_generation() != generation
+
+    assert ShippingRegion.objects.get(pk=region_br.pk).name == "Brazil"
+    assert ShippingRegion.objects.get(pk=region_pcr.pk).end_postal_code == 1500000
+    region_ar = ShippingRegion.objects.get(pk=100)
+    assert isinstance(region_ar, CountryShippingRegion)
+    assert (region_ar.country, region_ar.priority, region_ar.name) == ("AR", 0, "Argentina")
+
+    # the regions created later don't reuse the imported ids
+    assert CountryShippingRegion.objects.create(name="Chile", country="CL").pk > 100
+
+
+@pytest.mark.django_db
+def test_import_regions_errors():
+    region_br = CountryShippingRegion.objects.create(name="Brasil", country="BR")
+
+    records = [
+        {"model": "shuup_shipping_table.countryshippingregion", "pk": 10, "fields": {"country": "AR"}},
+        {"model": "shuup_shipping_table.shippingtable", "pk": 1, "fields": {}},
+        {"model": "shuup_shipping_table.postalcoderangeshippingregion", "pk": region_br.pk,
+         "fields": {"country": "BR", "start_postal_code": 1, "end_postal_code": 2}},
+        {"model": "shuup_shipping_table.postalcoderangeshippingregion", "pk": 11, "fields": {"country": "BR"}},
+        {"model": "shuup_shipping_table.shippingregiontranslation", "pk": None,
+         "fields": {"master": 12, "language_code": "en", "name": "Nowhere"}},
+    ]
+    result = RegionImporter().import_file(BytesIO(json.dumps(records).encode("utf-8")))
+    assert result.created == 0
+    assert [error.record for error in result.errors] == [2, 3, 4, 5]
+
+    # nothing is written when some record is invalid
+    assert ShippingRegion.objects.count() == 1
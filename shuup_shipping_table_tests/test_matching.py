@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Shipping Table
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+from __future__ import unicode_literals
+
+import pytest
+from shuup_shipping_table.matching import (
+    AddressRegionIndex, get_postal_code_index, has_custom_regions, PostalCodeRangeIndex, RegionMatcher
+)
+from shuup_shipping_table.models import (
+    AddressShippingRegion, CountryShippingRegion, FetchTableMode, PostalCodeRangeShippingRegion,
+    ShippingTableByModeBehaviorComponent
+)
+from shuup_shipping_table.utils import parse_postal_code
+from shuup_shipping_table_tests.test_models import (
+    add_product_line, create_test_data, get_custom_carrier_service, get_source
+)
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from shuup.testing.factories import get_address
+
+
+class AddressSource(object):
+    def __init__(self, **kwargs):
+        self.shipping_address = get_address(**kwargs)
+
+
+def test_parse_postal_code():
+    assert parse_postal_code("89060-201") == 89060201
+    assert parse_postal_code("ABC") is None
+    assert parse_postal_code("") is None
+    assert parse_postal_code(None) is None
+
+
+def test_postal_code_range_index():
+    index = PostalCodeRangeIndex([
+        (1, "BR", 89000000, 89999999),
+        (2, "BR", 89060000, 89070000),
+        (3, "BR", 1000000, 1999999),
+        (4, "US", 89000000, 89999999),
+    ])
+    assert index.find("BR", 89060001) == [1, 2]
+    assert index.find("BR", 89080001) == [1]
+    assert index.find("BR", 1500000) == [3]
+    assert index.find("BR", 500) == []
+    assert index.find("US", 89060001) == [4]
+    assert index.find("AR", 89060001) == []
+    assert index.find("BR", None) == []
+
+
+@pytest.mark.django_db(transaction=True)
+def test_region_matcher():
+    region1 = PostalCodeRangeShippingRegion.objects.create(name="PCR 1",
+                                                           start_postal_code=89060000,
+                                                           end_postal_code=89070000,
+                                                           country="BR")
+    region2 = PostalCodeRangeShippingRegion.objects.create(name="PCR 2",
+                                                           start_postal_code=89080000,
+                                                           end_postal_code=89090000,
+                                                           country="BR")
+    region3 = CountryShippingRegion.objects.create(name="Country BR", country="BR")
+
+    matcher = RegionMatcher(AddressSource(country="BR", postal_code="89060-201"))
+    assert matcher.is_compatible(region1)
+    assert not matcher.is_compatible(region2)
+    assert matcher.is_compatible(region3)
+
+    matcher = RegionMatcher(AddressSource(country="US", postal_code="89060-201"))
+    assert not matcher.is_compatible(region1)
+    assert not matcher.is_compatible(region3)
+
+    # the index is rebuilt when regions change
+    region2.start_postal_code = 89000000
+    region2.save()
+    assert len(get_postal_code_index().find("BR", 89060201)) == 2
+    matcher = RegionMatcher(AddressSource(country="BR", postal_code="89060-201"))
+    assert matcher.is_compatible(region2)
+
+
+def test_region_matcher_unsaved_regions():
+    matcher = RegionMatcher(AddressSource(country="BR", postal_code="89060-201"))
+    assert matcher.is_compatible(CountryShippingRegion(country="BR"))
+    assert not matcher.is_compatible(CountryShippingRegion(country="US"))
+    assert matcher.is_compatible(PostalCodeRangeShippingRegion(country="BR", start_postal_code=89060000,
+                                                               end_postal_code=89070000))
+
+
+def test_address_region_index():
+    index = AddressRegionIndex([
+        (1, "BR", "SC", "Blumenau, Joinville", None, None, None),
+        (2, "BR", None, " joinville ", "Rua A, Rua B", None, None),
+        (3, "BR", "SC", None, None, None, None),
+        (4, "US", None, "Joinville", None, None, None),
+    ])
+    source = AddressSource(country="BR", region="SC", city="JOINVILLE", street1="rua b")
+    assert sorted(index.find(source.shipping_address)) == [1, 2, 3]
+
+    source = AddressSource(country="BR", region="PR", city="Joinville", street1="Rua C")
+    assert index.find(source.shipping_address) == []
+
+    source = AddressSource(country="BR", region="SC", city="Curitiba")
+    assert index.find(source.shipping_address) == [3]
+
+
+def test_address_region_compiled_matchers():
+    region = AddressShippingRegion(country="BR", city="Blumenau, Joinville")
+    matchers = region.get_matchers()
+    assert matchers == (("city", frozenset(["BLUMENAU", "JOINVILLE"])),)
+    assert region.get_matchers() is matchers
+
+    # compiled again after a change
+    region.city = "Curitiba"
+    assert region.get_matchers() == (("city", frozenset(["CURITIBA"])),)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_region_matcher_address_regions():
+    region = AddressShippingRegion.objects.create(name="Address", country="BR", city="Blumenau, Joinville")
+
+    assert RegionMatcher(AddressSource(country="BR", city="joinville")).is_compatible(region)
+    assert not RegionMatcher(AddressSource(country="BR", city="Curitiba")).is_compatible(region)
+    assert not RegionMatcher(AddressSource(country="US", city="joinville")).is_compatible(region)
+
+    region.city = "Curitiba"
+    region.save()
+    assert RegionMatcher(AddressSource(country="BR", city="Curitiba")).is_compatible(region)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("country,postal_code", [
+    ("BR", "89060201"), ("BR", "89040001"), ("BR", "99090001"), ("BR", "89060100"),
+    ("BR", ""), ("US", "12345"), ("AR", "89060201")
+])
+@pytest.mark.parametrize("mode", [FetchTableMode.LOWEST_PRICE, FetchTableMode.LOWEST_DELIVERY_TIME])
+def test_database_resolution_matches_python(admin_user, settings, country, postal_code, mode):
+    create_test_data()
+    AddressShippingRegion.objects.create(name="Address", country="BR", city="Blumenau")
+    assert not has_custom_regions()
+
+    component = ShippingTableByModeBehaviorComponent.objects.create(mode=mode)
+    source = get_source(admin_user, get_custom_carrier_service())
+    add_product_line(source)
+    source.shipping_address.country = country
+    source.shipping_address.postal_code = postal_code
+
+    settings.SHIPPING_TABLE_RESOLVE_IN_DATABASE = False
+    expected = component.get_first_available_item(source)
+
+    settings.SHIPPING_TABLE_RESOLVE_IN_DATABASE = True
+    assert component.get_first_available_item(source) == expected
+
+    with CaptureQueriesContext(connection) as context:
+        component.get_first_available_item(source)
+    assert len(context.captured_queries) == 1
@@ -16,8 +16,9 @@ import pytest
 from shuup_shipping_table.models import (
     AddressShippingRegion, CountryShippingRegion, FetchTableMode, PostalCodeRangeShippingRegion,
     ShippingCarrier, ShippingTable, ShippingTableByModeBehaviorComponent, ShippingTableItem,
-    SpecificShippingTableBehaviorComponent, KG_TO_G
+    SpecificShippingTableBehaviorComponent, KG_TO_G, OPTIONS_BY_CARRIER, OPTIONS_BY_TABLE
 )
+from shuup_shipping_table.cache import clear_source_cache
 from shuup_tests.front.test_checkout_flow import fill_address_inputs
 from shuup_tests.utils import SmartClient
 from shuup_tests.utils.basketish_order_source import BasketishOrderSource
@@ -37,6 +38,8 @@ from shuup.testing.soup_utils import extract_form_fields
 from shuup.xtheme._theme import set_current_theme
 
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.utils.timezone import now
 
 
@@ -281,6 +284,34 @@ def get_source(admin_user, service):
     return source
 
 
+def add_product_line(source, quantity=1, weight=Decimal("0.2"), product=None):
+    line_kwargs = {"weight": weight} if weight is not None else {}
+    source.add_line(
+        type=OrderLineType.PRODUCT,
+        product=product or get_default_product(),
+        supplier=get_default_supplier(),
+        quantity=quantity,
+        base_unit_price=source.create_price(10),
+        **line_kwargs
+    )
+
+
+def count_lookups(monkeypatch, component_class=ShippingTableByModeBehaviorComponent):
+    """
+    Returns the list where the sources of the lookups
+    which reach `get_first_available_item` are recorded.
+    """
+    lookups = []
+    get_first_available_item = component_class.get_first_available_item
+
+    def counting_get_first_available_item(self, source):
+        lookups.append(source)
+        return get_first_available_item(self, source)
+
+    monkeypatch.setattr(component_class, "get_first_available_item", counting_get_first_available_item)
+    return lookups
+
+
 @pytest.mark.django_db
 def test_lowest_price_table1_behavior(admin_user):
     create_test_data()
@@ -826,3 +857,197 @@ def test_shipping_table_behavior(admin_user):
 
     cubic_weight = (PRODUCT_WIDTH * PRODUCT_DEPTH * (PRODUCT_HEIGHT * 8)) / component.cubic_weight_factor
     assert abs((component.get_source_weight(source) * KG_TO_G) - cubic_weight) < Decimal(0.0001)
+
+
+@pytest.mark.django_db
+def test_source_weight_exact(admin_user):
+    create_test_data()
+    service = get_custom_carrier_service()
+    component = ShippingTableByModeBehaviorComponent.objects.create(mode=FetchTableMode.LOWEST_PRICE)
+
+    product = get_default_product()
+    product.gross_weight = Decimal(1000)
+    product.save()
+
+    source = get_source(admin_user, service)
+    source.shipping_address.postal_code = "89060201"
+    add_product_line(source, weight=None, product=product)
+
+    # Decimal(0.001) is a bit more than 0.001, which made 1000g weigh more than 1kg
+    assert component.get_source_weight(source) == Decimal(1)
+    first_item = ShippingTableItem.objects.get(table__identifier="table-1", start_weight=0, end_weight=1)
+    assert first_item in list(component.get_available_table_items(source))
+
+
+@pytest.mark.django_db
+def test_source_lookup_cache(admin_user, monkeypatch):
+    create_test_data()
+
+    service = get_custom_carrier_service()
+    component = ShippingTableByModeBehaviorComponent.objects.create(
+        mode=FetchTableMode.LOWEST_PRICE
+    )
+    service.behavior_components.add(component)
+    source = get_source(admin_user, service)
+
+    add_product_line(source)
+    source.shipping_address.postal_code = "89060201"
+
+    lookups = count_lookups(monkeypatch)
+
+    # the three hooks share the same resolution
+    assert len(list(component.get_unavailability_reasons(service, source))) == 0
+    costs = list(component.get_costs(service, source))
+    assert costs[0].price.value == Decimal(1)
+    assert component.get_delivery_time(service, source).min_duration.days == 8
+    assert len(lookups) == 1
+
+    # the address changed, resolve again
+    source.shipping_address.postal_code = "99090001"
+    costs = list(component.get_costs(service, source))
+    assert costs[0].price.value == Decimal(999)
+    assert len(lookups) == 2
+
+    # the component configuration changed, resolve again
+    component.carriers.add(ShippingCarrier.objects.get(name="Carrier 2"))
+    list(component.get_costs(service, source))
+    assert len(lookups) == 3
+
+    # the lines changed, resolve again
+    add_product_line(source, quantity=2)
+    list(component.get_costs(service, source))
+    list(component.get_costs(service, source))
+    assert len(lookups) == 4
+
+    # explicit invalidation
+    clear_source_cache(source)
+    list(component.get_costs(service, source))
+    assert len(lookups) == 5
+
+
+@pytest.mark.django_db
+def test_lookup_queries_do_not_grow_with_candidates(admin_user):
+    create_test_data()
+
+    service = get_custom_carrier_service()
+    component = ShippingTableByModeBehaviorComponent.objects.create(
+        mode=FetchTableMode.LOWEST_PRICE
+    )
+    service.behavior_components.add(component)
+    source = get_source(admin_user, service)
+
+    add_product_line(source)
+
+    # no region matches, so every candidate is checked
+    source.shipping_address.postal_code = "11111111"
+
+    with CaptureQueriesContext(connection) as context:
+        assert component.get_first_available_item(source) is None
+    queries = len(context.captured_queries)
+
+    table = ShippingTable.objects.get(identifier="table-1")
+    for index in range(40):
+        region = PostalCodeRangeShippingRegion.objects.create(name="Region %d" % index,
+                                                              start_postal_code=index * 10,
+                                                              end_postal_code=index * 10 + 5,
+                                                              country="BR")
+        table.excluded_regions.add(region)
+        ShippingTableItem.objects.create(table=table,
+                                         region=region,
+                                         start_weight=0,
+                                         end_weight=10,
+                                         price=1,
+                                         delivery_time=1)
+
+    with CaptureQueriesContext(connection) as context:
+        assert component.get_first_available_item(source) is None
+    assert len(context.captured_queries) == queries
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("mode", [FetchTableMode.LOWEST_PRICE, FetchTableMode.LOWEST_DELIVERY_TIME])
+def test_batch_quotes(admin_user, mode):
+    create_test_data()
+
+    service = get_custom_carrier_service()
+    component = ShippingTableByModeBehaviorComponent.objects.create(
+        mode=mode,
+        add_price=Decimal(3),
+        add_delivery_time_days=2
+    )
+    service.behavior_components.add(component)
+
+    product = get_default_product()
+    quote_requests = []
+    expected = []
+    for weight in (Decimal("0.5"), Decimal("3"), Decimal("15"), Decimal("300")):
+        # a source of each weight, to compare with the costs of a real checkout
+        product.gross_weight = weight * KG_TO_G
+        product.save()
+
+        for (country, postal_code) in [("BR", "89060201"), ("BR", "89040001"), ("BR", "99090001"),
+                                       ("BR", "89060100"), ("US", ""), ("AR", "89090001")]:
+            source = get_source(admin_user, service)
+            source.shipping_address.country = country
+            source.shipping_address.postal_code = postal_code
+            add_product_line(source, weight=None, product=product)
+            assert component.get_source_weight(source) == weight
+
+            quote_requests.append((get_default_shop(), source.shipping_address, weight))
+            expected.append((list(component.get_costs(service, source)),
+                             component.get_delivery_time(service, source)))
+
+    quotes = component.get_quotes(quote_requests)
+    assert len(quotes) == len(quote_requests)
+    assert any(quote is None for quote in quotes)
+    assert any(quote is not None for quote in quotes)
+
+    for quote, (costs, delivery_time) in zip(quotes, expected):
+        if not costs:
+            assert quote is None
+            assert delivery_time is None
+            continue
+
+        assert quote.price.value == costs[0].price.value
+        assert quote.delivery_time.min_duration == delivery_time.min_duration
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("postal_code", ["89060201", "89040001", "99090001", "89060100"])
+@pytest.mark.parametrize("mode", [FetchTableMode.LOWEST_PRICE, FetchTableMode.LOWEST_DELIVERY_TIME])
+def test_all_options(admin_user, postal_code, mode):
+    create_test_data()
+
+    service = get_custom_carrier_service()
+    component = ShippingTableByModeBehaviorComponent.objects.create(mode=mode, add_price=Decimal(1))
+    source = get_source(admin_user, service)
+    source.shipping_address.postal_code = postal_code
+    add_product_line(source)
+
+    carrier_options = component.get_all_options(source)
+    table_options = component.get_all_options(source, OPTIONS_BY_TABLE)
+    assert component.get_all_options(source, OPTIONS_BY_CARRIER) == carrier_options
+
+    # the first option is the item picked by the component
+    first_item = component.get_first_available_item(source)
+    assert (carrier_options[0].table_item if carrier_options else None) == first_item
+    assert (table_options[0].table_item if table_options else None) == first_item
+
+    # each option is the item the component would pick with only that carrier or table
+    for carrier in ShippingCarrier.objects.all():
+        carrier_component = ShippingTableByModeBehaviorComponent.objects.create(mode=mode)
+        carrier_component.carriers.add(carrier)
+        expected = carrier_component.get_first_available_item(source)
+        options = [option for option in carrier_options if option.table_item.table.carrier_id == carrier.pk]
+        assert [option.table_item for option in options] == ([expected] if expected else [])
+
+    for table in ShippingTable.objects.all():
+        expected = SpecificShippingTableBehaviorComponent.objects.create(table=table).get_first_available_item(source)
+        options = [option for option in table_options if option.table_item.table_id == table.pk]
+        if mode == FetchTableMode.LOWEST_PRICE:
+            assert [option.table_item for option in options] == ([expected] if expected else [])
+        else:
+            assert len(options) == (1 if expected else 0)
+
+    for option in carrier_options:
+        assert option.price.value == option.table_item.price + component.add_price